@@ -1,20 +1,112 @@
+import importlib.util
 import os
+import threading
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 
 
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'secret_key' # change for production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///theospec.db'
-app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'uploads')
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+# Extensions are created unbound and attached to each app in create_app, so
+# importing the package (e.g. for app.batch or the models) builds nothing
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
 login_manager.login_message_category = 'info'
 
 
-from app import routes
\ No newline at end of file
+def configure(server, config=None):
+    """
+    Apply the app's settings and extensions to a Flask server; config is an
+    optional dict of overrides.
+    """
+    server.config['SECRET_KEY'] = 'secret_key' # change for production
+    server.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///theospec.db'
+    server.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'uploads')
+    if config is not None:
+        server.config.update(config)
+    db.init_app(server)
+    bcrypt.init_app(server)
+    login_manager.init_app(server)
+    from app import metrics
+    metrics.init_app(server)
+    return server
+
+
+def load_simulator():
+    """
+    A fresh copy of the app.simulator module. The module builds its Dash
+    app, layout and callbacks when it runs, so running it once per Flask
+    app gives each app a simulator of its own rather than the one cached
+    by the first import.
+    """
+    spec = importlib.util.find_spec('app.simulator')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LazySimulator:
+    """
+    WSGI middleware that serves the Dash simulator under prefix and
+    everything else from the wrapped app. The simulator (dash, plotly,
+    pandas, scipy, its layout and callbacks) is only imported and built on
+    the first request for it, on a Flask server of its own configured like
+    the main app, since routes can't be added to an app already serving.
+    """
+
+    def __init__(self, app, prefix='/data/'):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.prefix = prefix
+        self._server = None
+        self._lock = threading.Lock()
+
+    def server(self):
+        """
+        The simulator's Flask server, built on first use.
+        """
+        if self._server is None:
+            with self._lock:
+                if self._server is None:
+                    # Building the layout lists the materials, so the import
+                    # needs the main app's database
+                    with self.app.app_context():
+                        server = load_simulator().simulator.server
+                    # Dash names its server after the simulator, so its
+                    # instance folder isn't the main app's; share it so a
+                    # relative sqlite URI opens the same database
+                    server.instance_path = self.app.instance_path
+                    configure(server, self.app.config)
+                    self._server = server
+        return self._server
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(self.prefix):
+            return self.server().wsgi_app(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def create_app(config=None, simulator=True):
+    """
+    Build the Flask app.
+
+    input
+    ======
+
+    config: dict
+        overrides of the default settings, e.g. SQLALCHEMY_DATABASE_URI
+    simulator: bool
+        serve the Dash simulator under /data/ (built on its first request);
+        False for the pages and API only, e.g. in tests and batch jobs
+
+    """
+    app = configure(Flask(__name__), config)
+    from app.routes import main
+    from app.api import api
+    app.register_blueprint(main)
+    app.register_blueprint(api)
+    if simulator:
+        app.wsgi_app = LazySimulator(app)
+    return app
@@ -0,0 +1,164 @@
+import io
+
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from app.grids import grid_from_dict
+from app.timing import stage, timed
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MAX_STACKS = 5000 # per request
+MAX_VALUES = 20000000 # stacks x wavelengths per request
+
+
+class APIError(ValueError):
+    """
+    A problem with the request, reported to the client as a 400
+    """
+
+
+@api.errorhandler(APIError)
+def handle_api_error(error):
+    response = jsonify({'error': str(error)})
+    response.status_code = 400
+    return response
+
+
+def parse_grid(spec):
+    """
+    Wavelength grid from its JSON form (see grids.grid_from_dict), or the
+    simulator's grid if omitted
+    """
+    if spec is None:
+        from app.spectra import SPECTRAL_GRID
+        return SPECTRAL_GRID
+    try:
+        return grid_from_dict(spec)
+    except (TypeError, ValueError) as error:
+        raise APIError('Invalid grid: {}'.format(error))
+
+
+def parse_number(value, name):
+    """
+    A finite real number from the JSON body (JSON booleans are rejected
+    even though Python treats them as numbers)
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise APIError('{} must be a number'.format(name))
+    value = float(value)
+    if not np.isfinite(value):
+        raise APIError('{} must be finite'.format(name))
+    return value
+
+
+def parse_stacks(specs):
+    """
+    (mat_names, thicknesses, incoherent) tuples from the JSON stack list
+    """
+    if not isinstance(specs, list) or not specs:
+        raise APIError('stacks must be a non-empty list')
+    if len(specs) > MAX_STACKS:
+        raise APIError('At most {} stacks per request'.format(MAX_STACKS))
+    stacks = []
+    for i, spec in enumerate(specs):
+        try:
+            materials = [str(mat) for mat in spec['materials']]
+            thicknesses = [float(d) for d in spec['thicknesses']]
+            incoherent = [int(j) for j in spec.get('incoherent', [])]
+        except (KeyError, TypeError, ValueError):
+            raise APIError('stack {} needs "materials" and numeric '
+                           '"thicknesses" lists'.format(i))
+        if len(materials) != len(thicknesses):
+            raise APIError('stack {}: need one thickness per film'.format(i))
+        if any(d < 0 or not np.isfinite(d) for d in thicknesses):
+            raise APIError('stack {}: thicknesses must be finite and '
+                           'non-negative'.format(i))
+        stacks.append((materials, thicknesses, incoherent))
+    return stacks
+
+
+def parse_request(body):
+    """
+    Validated settings of a /reflectance request body, see reflectance
+    """
+    if not isinstance(body, dict):
+        raise APIError('Expected a JSON object body')
+    stacks = parse_stacks(body.get('stacks'))
+    grid = parse_grid(body.get('grid'))
+    if len(stacks) * len(grid) > MAX_VALUES:
+        raise APIError('Request too large: at most {} stacks x wavelengths'
+                       .format(MAX_VALUES))
+    pol = body.get('pol', 's')
+    if pol not in ('s', 'p'):
+        raise APIError('pol must be "s" or "p"')
+    file_format = body.get('format', 'json')
+    if file_format not in ('json', 'npz'):
+        raise APIError('format must be "json" or "npz"')
+    medium = parse_number(body.get('medium', 1.0), 'medium')
+    if medium <= 0:
+        raise APIError('medium must be a positive real index')
+    angle = parse_number(body.get('angle', 0), 'angle')
+    if not 0 <= angle < 90:
+        raise APIError('angle must be at least 0 and below 90 degrees')
+    relative_to_si = body.get('relative_to_si', False)
+    if not isinstance(relative_to_si, bool):
+        raise APIError('relative_to_si must be true or false')
+    return {'stacks': stacks, 'grid': grid, 'medium': medium,
+            'th_0': np.radians(angle), 'pol': pol,
+            'relative_to_si': relative_to_si, 'format': file_format}
+
+
+@api.route('/reflectance', methods=['POST'])
+def reflectance():
+    """
+    Batch reflectance simulation.
+
+    Request body (JSON):
+        stacks: list of {"materials": [...], "thicknesses": [...] (nm),
+                "incoherent": [...] (optional film positions)}
+        medium: real index of the medium on top, > 0 (default 1.0)
+        grid: see parse_grid (default the simulator's SPECTRAL_GRID,
+              250-1499 nm every 1 nm)
+        angle: angle of incidence in degrees, 0 <= angle < 90 (default 0)
+        pol: "s" or "p" (default "s")
+        relative_to_si: true to divide by bare Si like the simulator
+                        (default false)
+        format: "json" (default) or "npz"
+
+    Response: JSON {"wavelength": [...], "r": [[...], ...]} with one row per
+    stack in request order, or for "npz" a NumPy archive with the arrays
+    wavelength and r.
+    """
+    with timed('api.reflectance') as timer:
+        # Deferred so the TMM engine and n,k machinery load on first use
+        # rather than at app start-up
+        from app.spectra import compute_reflectance_many
+        with stage('parse'):
+            args = parse_request(request.get_json(silent=True))
+        grid = args['grid']
+        timer.fields.update(stacks=len(args['stacks']), wavelengths=len(grid))
+
+        try:
+            R = compute_reflectance_many(args['stacks'], args['medium'],
+                                         grid=grid, th_0=args['th_0'],
+                                         pol=args['pol'],
+                                         relative_to_si=args['relative_to_si'])
+        except ValueError as error: # e.g. unknown material, grid outside n,k data
+            raise APIError(str(error))
+        if not np.all(np.isfinite(R)):
+            # NaN/inf can't be sent as JSON; they come from n,k data that
+            # doesn't make physical sense on this grid
+            raise APIError('The reflectance is not finite everywhere on this '
+                           'grid; check the n,k data of the materials')
+
+        with stage('serialize'):
+            if args['format'] == 'npz':
+                buffer = io.BytesIO()
+                np.savez_compressed(buffer, wavelength=grid.wavelengths, r=R)
+                return Response(buffer.getvalue(),
+                                mimetype='application/octet-stream',
+                                headers={'Content-Disposition':
+                                         'attachment; filename=reflectance.npz'})
+            return jsonify({'wavelength': grid.wavelengths.tolist(),
+                            'r': R.tolist()})
@@ -0,0 +1,417 @@
+"""
+Batch reflectance runs from the command line, without the web app.
+
+    python -m app.batch run stacks.yaml -o spectra.npz [--materials nk.csv]
+    python -m app.batch export-materials nk.csv
+
+Stack files are YAML (a list of stacks, or a dict with "stacks" and
+optional "medium", "grid", "angle" and "pol") or CSV (columns materials,
+thicknesses and optionally name and incoherent; list entries separated
+by ";"). Each stack has materials (top to bottom) and thicknesses in nm,
+and sits on Si like the simulator's stacks.
+
+Materials come from an exported library (written by export-materials, a
+CSV with columns material, wavelength, n, k) when given, and from the
+local database otherwise.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+
+from .core_tmm import coh_tmm_spectrum
+from .grids import as_grid, grid_from_dict
+from .spectra import SPECTRAL_GRID, group_reflectance, group_stacks
+from .sweep import SharedSweepResult
+
+LIST_SEP = ';' # between list entries in a CSV cell
+MATERIAL_COLUMNS = ['material', 'wavelength', 'n', 'k']
+
+
+class StackBatch:
+    """
+    The stacks of one batch run and the settings they share.
+
+    input
+    ======
+
+    stacks: list
+        (mat_names, thicknesses, incoherent) tuples, as in
+        spectra.compute_reflectance_many
+    names: list
+        one label per stack
+    medium, grid, th_0, pol:
+        as in spectra.compute_reflectance_many; th_0 in radians
+
+    """
+
+    def __init__(self, stacks, names=None, medium=1.0, grid=None, th_0=0,
+                 pol='s'):
+        self.stacks = stacks
+        self.names = (names if names is not None
+                      else ['stack{}'.format(i) for i in range(len(stacks))])
+        if len(self.names) != len(self.stacks):
+            raise ValueError('Need one name per stack!')
+        self.medium = medium
+        self.grid = SPECTRAL_GRID if grid is None else as_grid(grid)
+        self.th_0 = th_0
+        self.pol = pol
+
+    def materials(self):
+        """
+        Names of all materials the batch needs, including the Si substrate
+        """
+        return sorted({mat for stack in self.stacks for mat in stack[0]}
+                      | {'Si'})
+
+
+def _split(cell, convert=str):
+    if isinstance(cell, float) and np.isnan(cell): # empty CSV cell
+        return []
+    return [convert(item.strip()) for item in str(cell).split(LIST_SEP)
+            if item.strip()]
+
+
+def _stack_tuple(spec, i):
+    try:
+        stack = ([str(mat) for mat in spec['materials']],
+                 [float(d) for d in spec['thicknesses']],
+                 [int(j) for j in spec.get('incoherent') or []])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Stack {} needs materials and numeric thicknesses'
+                         .format(i))
+    if len(stack[0]) != len(stack[1]):
+        raise ValueError('Stack {}: need one thickness per film'.format(i))
+    return stack
+
+
+def load_stacks(path, file_format=None):
+    """
+    Read a YAML or CSV stack file into a StackBatch; the format is taken
+    from the extension unless given.
+    """
+    if file_format is None:
+        file_format = path.rsplit('.', 1)[-1].lower()
+    settings = {}
+    if file_format in ('yaml', 'yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Reading YAML stack files requires pyyaml')
+        with open(path) as f:
+            doc = yaml.safe_load(f)
+        if isinstance(doc, dict):
+            settings = doc
+            specs = doc.get('stacks')
+        else:
+            specs = doc
+        if not isinstance(specs, list):
+            raise ValueError('{} has no list of stacks'.format(path))
+    elif file_format == 'csv':
+        df = pd.read_csv(path, dtype=str)
+        specs = [{'name': row.get('name'),
+                  'materials': _split(row['materials']),
+                  'thicknesses': _split(row['thicknesses'], float),
+                  'incoherent': _split(row.get('incoherent', np.nan), int)}
+                 for row in df.to_dict('records')]
+    else:
+        raise ValueError('Unknown stack file format: {}'.format(file_format))
+
+    stacks = [_stack_tuple(spec, i) for i, spec in enumerate(specs)]
+    names = [str(spec['name']) if spec.get('name') else 'stack{}'.format(i)
+             for i, spec in enumerate(specs)]
+    pol = settings.get('pol', 's')
+    if pol not in ('s', 'p'):
+        raise ValueError('pol must be "s" or "p", not {!r}'.format(pol))
+    grid = settings.get('grid')
+    return StackBatch(stacks, names, medium=float(settings.get('medium', 1.0)),
+                      grid=None if grid is None else grid_from_dict(grid),
+                      th_0=np.radians(float(settings.get('angle', 0))),
+                      pol=pol)
+
+
+def export_materials(path, names=None):
+    """
+    Write n,k of materials in the database (all of them by default) to a
+    material library CSV, wavelengths in nm. Needs the app's database.
+    """
+    from app import create_app
+    from .models import Material
+    from .spectra import get_nkvals
+    with create_app(simulator=False).app_context():
+        if names is None:
+            names = [material.name for material in Material.query.all()]
+        frames = []
+        for name in names:
+            df = get_nkvals(name)
+            frames.append(pd.DataFrame({'material': name,
+                                        'wavelength': df.wavelength,
+                                        'n': df.n, 'k': df.k.fillna(0)}))
+    pd.concat(frames)[MATERIAL_COLUMNS].to_csv(path, index=False)
+    return path
+
+
+def load_material_library(path):
+    """
+    Interpolated n,k per material from a library written by export_materials
+
+    output
+    ======
+
+    dict
+        {name: function of wavelength in nm}, like spectra.material_fn
+
+    """
+    df = pd.read_csv(path)
+    missing = set(MATERIAL_COLUMNS) - set(df.columns)
+    if missing:
+        raise ValueError('Material library is missing columns: {}'
+                         .format(', '.join(sorted(missing))))
+    library = {}
+    for name, mat_df in df.groupby('material', sort=False):
+        mat_df = mat_df.sort_values('wavelength')
+        library[str(name)] = interp1d(mat_df.wavelength.values,
+                                      mat_df.n.values + 1j * mat_df.k.values,
+                                      kind='linear')
+    return library
+
+
+def resolve_materials(names, grid, library=None):
+    """
+    n,k of each material on grid, from library (see load_material_library)
+    where it has the material and from the database otherwise.
+
+    output
+    ======
+
+    dict
+        {name: complex array of len(grid)}
+
+    """
+    library = library or {}
+    nk = {name: np.asarray(library[name](grid.wavelengths), dtype=complex)
+          for name in names if name in library}
+    from_db = [name for name in names if name not in library]
+    if from_db:
+        from app import create_app
+        from .spectra import material_nk
+        with create_app(simulator=False).app_context():
+            for name in from_db:
+                nk[name] = material_nk(name, grid)
+    return nk
+
+
+# Per-process state of run_batch workers, set by _init_worker
+_worker = {}
+
+def _init_worker(groups, lam_vac_list, th_0, pol, shm_name, shape):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker.update(groups=groups, lam_vac_list=lam_vac_list, th_0=th_0,
+                   pol=pol, shm=shm,
+                   r=np.ndarray(shape, dtype=float, buffer=shm.buf))
+
+def _evaluate_tile(tile):
+    group, start, stop = tile
+    n_array, d_array, incoherent, rows = _worker['groups'][group]
+    _worker['r'][rows[start:stop]] = group_reflectance(
+        n_array, d_array[start:stop], incoherent, _worker['lam_vac_list'],
+        _worker['th_0'], _worker['pol'])
+    return stop - start
+
+
+def run_batch(batch, nk, max_workers=None, chunk_size=256,
+              relative_to_si=False):
+    """
+    Reflectances of every stack in a StackBatch.
+
+    Stacks are grouped by structure as in compute_reflectance_many, and
+    each group is cut into tiles of chunk_size stacks. With more than one
+    worker the tiles run on a ProcessPoolExecutor writing into shared
+    memory, like sweep.parallel_sweep.
+
+    input
+    ======
+
+    nk: dict
+        n,k of every material on batch.grid, see resolve_materials
+    max_workers: int
+        worker processes, default os.cpu_count(); 1 runs in this process
+
+    output
+    ======
+
+    numpy array
+        (len(batch.stacks), len(batch.grid)) reflectances, in input order
+
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    lam_vac_list = batch.grid.wavelengths
+    groups = []
+    for (mat_names, incoherent), rows in group_stacks(batch.stacks).items():
+        n_array = np.empty((len(mat_names) + 2, lam_vac_list.size),
+                           dtype=complex)
+        n_array[0] = batch.medium
+        for i, mat in enumerate(list(mat_names) + ['Si']):
+            n_array[i+1] = nk[mat]
+        d_array = np.full((len(rows), len(mat_names) + 2), np.inf)
+        d_array[:, 1:-1] = [batch.stacks[i][1] for i in rows]
+        groups.append((n_array, d_array, incoherent, np.array(rows)))
+    tiles = [(g, start, min(start + chunk_size, len(group[3])))
+             for g, group in enumerate(groups)
+             for start in range(0, len(group[3]), chunk_size)]
+
+    shape = (len(batch.stacks), lam_vac_list.size)
+    if max_workers <= 1 or len(tiles) <= 1:
+        _worker.update(groups=groups, lam_vac_list=lam_vac_list,
+                       th_0=batch.th_0, pol=batch.pol, r=np.empty(shape))
+        try:
+            for tile in tiles:
+                _evaluate_tile(tile)
+            R = _worker['r']
+        finally:
+            _worker.clear()
+    else:
+        with SharedSweepResult(shape) as result:
+            with ProcessPoolExecutor(
+                    max_workers=min(max_workers, len(tiles)),
+                    initializer=_init_worker,
+                    initargs=(groups, lam_vac_list, batch.th_0, batch.pol,
+                              result.shm.name, shape)) as executor:
+                for _ in executor.map(_evaluate_tile, tiles):
+                    pass
+            R = result.r.copy()
+    if relative_to_si:
+        R /= coh_tmm_spectrum(batch.pol, [np.full(lam_vac_list.size,
+                                                  batch.medium, dtype=complex),
+                                          nk['Si']],
+                              [np.inf, np.inf], batch.th_0, lam_vac_list)['R']
+    return R
+
+
+def write_results(batch, R, path, file_format=None):
+    """
+    Write batch results to .npz or Parquet; the format is taken from the
+    extension unless given.
+
+    The .npz holds wavelength, r (stacks x wavelengths), name, materials
+    (";"-joined per stack) and thickness (stacks x most films, padded with
+    NaN). Parquet (needs pyarrow) has one row per stack with columns name,
+    materials, thicknesses and r, and the wavelengths in the schema
+    metadata, like sweep.write_parquet.
+    """
+    if file_format is None:
+        file_format = path.rsplit('.', 1)[-1].lower()
+    if file_format == 'npz':
+        num_films = max([len(stack[1]) for stack in batch.stacks] + [0])
+        thickness = np.full((len(batch.stacks), num_films), np.nan)
+        for i, stack in enumerate(batch.stacks):
+            thickness[i, :len(stack[1])] = stack[1]
+        np.savez_compressed(
+            path, wavelength=batch.grid.wavelengths, r=R,
+            name=np.array(batch.names, dtype=str),
+            materials=np.array([LIST_SEP.join(stack[0])
+                                for stack in batch.stacks], dtype=str),
+            thickness=thickness)
+    elif file_format == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Writing Parquet results requires pyarrow')
+        table = pa.table({
+            'name': batch.names,
+            'materials': [list(stack[0]) for stack in batch.stacks],
+            'thicknesses': [list(stack[1]) for stack in batch.stacks],
+            'r': pa.FixedSizeListArray.from_arrays(
+                pa.array(np.ascontiguousarray(R).ravel()), R.shape[1])})
+        table = table.replace_schema_metadata(
+            {'wavelength': ','.join(repr(float(lam))
+                                    for lam in batch.grid.wavelengths)})
+        pq.write_table(table, path)
+    else:
+        raise ValueError('Unknown result file format: {}'.format(file_format))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m app.batch',
+        description='Batch reflectance simulation without the web app')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='simulate a stack file')
+    run.add_argument('stacks', help='YAML or CSV stack file')
+    run.add_argument('-o', '--output', required=True,
+                     help='result file, .npz or .parquet')
+    run.add_argument('--materials', help='material library CSV; materials '
+                     'not in it are read from the database')
+    run.add_argument('--medium', type=float,
+                     help='index of the medium on top, overrides the file')
+    run.add_argument('--grid', type=float, nargs=3,
+                     metavar=('START', 'STOP', 'STEP'),
+                     help='uniform wavelength grid in nm, overrides the file')
+    run.add_argument('--relative-to-si', action='store_true',
+                     help='divide by bare Si like the simulator')
+    run.add_argument('--workers', type=int, default=None,
+                     help='worker processes (default: all CPUs)')
+    run.add_argument('--chunk-size', type=int, default=256,
+                     help='stacks per task (default: 256)')
+
+    export = commands.add_parser('export-materials',
+                                 help='write the database n,k to a library')
+    export.add_argument('output', help='material library CSV')
+    export.add_argument('names', nargs='*',
+                        help='materials to export (default: all)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export-materials':
+        export_materials(args.output, args.names or None)
+        print('Wrote {}'.format(args.output))
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    # Catch a bad output before spending the run on it
+    file_format = args.output.rsplit('.', 1)[-1].lower()
+    if file_format not in ('npz', 'parquet'):
+        parser.error('output must be .npz or .parquet')
+    if file_format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            parser.error('writing Parquet results requires pyarrow')
+
+    batch = load_stacks(args.stacks)
+    if args.medium is not None:
+        batch.medium = args.medium
+    if args.grid is not None:
+        batch.grid = as_grid(tuple(args.grid))
+    library = load_material_library(args.materials) if args.materials else None
+    nk = resolve_materials(batch.materials(), batch.grid, library)
+
+    start = time.perf_counter()
+    R = run_batch(batch, nk, max_workers=args.workers,
+                  chunk_size=args.chunk_size,
+                  relative_to_si=args.relative_to_si)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    write_results(batch, R, args.output)
+
+    num_stacks, num_wl = R.shape
+    print('{} stacks x {} wavelengths in {:.3f} s: {:.1f} stacks/s, '
+          '{:.3g} wavelengths/s'.format(num_stacks, num_wl, elapsed,
+                                         num_stacks / elapsed,
+                                         num_stacks * num_wl / elapsed))
+    print('Wrote {}'.format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
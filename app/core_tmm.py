@@ -2,15 +2,25 @@ from numpy import cos, inf, zeros, array, exp, conj, nan, isnan, pi, sin
 
 import numpy as np
 from numpy import arange, array
-
-import scipy as sp
+from numpy.lib import scimath
 
 import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from .grids import DEFAULT_GRID, EnergyGrid, as_grid
 
 inf = float('inf')
 
 EPSILON = sys.float_info.epsilon # typical floating-point calculation error
 
+LAM_VAC_LIST = DEFAULT_GRID.wavelengths # default simulation wavelengths, nm
+
+class OpacityWarning(RuntimeWarning):
+    """
+    A layer was so opaque that its phase had to be clamped, see warn_opacity
+    """
+
 def make_2x2_array(a, b, c, d, dtype=float):
     """
     Makes a 2x2 numpy array of [[a,b],[c,d]]
@@ -64,15 +74,31 @@ def is_forward_angle(n, theta):
         assert (n * cos(theta.conjugate())).real < 100 * EPSILON, error_string
     return answer
 
+def is_forward_angle_array(n, theta):
+    """
+    Elementwise version of is_forward_angle for arrays of n and theta (e.g.
+    one entry per wavelength). Returns a boolean array; the consistency
+    checks of is_forward_angle are skipped.
+    """
+    assert np.all(n.real * n.imag >= 0), ("For materials with gain, it's "
+                                          "ambiguous which beam is incoming "
+                                          "vs outgoing. See "
+                                          "https://arxiv.org/abs/1603.02720 "
+                                          "Appendix C.")
+    ncostheta = n * cos(theta)
+    return np.where(abs(ncostheta.imag) > 100 * EPSILON,
+                    ncostheta.imag > 0, ncostheta.real > 0)
+
 def snell(n_1, n_2, th_1):
     """
     return angle theta in layer 2 with refractive index n_2, assuming
     it has angle th_1 in layer with refractive index n_1. Use Snell's law. Note
     that "angles" may be complex!!
     """
-    # Important that the arcsin here is scipy.arcsin, not numpy.arcsin! (They
-    # give different results e.g. for arcsin(2).)
-    th_2_guess = sp.arcsin(n_1*np.sin(th_1) / n_2)
+    # Important that the arcsin here is scimath.arcsin (what scipy.arcsin
+    # used to wrap), not numpy.arcsin! (They give different results e.g. for
+    # arcsin(2).)
+    th_2_guess = scimath.arcsin(n_1*np.sin(th_1) / n_2)
     if is_forward_angle(n_2, th_2_guess):
         return th_2_guess
     else:
@@ -84,9 +110,10 @@ def list_snell(n_list, th_0):
     using Snell's law. n_list is index of refraction of each layer. Note that
     "angles" may be complex!!
     """
-    # Important that the arcsin here is scipy.arcsin, not numpy.arcsin! (They
-    # give different results e.g. for arcsin(2).)
-    angles = sp.arcsin(n_list[0]*np.sin(th_0) / n_list)
+    # Important that the arcsin here is scimath.arcsin (what scipy.arcsin
+    # used to wrap), not numpy.arcsin! (They give different results e.g. for
+    # arcsin(2).)
+    angles = scimath.arcsin(n_list[0]*np.sin(th_0) / n_list)
     # The first and last entry need to be the forward angle (the intermediate
     # layers don't matter, see https://arxiv.org/abs/1603.02720 Section 5)
     if not is_forward_angle(n_list[0], angles[0]):
@@ -95,6 +122,18 @@ def list_snell(n_list, th_0):
         angles[-1] = pi - angles[-1]
     return angles
 
+def list_snell_spectrum(n_array, th_0):
+    """
+    Same as list_snell, but n_array is (num_layers, num_wavelengths) and the
+    returned angles have the same shape.
+    """
+    # scimath.arcsin, not numpy.arcsin, as in list_snell
+    angles = scimath.arcsin(n_array[0]*np.sin(th_0) / n_array)
+    for i in (0, -1):
+        backward = ~is_forward_angle_array(n_array[i], angles[i])
+        angles[i] = np.where(backward, pi - angles[i], angles[i])
+    return angles
+
 
 def interface_r(polarization, n_i, n_f, th_i, th_f):
     """
@@ -184,6 +223,18 @@ def interface_T(polarization, n_i, n_f, th_i, th_f):
     t = interface_t(polarization, n_i, n_f, th_i, th_f)
     return T_from_t(polarization, t, n_i, n_f, th_i, th_f)
 
+def warn_opacity():
+    """
+    Issue an OpacityWarning when a layer's phase is clamped. Goes through the
+    warnings module rather than a module global, so it is safe to call from
+    several threads. How often it is shown is left to the application's
+    warning filters.
+    """
+    warnings.warn("Layers that are almost perfectly opaque "
+                  "are modified to be slightly transmissive, "
+                  "allowing 1 photon in 10^30 to pass through. It's "
+                  "for numerical stability.", OpacityWarning, stacklevel=3)
+
 def coh_tmm(pol, n_list, d_list, th_0, lam_vac):
     """
     Main "coherent transfer matrix method" calc. Given parameters of a stack,
@@ -225,7 +276,9 @@ def coh_tmm(pol, n_list, d_list, th_0, lam_vac):
     if ((hasattr(lam_vac, 'size') and lam_vac.size > 1)
           or (hasattr(th_0, 'size') and th_0.size > 1)):
         raise ValueError('This function is not vectorized; you need to run one '
-                         'calculation at a time (1 wavelength, 1 angle, etc.)')
+                         'calculation at a time (1 wavelength, 1 angle, etc.). '
+                         'See coh_tmm_spectrum and coh_tmm_sp for spectra '
+                         'and angle sweeps.')
     if (n_list.ndim != 1) or (d_list.ndim != 1) or (n_list.size != d_list.size):
         raise ValueError("Problem with n_list or d_list!")
     assert d_list[0] == d_list[-1] == inf, 'd_list must start and end with inf!'
@@ -244,9 +297,9 @@ def coh_tmm(pol, n_list, d_list, th_0, lam_vac):
 
     # delta is the total phase accrued by traveling through a given layer.
     # Ignore warning about inf multiplication
-    olderr = sp.seterr(invalid='ignore')
-    delta = kz_list * d_list
-    sp.seterr(**olderr)
+    # (errstate is local to this thread, unlike seterr)
+    with np.errstate(invalid='ignore'):
+        delta = kz_list * d_list
 
     # For a very opaque layer, reset delta to avoid divide-by-0 and similar
     # errors. The criterion imag(delta) > 35 corresponds to single-pass
@@ -255,14 +308,7 @@ def coh_tmm(pol, n_list, d_list, th_0, lam_vac):
     for i in range(1, num_layers-1):
         if delta[i].imag > 35:
             delta[i] = delta[i].real + 35j
-            if 'opacity_warning' not in globals():
-                global opacity_warning
-                opacity_warning = True
-                print("Warning: Layers that are almost perfectly opaque "
-                      "are modified to be slightly transmissive, "
-                      "allowing 1 photon in 10^30 to pass through. It's "
-                      "for numerical stability. This warning will not "
-                      "be shown again.")
+            warn_opacity()
 
     # t_list[i,j] and r_list[i,j] are transmission and reflection amplitudes,
     # respectively, coming from i, going to j. Only need to calculate this when
@@ -298,51 +344,428 @@ def coh_tmm(pol, n_list, d_list, th_0, lam_vac):
 
     # vw_list[n] = [v_n, w_n]. v_0 and w_0 are undefined because the 0th medium
     # has no left interface.
-    # vw_list = zeros((num_layers, 2), dtype=complex)
-    # vw = array([[t],[0]])
-    # vw_list[-1,:] = np.transpose(vw)
-    # for i in range(num_layers-2, 0, -1):
-    #     vw = np.dot(M_list[i], vw)
-    #     vw_list[i,:] = np.transpose(vw)
+    vw_list = zeros((num_layers, 2), dtype=complex)
+    vw = array([[t],[0]])
+    vw_list[-1,:] = np.transpose(vw)
+    for i in range(num_layers-2, 0, -1):
+        vw = np.dot(M_list[i], vw)
+        vw_list[i,:] = np.transpose(vw)
 
     # Net transmitted and reflected power, as a proportion of the incoming light
     # power.
     R = R_from_r(r)
-    # T = T_from_t(pol, t, n_list[0], n_list[-1], th_0, th_list[-1])
-    # power_entering = power_entering_from_r(pol, r, n_list[0], th_0)
+    T = T_from_t(pol, t, n_list[0], n_list[-1], th_0, th_list[-1])
+    power_entering = power_entering_from_r(pol, r, n_list[0], th_0)
+
+    return {'r': r, 't': t, 'R': R, 'T': T, 'power_entering': power_entering,
+            'vw_list': vw_list, 'kz_list': kz_list, 'th_list': th_list,
+            'pol': pol, 'n_list': n_list, 'd_list': d_list, 'th_0': th_0,
+            'lam_vac':lam_vac}
+
+def coh_tmm_spectrum(pol, n_array, d_list, th_0, lam_vac_list, jacobian=False):
+    """
+    Vectorized coh_tmm: runs the whole spectrum at once instead of one
+    wavelength per call.
+    n_array is (num_layers, num_wavelengths): n_array[:, j] is the n_list
+    at wavelength lam_vac_list[j]. pol and d_list are as in coh_tmm; th_0 is
+    a single angle or one angle per wavelength.
+    If jacobian is True, the derivatives of R with respect to each layer
+    thickness are computed in the same pass from prefix and suffix products
+    of the transfer matrices, so they cost about one extra matrix product
+    per layer instead of one extra TMM run per layer.
+    Outputs the following as a dictionary, each array having one entry per
+    wavelength:
+    * r, t, R, T, power_entering--as in coh_tmm
+    * kz_list, th_list--(num_layers, num_wavelengths) arrays, as in coh_tmm
+    * dR_dd--only if jacobian is True. (num_layers, num_wavelengths) array,
+      dR_dd[i] is the derivative of R with respect to d_list[i] (in inverse
+      units of d_list). Rows for the semi-infinite media are zero.
+    * pol, n_list, d_list, th_0, lam_vac--same as input
+    """
+    n_array = np.asarray(n_array, dtype=complex)
+    d_list = array(d_list, dtype=float)
+    lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+
+    # Input tests
+    if lam_vac_list.ndim != 1 or np.ndim(th_0) > 1 or (
+            np.ndim(th_0) == 1 and np.size(th_0) != lam_vac_list.size):
+        raise ValueError('lam_vac_list must be 1D and th_0 a single angle '
+                         'or one angle per wavelength')
+    if ((n_array.ndim != 2) or (d_list.ndim != 1)
+            or (n_array.shape != (d_list.size, lam_vac_list.size))):
+        raise ValueError("Problem with n_array or d_list!")
+    assert d_list[0] == d_list[-1] == inf, 'd_list must start and end with inf!'
+    assert np.all(abs((n_array[0]*np.sin(th_0)).imag) < 100*EPSILON), \
+        'Error in n0 or th0!'
+    num_layers = d_list.size
+
+    th_list = list_snell_spectrum(n_array, th_0)
+    kz_list = 2 * np.pi * n_array * cos(th_list) / lam_vac_list
+
+    # Phase through the finite layers only, so the infs never enter the math.
+    # Same opacity clamp as coh_tmm.
+    delta = kz_list[1:-1] * d_list[1:-1, None]
+    opaque = delta.imag > 35
+    if opaque.any():
+        delta = np.where(opaque, delta.real + 35j, delta)
+        warn_opacity()
+
+    # Interface i is between layer i and layer i+1
+    r_list = interface_r(pol, n_array[:-1], n_array[1:],
+                         th_list[:-1], th_list[1:])
+    t_list = interface_t(pol, n_array[:-1], n_array[1:],
+                         th_list[:-1], th_list[1:])
+
+    # M_list[i-1] is the (num_wavelengths, 2, 2) stack of coh_tmm's M_i
+    num_wl = lam_vac_list.size
+    M_list = np.empty((num_layers - 2, num_wl, 2, 2), dtype=complex)
+    fwd = exp(-1j * delta) / t_list[1:]
+    bwd = exp(1j * delta) / t_list[1:]
+    M_list[:, :, 0, 0] = fwd
+    M_list[:, :, 0, 1] = fwd * r_list[1:]
+    M_list[:, :, 1, 0] = bwd * r_list[1:]
+    M_list[:, :, 1, 1] = bwd
+
+    # prefix[i] = A_0 M_1 ... M_i, where A_0 is the first interface
+    prefix = np.empty((num_layers - 1, num_wl, 2, 2), dtype=complex)
+    prefix[0, :, 0, 0] = prefix[0, :, 1, 1] = 1 / t_list[0]
+    prefix[0, :, 0, 1] = prefix[0, :, 1, 0] = r_list[0] / t_list[0]
+    for i in range(1, num_layers - 1):
+        prefix[i] = np.matmul(prefix[i-1], M_list[i-1])
+    Mtilde = prefix[-1]
+
+    r = Mtilde[:, 1, 0] / Mtilde[:, 0, 0]
+    t = 1 / Mtilde[:, 0, 0]
+    R = R_from_r(r)
+    T = T_from_t(pol, t, n_array[0], n_array[-1], th_0, th_list[-1])
+    power_entering = power_entering_from_r(pol, r, n_array[0], th_0)
+
+    ans = {'r': r, 't': t, 'R': R, 'T': T, 'power_entering': power_entering,
+           'kz_list': kz_list, 'th_list': th_list,
+           'pol': pol, 'n_list': n_array, 'd_list': d_list, 'th_0': th_0,
+           'lam_vac': lam_vac_list}
+
+    if jacobian:
+        # Only the first column of Mtilde enters r, so carry the suffix
+        # products as column vectors: col = M_i ... M_last [1, 0]^T
+        dR_dd = zeros((num_layers, num_wl))
+        col = zeros((num_wl, 2), dtype=complex)
+        col[:, 0] = 1
+        for i in range(num_layers - 2, 0, -1):
+            # dM_i/dd_i = diag(-1j kz, 1j kz) M_i, constant where clamped
+            Mcol = np.einsum('wij,wj->wi', M_list[i-1], col)
+            ikz = np.where(opaque[i-1], 0, 1j * kz_list[i])
+            dcol = np.einsum('wij,wj->wi', prefix[i-1],
+                             Mcol * np.stack((-ikz, ikz), axis=-1))
+            dr = ((dcol[:, 1] * Mtilde[:, 0, 0] - Mtilde[:, 1, 0] * dcol[:, 0])
+                  / Mtilde[:, 0, 0]**2)
+            dR_dd[i] = 2 * (conj(r) * dr).real
+            col = Mcol
+        ans['dR_dd'] = dR_dd
+
+    return ans
+
+def coh_tmm_spectrum_reverse(pol, n_array, d_list, th_0, lam_vac_list):
+    """
+    Reverses the order of the stack then runs coh_tmm_spectrum.
+    """
+    th_f = scimath.arcsin(n_array[0]*np.sin(th_0) / n_array[-1])
+    th_f = np.where(is_forward_angle_array(n_array[-1], th_f), th_f, pi - th_f)
+    return coh_tmm_spectrum(pol, n_array[::-1], array(d_list)[::-1], th_f,
+                            lam_vac_list)
+
+def coh_tmm_spectrum_threaded(pol, n_array, d_list, th_0, lam_vac_list,
+                              jacobian=False, chunk_size=256, max_workers=None):
+    """
+    coh_tmm_spectrum with the wavelengths split into chunks of chunk_size
+    and evaluated on a thread pool. NumPy releases the GIL inside the array
+    math, so chunks run in parallel even inside a threaded web server, and
+    the kernel touches no global state. Same inputs and outputs as
+    coh_tmm_spectrum.
+    """
+    lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+    n_array = np.asarray(n_array, dtype=complex)
+    bounds = [(i, min(i + chunk_size, lam_vac_list.size))
+              for i in range(0, lam_vac_list.size, chunk_size)]
+    if len(bounds) < 2:
+        return coh_tmm_spectrum(pol, n_array, d_list, th_0, lam_vac_list,
+                                jacobian=jacobian)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        parts = list(executor.map(
+            lambda b: coh_tmm_spectrum(pol, n_array[:, b[0]:b[1]], d_list,
+                                       th_0, lam_vac_list[b[0]:b[1]],
+                                       jacobian=jacobian), bounds))
+    ans = dict(parts[0])
+    for key in ('r', 't', 'R', 'T', 'power_entering', 'kz_list', 'th_list',
+                'n_list', 'lam_vac', 'dR_dd'):
+        if key in ans:
+            ans[key] = np.concatenate([part[key] for part in parts], axis=-1)
+    return ans
+
+
+def coh_tmm_batch(pol, n_array, d_array, th_0, lam_vac_list):
+    """
+    Reflected power of the same stack at many sets of layer thicknesses.
+    n_array, th_0 and lam_vac_list are as in coh_tmm_spectrum; d_array is
+    (num_stacks, num_layers), each row a d_list. Angles, wavenumbers and
+    interface coefficients don't depend on thickness, so they're computed
+    once for the whole batch.
+    Returns R as a (num_stacks, num_wavelengths) array.
+    """
+    n_array = np.asarray(n_array, dtype=complex)
+    d_array = np.atleast_2d(np.asarray(d_array, dtype=float))
+    lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+    if ((n_array.ndim != 2) or (d_array.ndim != 2)
+            or (n_array.shape != (d_array.shape[1], lam_vac_list.size))):
+        raise ValueError("Problem with n_array or d_array!")
+    if not (np.all(d_array[:, 0] == inf) and np.all(d_array[:, -1] == inf)):
+        raise ValueError('Each d_list must start and end with inf!')
+    num_layers = d_array.shape[1]
+
+    th_list = list_snell_spectrum(n_array, th_0)
+    kz_list = 2 * np.pi * n_array * cos(th_list) / lam_vac_list
+    r_list = interface_r(pol, n_array[:-1], n_array[1:],
+                         th_list[:-1], th_list[1:])
+
+    # Only the first column of Mtilde is needed for r, so multiply the
+    # transfer matrices onto [v, w] = [1, 0] from the back of the stack.
+    v = np.ones((d_array.shape[0], lam_vac_list.size), dtype=complex)
+    w = np.zeros_like(v)
+    for i in range(num_layers - 2, 0, -1):
+        delta = kz_list[i] * d_array[:, i, None]
+        opaque = delta.imag > 35
+        if opaque.any():
+            delta = np.where(opaque, delta.real + 35j, delta)
+            warn_opacity()
+        # One complex exp per element: exp(-1j delta) = 1 / exp(1j delta)
+        bwd = exp(1j * delta)
+        fwd = 1 / bwd
+        v, w = fwd * (v + r_list[i] * w), bwd * (r_list[i] * v + w)
+    # The 1/t factors only rescale v and w together, which cancels in r
+    r = (r_list[0] * v + w) / (v + r_list[0] * w)
+    return R_from_r(r)
+
+def coh_tmm_sp(n_array, d_list, th_0, lam_vac_list):
+    """
+    Both polarizations of coh_tmm_spectrum in one pass. Snell angles,
+    wavenumbers and phase factors don't depend on polarization, so they are
+    computed once and the s and p interface coefficients are propagated
+    through the stack side by side.
+    n_array, d_list and lam_vac_list are as in coh_tmm_spectrum. th_0 is a
+    single angle or an array of angles; every output has shape
+    th_0.shape + (num_wavelengths,), so a 1D th_0 gives an
+    (angles, wavelengths) map.
+    Outputs the following as a dictionary:
+    * rs, rp, ts, tp--reflection and transmission amplitudes
+    * Rs, Rp, Ts, Tp--reflected and transmitted power
+    * R, T--unpolarized, as in unpolarized_RT
+    * psi, Delta--ellipsometric parameters, as in ellips
+    * th_0, lam_vac--same as input
+    """
+    n_array = np.asarray(n_array, dtype=complex)
+    d_list = array(d_list, dtype=float)
+    lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+    th_0 = np.asarray(th_0)
+
+    # Input tests
+    if ((n_array.ndim != 2) or (d_list.ndim != 1) or (lam_vac_list.ndim != 1)
+            or (n_array.shape != (d_list.size, lam_vac_list.size))):
+        raise ValueError("Problem with n_array or d_list!")
+    if (d_list[0] != inf) or (d_list[-1] != inf):
+        raise ValueError('d_list must start and end with inf!')
+    num_layers = d_list.size
+
+    # Angles first, then layers, then wavelengths
+    th = th_0.reshape(-1, 1, 1)
+    if np.any(abs((n_array[0]*np.sin(th)).imag) >= 100*EPSILON):
+        raise ValueError('Error in n0 or th0!')
+    th_list = scimath.arcsin(n_array[0]*np.sin(th) / n_array)
+    for i in (0, -1):
+        backward = ~is_forward_angle_array(n_array[i], th_list[:, i])
+        th_list[:, i] = np.where(backward, pi - th_list[:, i], th_list[:, i])
+    cos_th = cos(th_list)
+    kz_list = 2 * np.pi * n_array * cos_th / lam_vac_list
+
+    # Shared Fresnel terms; axis 0 of r_list and t_list is (s, p)
+    n_i, n_f = n_array[:-1], n_array[1:]
+    cos_i, cos_f = cos_th[:, :-1], cos_th[:, 1:]
+    s_i, s_f = n_i * cos_i, n_f * cos_f
+    p_i, p_f = n_f * cos_i, n_i * cos_f
+    r_list = np.stack(((s_i - s_f) / (s_i + s_f), (p_i - p_f) / (p_i + p_f)))
+    t_list = np.stack((2 * s_i / (s_i + s_f), 2 * s_i / (p_i + p_f)))
+
+    delta = kz_list[:, 1:-1] * d_list[1:-1, None]
+    opaque = delta.imag > 35
+    if opaque.any():
+        delta = np.where(opaque, delta.real + 35j, delta)
+        warn_opacity()
+    bwd_list = exp(1j * delta)
+
+    # First column of Mtilde, as in coh_tmm_batch, for both polarizations
+    v = np.ones((2,) + th_list[:, 0].shape, dtype=complex)
+    w = np.zeros_like(v)
+    for i in range(num_layers - 2, 0, -1):
+        bwd = bwd_list[:, i-1]
+        v, w = ((v + r_list[:, :, i] * w) / bwd,
+                bwd * (r_list[:, :, i] * v + w))
+    Mtilde_00 = v + r_list[:, :, 0] * w
+    r = (r_list[:, :, 0] * v + w) / Mtilde_00
+    t = np.prod(t_list, axis=2) / Mtilde_00
+
+    R = R_from_r(r)
+    Ts = T_from_t('s', t[0], n_array[0], n_array[-1], th_list[:, 0],
+                  th_list[:, -1])
+    Tp = T_from_t('p', t[1], n_array[0], n_array[-1], th_list[:, 0],
+                  th_list[:, -1])
+    shape = th_0.shape + (lam_vac_list.size,)
+    ans = {'rs': r[0], 'rp': r[1], 'ts': t[0], 'tp': t[1],
+           'Rs': R[0], 'Rp': R[1], 'Ts': Ts, 'Tp': Tp,
+           'R': (R[0] + R[1]) / 2., 'T': (Ts + Tp) / 2.,
+           'psi': np.arctan(abs(r[1] / r[0])),
+           'Delta': np.angle(-r[1] / r[0])}
+    for key in ans:
+        ans[key] = ans[key].reshape(shape)
+    ans['th_0'] = th_0
+    ans['lam_vac'] = lam_vac_list
+    return ans
 
-    # return {'r': r, 't': t, 'R': R, 'T': T, 'power_entering': power_entering,
-    #         'vw_list': vw_list, 'kz_list': kz_list, 'th_list': th_list,
-    #         'pol': pol, 'n_list': n_list, 'd_list': d_list, 'th_0': th_0,
-    #         'lam_vac':lam_vac}
-    return {'R': R}
+def coh_tmm_na(n_array, d_list, na, lam_vac_list, num_angles=12, na_min=0,
+               pupil='aplanatic'):
+    """
+    R and T of a stack illuminated through an objective of numerical
+    aperture na, averaged over the cone of incidence angles.
+    n_array, d_list and lam_vac_list are as in coh_tmm_spectrum; the
+    incident medium (n_array[0]) must be real and the same at every
+    wavelength, since na fixes the angles in it. na_min > 0 gives an annular
+    (e.g. centrally obscured) pupil.
+    The cone is integrated with num_angles-point Gauss-Legendre quadrature,
+    all angles evaluated together in one coh_tmm_sp pass. pupil sets how
+    the angles are weighted:
+    * 'aplanatic'--uniformly filled pupil of an objective obeying the sine
+      condition, weight sin(th)cos(th); uniform in sin(th)^2
+    * 'uniform'--equal power per solid angle, weight sin(th); uniform in
+      cos(th)
+    Averaging over the azimuth mixes s and p equally, whatever the input
+    polarization.
+    Outputs the following as a dictionary:
+    * R, T, Rs, Rp, Ts, Tp--cone-averaged, (num_wavelengths,) arrays
+    * angles, weights--the quadrature nodes (in radians) and their weights,
+      which sum to 1
+    * lam_vac--same as input
+    """
+    n_array = np.asarray(n_array, dtype=complex)
+    n_0 = n_array[0]
+    if np.any(n_0 != n_0[0]) or n_0[0].imag != 0:
+        raise ValueError('NA averaging needs a real, non-dispersive '
+                         'incident medium!')
+    n_0 = n_0[0].real
+    if not 0 <= na_min < na <= n_0:
+        raise ValueError('Need 0 <= na_min < na <= n of the incident medium!')
+
+    sin_min, sin_max = na_min / n_0, na / n_0
+    x, w = np.polynomial.legendre.leggauss(num_angles)
+    if pupil == 'aplanatic':
+        lo, hi = sin_min**2, sin_max**2
+        angles = np.arcsin(np.sqrt(lo + (hi - lo) * (x + 1) / 2))
+    elif pupil == 'uniform':
+        lo, hi = np.sqrt(1 - sin_max**2), np.sqrt(1 - sin_min**2)
+        angles = np.arccos(lo + (hi - lo) * (x + 1) / 2)
+    else:
+        raise ValueError("pupil must be 'aplanatic' or 'uniform'")
+    weights = w / w.sum()
+
+    data = coh_tmm_sp(n_array, d_list, angles, lam_vac_list)
+    ans = {key: np.dot(weights, data[key])
+           for key in ('R', 'T', 'Rs', 'Rp', 'Ts', 'Tp')}
+    ans['angles'] = angles
+    ans['weights'] = weights
+    ans['lam_vac'] = data['lam_vac']
+    return ans
 
 
-def calc_reflectances(n_fn_list, d_list, th_0, pol='s', spectral_range='narrow'):
+def adaptive_spectrum(R_fn, lam_min, lam_max, tol=1e-3, max_points=2000,
+                      num_initial=65, min_step=0.01):
+    """
+    Sample a spectrum densely only where it needs it.
+    R_fn maps an array of wavelengths (nm) to an array of values, e.g.
+    CompiledStack(...).reflectance. Sampling starts from num_initial points
+    evenly spaced in photon energy between lam_min and lam_max (fringes are
+    evenly spaced in 1/wavelength, so this keeps the first pass from
+    aliasing the blue end first). Each point's error estimate is its
+    distance from the straight line through its two neighbours; intervals
+    next to a point whose estimate exceeds tol get their midpoint added.
+    All new midpoints of a round are evaluated in one R_fn call, largest
+    errors first if the round would exceed max_points. Intervals narrower
+    than min_step nm are never split.
+    Returns (lam, R, converged): the sorted sample wavelengths, the values
+    there, and whether every estimate ended within tol.
+    """
+    lam = EnergyGrid(lam_min, lam_max, num_initial).wavelengths.copy()
+    R = np.asarray(R_fn(lam), dtype=float)
+    while True:
+        # Error of linear interpolation at each interior point...
+        frac = (lam[1:-1] - lam[:-2]) / (lam[2:] - lam[:-2])
+        point_err = abs(R[1:-1] - (R[:-2] + frac * (R[2:] - R[:-2])))
+        # ...charged to the intervals on either side of it
+        interval_err = zeros(lam.size - 1)
+        interval_err[:-1] = point_err
+        interval_err[1:] = np.maximum(interval_err[1:], point_err)
+        interval_err[np.diff(lam) < 2 * min_step] = 0
+        refine = np.flatnonzero(interval_err > tol)
+        if refine.size == 0:
+            return lam, R, True
+        budget = max_points - lam.size
+        if budget <= 0:
+            return lam, R, False
+        if refine.size > budget:
+            refine = refine[np.argsort(interval_err[refine])[::-1][:budget]]
+        new_lam = (lam[refine] + lam[refine + 1]) / 2
+        new_R = np.asarray(R_fn(new_lam), dtype=float)
+        lam = np.concatenate((lam, new_lam))
+        R = np.concatenate((R, new_R))
+        order = np.argsort(lam)
+        lam, R = lam[order], R[order]
+
+def calc_reflectances(n_fn_list, d_list, th_0, pol='s', spectral_range='narrow',
+                      c_list=None, grid=None, tol=None, max_points=2000,
+                      display_grid=None):
     """
     Calculate the reflection spectrum of a thin-film stack.
     n_fn_list[m] should be a function that inputs wavelength in nm and
     outputs refractive index of the m'th layer. In other words,
     n_fn_list[2](456) == 1.53 + 0.4j mans that layer #2 has a refractive index
     of 1.53 + 0.4j at 456nm. These functions could be defined with
-    scipy.interpolate.interp1d() for example.
+    scipy.interpolate.interp1d() for example. Each function is called once,
+    with the whole array of wavelengths; a function may also return a
+    single number for a constant index.
     pol, d_list and th_0 are defined as in tmm.coh_tmm ... but d_list
     MUST be in units of nanometers
     spectral_range can be 'full' if all the functions in n_fn_list can take
-    wavelength arguments between 360-830nm; or 'narrow' if some or all require
-    arguments only in the range 400-700nm. The wavelengths outside the
-    'narrow' range make only a tiny difference to the color, because they are
-    almost invisible to the eye. If spectral_range is 'narrow', then the n(400)
-    values are used for 360-400 and n(700) for 700-830nm
+    any wavelength of the grid; or 'narrow' if some or all require
+    arguments only in the range 400-700nm. If spectral_range is 'narrow',
+    then the n(400) values are used below 400nm and n(700) above 700nm.
+    spectral_range may also be a (start, stop) or (start, stop, step) tuple
+    in nm, meaning 'full' on that uniform grid.
+    grid is where the spectrum is computed: a grids.WavelengthGrid, an array
+    of wavelengths, or anything grids.as_grid accepts. It defaults to the
+    spectral_range tuple if one is given, otherwise to grids.DEFAULT_GRID
+    (250-1499nm every 1nm). Only the grid points are computed.
+    c_list, if given, marks layers 'i' (incoherent, e.g. a thick glass or
+    wafer layer) or 'c' (coherent) as in inc_tmm.
+    If tol is given, the spectrum is instead sampled adaptively between the
+    first and last grid wavelengths (see adaptive_spectrum): points are
+    added where linear interpolation between neighbours would be off by
+    more than tol in R, up to max_points in total.
     Returns a 2-column array where the first column is wavelength in nm
-    (360,361,362,...,830) and the second column is reflectivity (from 0
-    to 1, where 1 is a perfect mirror). This range is chosen to be
-    consistent with colorpy.illuminants. See  colorpy.ciexyz.start_wl_nm etc.
+    and the second column is reflectivity (from 0 to 1, where 1 is a
+    perfect mirror). In adaptive mode the wavelengths are the non-uniform
+    samples, and if display_grid is also given the return value is
+    (samples, resampled), resampled being the same 2-column layout linearly
+    interpolated onto display_grid.
     """
-
-    lam_vac_list = arange(250, 1500)
-
-    num_layers = len(n_fn_list)
+    if grid is None and isinstance(spectral_range, tuple):
+        grid = spectral_range
+    lam_vac_list = as_grid(grid).wavelengths
 
     def extend_spectral_range(n_fn):
         """
@@ -351,26 +774,31 @@ def calc_reflectances(n_fn_list, d_list, th_0, pol='s', spectral_range='narrow')
         refractive index function
         """
         def extended_n_fn(lam):
-            if lam < 400:
-                return n_fn(400)
-            elif lam > 700:
-                return n_fn(700)
-            else:
-                return n_fn(lam)
+            return n_fn(np.clip(lam, 400, 700))
         return extended_n_fn
 
     if spectral_range == 'narrow':
-        n_fn_list = [extend_spectral_range(n_fn) for n_fn in n_fn_list]
-
-    final_answer = []
-
-    for lam_vac in lam_vac_list:
-        n_list = [n_fn_list[i](lam_vac) for i in range(num_layers)]
-        R = coh_tmm(pol, n_list, d_list, th_0, lam_vac)['R']
-        final_answer.append([lam_vac,R])
-    final_answer = array(final_answer)
-
-    return final_answer
+        # One wrapper per distinct function, so layers sharing a material
+        # still share it inside CompiledStack
+        extended = {}
+        for n_fn in n_fn_list:
+            if id(n_fn) not in extended:
+                extended[id(n_fn)] = extend_spectral_range(n_fn)
+        n_fn_list = [extended[id(n_fn)] for n_fn in n_fn_list]
+
+    stack = CompiledStack(n_fn_list, d_list, c_list=c_list, th_0=th_0, pol=pol)
+    if tol is None:
+        R = stack.reflectance(lam_vac_list)
+        return np.column_stack((lam_vac_list, R))
+
+    lam, R, _ = adaptive_spectrum(stack.reflectance, lam_vac_list[0],
+                                  lam_vac_list[-1], tol=tol,
+                                  max_points=max_points)
+    final_answer = np.column_stack((lam, R))
+    if display_grid is None:
+        return final_answer
+    display = as_grid(display_grid).wavelengths
+    return final_answer, np.column_stack((display, np.interp(display, lam, R)))
 
 
 def coh_tmm_reverse(pol, n_list, d_list, th_0, lam_vac):
@@ -384,24 +812,18 @@ def ellips(n_list, d_list, th_0, lam_vac):
     """
     Calculates ellipsometric parameters, in radians.
     Warning: Conventions differ. You may need to subtract pi/2 or whatever.
+    For whole spectra or several angles at once, use coh_tmm_sp.
     """
-
-    s_data = coh_tmm('s', n_list, d_list, th_0, lam_vac)
-    p_data = coh_tmm('p', n_list, d_list, th_0, lam_vac)
-    rs = s_data['r']
-    rp = p_data['r']
-    return {'psi': np.arctan(abs(rp/rs)), 'Delta': np.angle(-rp/rs)}
+    data = coh_tmm_sp(array(n_list)[:, None], d_list, th_0, [lam_vac])
+    return {'psi': data['psi'][0], 'Delta': data['Delta'][0]}
 
 def unpolarized_RT(n_list, d_list, th_0, lam_vac):
     """
     Calculates reflected and transmitted power for unpolarized light.
+    For whole spectra or several angles at once, use coh_tmm_sp.
     """
-
-    s_data = coh_tmm('s', n_list, d_list, th_0, lam_vac)
-    p_data = coh_tmm('p', n_list, d_list, th_0, lam_vac)
-    R = (s_data['R'] + p_data['R']) / 2.
-    T = (s_data['T'] + p_data['T']) / 2.
-    return {'R': R, 'T': T}
+    data = coh_tmm_sp(array(n_list)[:, None], d_list, th_0, [lam_vac])
+    return {'R': data['R'][0], 'T': data['T'][0]}
 
 def position_resolved(layer, distance, coh_tmm_data):
     """
@@ -463,6 +885,101 @@ def position_resolved(layer, distance, coh_tmm_data):
 
     return {'poyn': poyn, 'absor': absor, 'Ex': Ex, 'Ey': Ey, 'Ez': Ez}
 
+def vw_list_spectrum(coh_tmm_data):
+    """
+    Starting with output of coh_tmm_spectrum(), calculate the forward and
+    backward amplitudes [v, w] at the start of each layer, as vw_list in
+    coh_tmm. Returns a (num_layers, 2, num_wavelengths) array; row 0 is nan
+    as in coh_tmm.
+    Kept out of coh_tmm_spectrum itself so that spectra and fits, which
+    only need r, don't pay for it.
+    """
+    pol = coh_tmm_data['pol']
+    n_array = coh_tmm_data['n_list']
+    d_list = coh_tmm_data['d_list']
+    th_list = coh_tmm_data['th_list']
+    kz_list = coh_tmm_data['kz_list']
+    num_layers = d_list.size
+
+    delta = kz_list[1:-1] * d_list[1:-1, None]
+    delta = np.where(delta.imag > 35, delta.real + 35j, delta)
+    r_list = interface_r(pol, n_array[:-1], n_array[1:],
+                         th_list[:-1], th_list[1:])
+    t_list = interface_t(pol, n_array[:-1], n_array[1:],
+                         th_list[:-1], th_list[1:])
+
+    vw_list = zeros((num_layers, 2, n_array.shape[1]), dtype=complex)
+    vw_list[0] = nan
+    v, w = coh_tmm_data['t'], zeros(n_array.shape[1], dtype=complex)
+    vw_list[-1, 0] = v
+    vw_list[-1, 1] = w
+    for i in range(num_layers - 2, 0, -1):
+        fwd = exp(-1j * delta[i-1]) / t_list[i]
+        bwd = exp(1j * delta[i-1]) / t_list[i]
+        v, w = fwd * (v + r_list[i] * w), bwd * (r_list[i] * v + w)
+        vw_list[i, 0] = v
+        vw_list[i, 1] = w
+    return vw_list
+
+def position_resolved_spectrum(distances, coh_tmm_data):
+    """
+    Vectorized position_resolved: starting with output of
+    coh_tmm_spectrum(), calculate the Poynting vector, absorbed energy
+    density, and E-field at every distance for every wavelength at once.
+    distances is a 1D array measured from the start of layer 1, as in
+    find_in_structure_with_inf; negative distances are in layer 0. Layers
+    are located with one searchsorted over layer_starts(d_list) rather than
+    a walk through the stack for each point.
+    Returns a dictionary containing (num_distances, num_wavelengths) maps of
+    poyn, absor, Ex, Ey and Ez, defined as in position_resolved, plus
+    * layer, z - (num_distances,) arrays locating each distance, as
+      find_in_structure_with_inf would
+    """
+    distances = np.asarray(distances, dtype=float)
+    if distances.ndim != 1:
+        raise ValueError('distances must be 1D')
+    d_list = coh_tmm_data['d_list']
+    starts = layer_starts(d_list)
+    layer = np.searchsorted(starts, distances, side='right') - 1
+    z = np.where(layer == 0, distances, distances - starts[layer])
+
+    vw_list = vw_list_spectrum(coh_tmm_data)
+    vw_list[0, 0] = 1
+    vw_list[0, 1] = coh_tmm_data['r']
+    v = vw_list[layer, 0]
+    w = vw_list[layer, 1]
+    kz = coh_tmm_data['kz_list'][layer]
+    th = coh_tmm_data['th_list'][layer]
+    n = coh_tmm_data['n_list'][layer]
+    n_0 = coh_tmm_data['n_list'][0]
+    th_0 = coh_tmm_data['th_0']
+    pol = coh_tmm_data['pol']
+
+    # Amplitude of forward-moving wave is Ef, backwards is Eb
+    Ef = v * exp(1j * kz * z[:, None])
+    Eb = w * exp(-1j * kz * z[:, None])
+
+    if pol == 's':
+        poyn = ((n*cos(th)*conj(Ef+Eb)*(Ef-Eb)).real) / (n_0*cos(th_0)).real
+        absor = (n*cos(th)*kz*abs(Ef+Eb)**2).imag / (n_0*cos(th_0)).real
+        Ex = zeros(Ef.shape, dtype=complex)
+        Ey = Ef + Eb
+        Ez = zeros(Ef.shape, dtype=complex)
+    elif pol == 'p':
+        poyn = (((n*conj(cos(th))*(Ef+Eb)*conj(Ef-Eb)).real)
+                    / (n_0*conj(cos(th_0))).real)
+        absor = (n*conj(cos(th))*
+                 (kz*abs(Ef-Eb)**2-conj(kz)*abs(Ef+Eb)**2)
+                ).imag / (n_0*conj(cos(th_0))).real
+        Ex = (Ef - Eb) * cos(th)
+        Ey = zeros(Ef.shape, dtype=complex)
+        Ez = (-Ef - Eb) * sin(th)
+    else:
+        raise ValueError("Polarization must be 's' or 'p'")
+
+    return {'poyn': poyn, 'absor': absor, 'Ex': Ex, 'Ey': Ey, 'Ez': Ez,
+            'layer': layer, 'z': z}
+
 def find_in_structure(d_list, distance):
     """
     d_list is list of thicknesses of layers, all of which are finite.
@@ -606,6 +1123,111 @@ class absorp_analytic_fn:
         self.A3 += b.A3
         return self
 
+class absorp_analytic_fn_array:
+    """
+    absorp_analytic_fn for many layers and/or wavelengths at once: A1, A2,
+    A3, a1, a3 and d are NumPy arrays (struct of arrays) instead of
+    scalars, and every method works elementwise on all of them.
+    fill_in takes the output of coh_tmm_spectrum (or coh_tmm) and a layer
+    index or array of layer indices; the coefficients then have shape
+    layer.shape + (num_wavelengths,).
+    """
+    __slots__ = ('A1', 'A2', 'A3', 'a1', 'a3', 'd')
+
+    def fill_in(self, coh_tmm_data, layer):
+        """
+        fill in the coefficients from coh_tmm_data for absorption in the
+        layer(s) with index "layer".
+        """
+        pol = coh_tmm_data['pol']
+        vw_list = coh_tmm_data.get('vw_list')
+        if vw_list is None:
+            vw_list = vw_list_spectrum(coh_tmm_data)
+        layer = np.asarray(layer)
+        v = vw_list[layer, 0]
+        w = vw_list[layer, 1]
+        kz = coh_tmm_data['kz_list'][layer]
+        n = coh_tmm_data['n_list'][layer]
+        n_0 = coh_tmm_data['n_list'][0]
+        th_0 = coh_tmm_data['th_0']
+        th = coh_tmm_data['th_list'][layer]
+        d = np.asarray(coh_tmm_data['d_list'], dtype=float)[layer]
+        if np.ndim(kz) > np.ndim(d):
+            d = d[..., None]
+        self.d = d
+
+        self.a1 = 2*kz.imag
+        self.a3 = 2*kz.real
+
+        if pol == 's':
+            temp = (n*cos(th)*kz).imag / (n_0*cos(th_0)).real
+            self.A1 = temp * abs(w)**2
+            self.A2 = temp * abs(v)**2
+            self.A3 = temp * v * conj(w)
+        else: # pol=='p'
+            temp = (2*(kz.imag)*(n*cos(conj(th))).real /
+                    (n_0*conj(cos(th_0))).real)
+            self.A1 = temp * abs(w)**2
+            self.A2 = temp * abs(v)**2
+            self.A3 = v * conj(w) * (-2*(kz.real)*(n*cos(conj(th))).imag /
+                                     (n_0*conj(cos(th_0))).real)
+        return self
+
+    def copy(self):
+        """
+        Create copy of an absorp_analytic_fn_array object
+        """
+        a = absorp_analytic_fn_array()
+        (a.A1, a.A2, a.A3, a.a1, a.a3, a.d) = (
+           np.copy(self.A1), np.copy(self.A2), np.copy(self.A3),
+           np.copy(self.a1), np.copy(self.a3), np.copy(self.d))
+        return a
+
+    def run(self, z):
+        """
+        Calculates absorption at depth z, where z=0 is the start of the
+        layer. z broadcasts against the coefficients, so for a
+        (num_depths, num_wavelengths) map of one layer pass z[:, None].
+        """
+        return (self.A1*exp(self.a1 * z) + self.A2*exp(-self.a1 * z)
+             + 2 * (self.A3*exp(1j*self.a3*z)).real)
+
+    def flip(self):
+        """
+        Flip the functions front-to-back, to describe a(d-z) instead of
+        a(z), where d is layer thickness.
+        """
+        newA1 = self.A2*exp(-self.a1 * self.d)
+        newA2 = self.A1*exp(self.a1 * self.d)
+        self.A1, self.A2 = newA1, newA2
+        self.A3 = conj(self.A3 * exp(1j * self.a3 * self.d))
+        return self
+
+    def scale(self, factor):
+        """
+        multiplies the absorption at each point by "factor", which may be
+        an array broadcasting against the coefficients (e.g. one factor per
+        wavelength).
+        """
+        self.A1 = self.A1 * factor
+        self.A2 = self.A2 * factor
+        self.A3 = self.A3 * factor
+        return self
+
+    def add(self, b):
+        """
+        adds another compatible absorption analytical function
+        """
+        # Forward and reversed stacks reach kz along different rounding
+        # paths, so compare to within rounding rather than exactly
+        if not (np.allclose(b.a1, self.a1, rtol=1e-9, atol=1e-18)
+                and np.allclose(b.a3, self.a3, rtol=1e-9, atol=1e-18)):
+            raise ValueError('Incompatible absorption analytical functions!')
+        self.A1 = self.A1 + b.A1
+        self.A2 = self.A2 + b.A2
+        self.A3 = self.A3 + b.A3
+        return self
+
 def absorp_in_each_layer(coh_tmm_data):
     """
     An array listing what proportion of light is absorbed in each layer.
@@ -613,7 +1235,11 @@ def absorp_in_each_layer(coh_tmm_data):
     Assumes the initial layer eventually absorbs all reflected light.
     Entries of array should sum to 1.
     coh_tmm_data is output of coh_tmm()
+    If coh_tmm_data is output of coh_tmm_spectrum, returns a
+    (num_wavelengths, num_layers) array instead, each row summing to 1.
     """
+    if np.ndim(coh_tmm_data['R']) > 0:
+        return absorp_in_each_layer_spectrum(coh_tmm_data)
     num_layers = len(coh_tmm_data['d_list'])
     power_entering_each_layer = zeros(num_layers)
     power_entering_each_layer[0] = 1
@@ -626,6 +1252,40 @@ def absorp_in_each_layer(coh_tmm_data):
     final_answer[-1] = power_entering_each_layer[-1]
     return final_answer
 
+def absorp_in_each_layer_spectrum(coh_tmm_data):
+    """
+    absorp_in_each_layer for output of coh_tmm_spectrum. The Poynting vector
+    at the start of every interior layer comes from one vw_list_spectrum
+    pass instead of a position_resolved call per layer per wavelength.
+    Returns a (num_wavelengths, num_layers) array.
+    """
+    pol = coh_tmm_data['pol']
+    n = coh_tmm_data['n_list']
+    th = coh_tmm_data['th_list']
+    n_0 = n[0]
+    th_0 = coh_tmm_data['th_0']
+    num_layers = n.shape[0]
+
+    power_entering_each_layer = zeros(n.shape)
+    power_entering_each_layer[0] = 1
+    power_entering_each_layer[1] = coh_tmm_data['power_entering']
+    power_entering_each_layer[-1] = coh_tmm_data['T']
+    if num_layers > 3:
+        vw_list = vw_list_spectrum(coh_tmm_data)[2:-1]
+        Ef, Eb = vw_list[:, 0], vw_list[:, 1]
+        n, th = n[2:-1], th[2:-1]
+        if pol == 's':
+            poyn = (((n*cos(th)*conj(Ef+Eb)*(Ef-Eb)).real)
+                    / (n_0*cos(th_0)).real)
+        else:
+            poyn = (((n*conj(cos(th))*(Ef+Eb)*conj(Ef-Eb)).real)
+                    / (n_0*conj(cos(th_0))).real)
+        power_entering_each_layer[2:-1] = poyn
+    final_answer = zeros(power_entering_each_layer.shape)
+    final_answer[0:-1] = -np.diff(power_entering_each_layer, axis=0)
+    final_answer[-1] = power_entering_each_layer[-1]
+    return final_answer.T
+
 def inc_group_layers(n_list, d_list, c_list):
     """
     Helper function for inc_tmm. Groups and sorts layer information.
@@ -729,7 +1389,7 @@ def inc_group_layers(n_list, d_list, c_list):
             'num_inc_layers':len(all_from_inc),
             'num_layers':len(n_list)}
 
-def inc_tmm(pol, n_list, d_list, c_list, th_0, lam_vac):
+def inc_tmm(pol, n_list, d_list, c_list, th_0, lam_vac, group_layers_data=None):
     """
     Incoherent, or partly-incoherent-partly-coherent, transfer matrix method.
     See coh_tmm for definitions of pol, n_list, d_list, th_0, lam_vac.
@@ -758,6 +1418,11 @@ def inc_tmm(pol, n_list, d_list, c_list, th_0, lam_vac):
       crossing the interface into the n'th incoherent layer from the previous
       (coherent or incoherent) layer.
     * Plus, all the outputs of inc_group_layers
+    group_layers_data, if given, is the output of
+    inc_group_layers(arange(len(n_list)), d_list, c_list) -- the grouping
+    done on layer indices rather than refractive indices. It depends only on
+    c_list, so it can be computed once and reused across wavelengths and
+    thicknesses (see CompiledStack).
     """
     # Convert lists to numpy arrays if they're not already.
     n_list = array(n_list)
@@ -767,14 +1432,17 @@ def inc_tmm(pol, n_list, d_list, c_list, th_0, lam_vac):
     if (np.real_if_close(n_list[0]*np.sin(th_0))).imag != 0:
         raise ValueError('Error in n0 or th0!')
 
-    group_layers_data = inc_group_layers(n_list, d_list, c_list)
+    if group_layers_data is None:
+        group_layers_data = inc_group_layers(arange(n_list.size), d_list, c_list)
     num_inc_layers = group_layers_data['num_inc_layers']
     num_stacks = group_layers_data['num_stacks']
-    stack_n_list = group_layers_data['stack_n_list']
-    stack_d_list = group_layers_data['stack_d_list']
     all_from_stack = group_layers_data['all_from_stack']
+    # The grouping only fixes which layers form each stack; take n and d
+    # from this call's lists
+    stack_n_list = [n_list[indices] for indices in all_from_stack]
+    stack_d_list = [np.concatenate(([inf], d_list[indices[1:-1]], [inf]))
+                    for indices in all_from_stack]
     all_from_inc = group_layers_data['all_from_inc']
-    all_from_stack = group_layers_data['all_from_stack']
     stack_from_inc = group_layers_data['stack_from_inc']
     inc_from_stack = group_layers_data['inc_from_stack']
 
@@ -920,8 +1588,269 @@ def inc_tmm(pol, n_list, d_list, c_list, th_0, lam_vac):
             'stackFB_list':stackFB_list,
             'power_entering_list':power_entering_list}
     ans.update(group_layers_data)
+    ans['stack_n_list'] = stack_n_list
+    ans['stack_d_list'] = stack_d_list
     return ans
 
+def inc_tmm_spectrum(pol, n_array, d_list, c_list, th_0, lam_vac_list,
+                     group_layers_data=None):
+    """
+    Vectorized inc_tmm: the whole spectrum in one call. Each coherent stack
+    is run forward and reversed through coh_tmm_spectrum, and the incoherent
+    power matrices are built and multiplied as (num_wavelengths, 2, 2)
+    arrays, so the Python-level loops run over layers only, never over
+    wavelengths.
+    n_array, th_0 and lam_vac_list are as in coh_tmm_spectrum; pol, d_list,
+    c_list and group_layers_data are as in inc_tmm.
+    Outputs the same dictionary as inc_tmm, with a trailing wavelength axis
+    on every per-wavelength quantity:
+    * R, T--(num_wavelengths,) arrays
+    * VW_list--(num_inc_layers, 2, num_wavelengths)
+    * coh_tmm_data_list, coh_tmm_bdata_list--outputs of coh_tmm_spectrum
+    * stackFB_list--n'th element is [F,B], each (num_wavelengths,)
+    * power_entering_list--(num_inc_layers, num_wavelengths)
+    * stack_n_list--n'th element is (stack size, num_wavelengths)
+    """
+    n_array = np.asarray(n_array, dtype=complex)
+    d_list = array(d_list, dtype=float)
+    lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+
+    # Input tests
+    if ((n_array.ndim != 2) or (d_list.ndim != 1) or (lam_vac_list.ndim != 1)
+            or (n_array.shape != (d_list.size, lam_vac_list.size))):
+        raise ValueError("Problem with n_array or d_list!")
+    if np.any(abs((n_array[0]*np.sin(th_0)).imag) >= 100*EPSILON):
+        raise ValueError('Error in n0 or th0!')
+
+    if group_layers_data is None:
+        group_layers_data = inc_group_layers(arange(d_list.size), d_list, c_list)
+    num_inc_layers = group_layers_data['num_inc_layers']
+    all_from_stack = group_layers_data['all_from_stack']
+    all_from_inc = group_layers_data['all_from_inc']
+    stack_from_inc = group_layers_data['stack_from_inc']
+    inc_from_stack = group_layers_data['inc_from_stack']
+    stack_n_list = [n_array[indices] for indices in all_from_stack]
+    stack_d_list = [np.concatenate(([inf], d_list[indices[1:-1]], [inf]))
+                    for indices in all_from_stack]
+    num_wl = lam_vac_list.size
+
+    th_list = list_snell_spectrum(n_array, th_0)
+
+    coh_tmm_data_list = []
+    coh_tmm_bdata_list = []
+    for indices, stack_n, stack_d in zip(all_from_stack, stack_n_list,
+                                         stack_d_list):
+        coh_tmm_data_list.append(coh_tmm_spectrum(
+            pol, stack_n, stack_d, th_list[indices[0]], lam_vac_list))
+        coh_tmm_bdata_list.append(coh_tmm_spectrum_reverse(
+            pol, stack_n, stack_d, th_list[indices[0]], lam_vac_list))
+
+    # P_list[i] is fraction not absorbed in a single pass through i'th
+    # incoherent layer, with the same 1e-30 floor as inc_tmm
+    P_list = zeros((num_inc_layers, num_wl))
+    inner = all_from_inc[1:-1]
+    if inner:
+        P_list[1:-1] = np.maximum(
+            exp(-4 * np.pi * d_list[inner, None]
+                * (n_array[inner] * cos(th_list[inner])).imag / lam_vac_list),
+            1e-30)
+
+    # T_list[i,j] and R_list[i,j] as in inc_tmm, one value per wavelength
+    T_list = zeros((num_inc_layers, num_inc_layers, num_wl))
+    R_list = zeros((num_inc_layers, num_inc_layers, num_wl))
+    for inc_index in range(num_inc_layers-1):
+        i = all_from_inc[inc_index]
+        nextstack_index = stack_from_inc[inc_index+1]
+        if isnan(nextstack_index):
+            args = (n_array[i], n_array[i+1], th_list[i], th_list[i+1])
+            back_args = (n_array[i+1], n_array[i], th_list[i+1], th_list[i])
+            R_list[inc_index, inc_index+1] = interface_R(pol, *args)
+            T_list[inc_index, inc_index+1] = interface_T(pol, *args)
+            R_list[inc_index+1, inc_index] = interface_R(pol, *back_args)
+            T_list[inc_index+1, inc_index] = interface_T(pol, *back_args)
+        else:
+            R_list[inc_index, inc_index+1] = (
+                coh_tmm_data_list[nextstack_index]['R'])
+            T_list[inc_index, inc_index+1] = (
+                coh_tmm_data_list[nextstack_index]['T'])
+            R_list[inc_index+1, inc_index] = (
+                coh_tmm_bdata_list[nextstack_index]['R'])
+            T_list[inc_index+1, inc_index] = (
+                coh_tmm_bdata_list[nextstack_index]['T'])
+
+    def interface_L(i):
+        # (num_wavelengths, 2, 2) power matrix of interface i -> i+1
+        L = np.empty((num_wl, 2, 2))
+        L[:, 0, 0] = 1
+        L[:, 0, 1] = -R_list[i+1, i]
+        L[:, 1, 0] = R_list[i, i+1]
+        L[:, 1, 1] = (T_list[i+1, i] * T_list[i, i+1]
+                      - R_list[i+1, i] * R_list[i, i+1])
+        return L / T_list[i, i+1][:, None, None]
+
+    L_list = [nan]
+    Ltilde = interface_L(0)
+    for i in range(1, num_inc_layers-1):
+        L = interface_L(i)
+        L[:, 0, :] /= P_list[i][:, None]
+        L[:, 1, :] *= P_list[i][:, None]
+        L_list.append(L)
+        Ltilde = np.matmul(Ltilde, L)
+    T = 1 / Ltilde[:, 0, 0]
+    R = Ltilde[:, 1, 0] / Ltilde[:, 0, 0]
+
+    VW_list = zeros((num_inc_layers, 2, num_wl))
+    VW_list[0] = nan
+    VW = zeros((num_wl, 2))
+    VW[:, 0] = T
+    VW_list[-1] = VW.T
+    for i in range(num_inc_layers-2, 0, -1):
+        VW = np.einsum('wij,wj->wi', L_list[i], VW)
+        VW_list[i] = VW.T
+
+    stackFB_list = []
+    for prev_inc_index in inc_from_stack:
+        if prev_inc_index == 0:
+            F = np.ones(num_wl)
+        else:
+            F = VW_list[prev_inc_index, 0] * P_list[prev_inc_index]
+        B = VW_list[prev_inc_index+1, 1]
+        stackFB_list.append([F, B])
+
+    power_entering_list = zeros((num_inc_layers, num_wl))
+    power_entering_list[0] = 1
+    for i in range(1, num_inc_layers):
+        prev_stack_index = stack_from_inc[i]
+        if isnan(prev_stack_index):
+            if i == 1:
+                power_entering_list[i] = (T_list[0, 1]
+                                          - VW_list[1, 1] * T_list[1, 0])
+            else:
+                power_entering_list[i] = (
+                    VW_list[i-1, 0] * P_list[i-1] * T_list[i-1, i]
+                    - VW_list[i, 1] * T_list[i, i-1])
+        else:
+            power_entering_list[i] = (
+                stackFB_list[prev_stack_index][0]
+                * coh_tmm_data_list[prev_stack_index]['T']
+                - stackFB_list[prev_stack_index][1]
+                * coh_tmm_bdata_list[prev_stack_index]['power_entering'])
+
+    ans = {'T': T, 'R': R, 'VW_list': VW_list,
+           'coh_tmm_data_list': coh_tmm_data_list,
+           'coh_tmm_bdata_list': coh_tmm_bdata_list,
+           'stackFB_list': stackFB_list,
+           'power_entering_list': power_entering_list}
+    ans.update(group_layers_data)
+    ans['stack_n_list'] = stack_n_list
+    ans['stack_d_list'] = stack_d_list
+    return ans
+
+class CompiledStack:
+    """
+    A thin-film structure prepared once for repeated evaluation: the inputs
+    are validated, the coherent/incoherent grouping is worked out, layers
+    sharing a refractive index function are evaluated only once per
+    wavelength, and the (num_layers, num_wavelengths) index array is kept
+    for the last wavelength grid used.
+    n_fn_list and d_list are as in calc_reflectances; an entry of n_fn_list
+    may also be a plain number. c_list is as in inc_tmm; leave it as None
+    for a fully coherent stack.
+    Every layer is evaluated with the same th_0 and pol, so one object can
+    serve every request that shares the structure, with thicknesses
+    supplied per call.
+    """
+    def __init__(self, n_fn_list, d_list, c_list=None, th_0=0, pol='s'):
+        d_list = array(d_list, dtype=float)
+        if d_list.ndim != 1 or d_list.size != len(n_fn_list):
+            raise ValueError("Problem with n_fn_list or d_list!")
+        if (d_list[0] != inf) or (d_list[-1] != inf):
+            raise ValueError('d_list must start and end with inf!')
+        if pol not in ('s', 'p'):
+            raise ValueError("Polarization must be 's' or 'p'")
+        self.d_list = d_list
+        self.num_layers = d_list.size
+        self.th_0 = th_0
+        self.pol = pol
+
+        # Layers with the same n function (e.g. repeated NAND pairs) share
+        # one row of the evaluated index array
+        self.n_fns = []
+        self.layer_index = zeros(self.num_layers, dtype=int)
+        for i, n_fn in enumerate(n_fn_list):
+            for j, known in enumerate(self.n_fns):
+                # Functions by identity, constant indices by value
+                if known is n_fn or (not callable(known)
+                                     and not callable(n_fn) and known == n_fn):
+                    break
+            else:
+                j = len(self.n_fns)
+                self.n_fns.append(n_fn)
+            self.layer_index[i] = j
+
+        if c_list is None or all(c == 'c' for c in c_list[1:-1]):
+            self.c_list = None
+            self.group_layers_data = None
+        else:
+            self.c_list = list(c_list)
+            self.group_layers_data = inc_group_layers(arange(self.num_layers),
+                                                      d_list, self.c_list)
+        self._n_cache = None
+
+    def n_array(self, lam_vac_list):
+        """
+        (num_layers, num_wavelengths) refractive indices at lam_vac_list.
+        """
+        lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+        cached = self._n_cache
+        if (cached is not None and cached[0].shape == lam_vac_list.shape
+                and np.array_equal(cached[0], lam_vac_list)):
+            return cached[1]
+        unique_n = np.empty((len(self.n_fns), lam_vac_list.size), dtype=complex)
+        for j, n_fn in enumerate(self.n_fns):
+            unique_n[j] = n_fn(lam_vac_list) if callable(n_fn) else n_fn
+        n_array = unique_n[self.layer_index]
+        # One tuple assignment, so concurrent callers never see a mismatch
+        self._n_cache = (lam_vac_list, n_array)
+        return n_array
+
+    def _d_rows(self, thicknesses):
+        thicknesses = np.atleast_2d(np.asarray(thicknesses, dtype=float))
+        if thicknesses.shape[1] != self.num_layers - 2:
+            raise ValueError('Need one thickness per finite layer!')
+        d_array = np.empty((thicknesses.shape[0], self.num_layers))
+        d_array[:, 0] = d_array[:, -1] = inf
+        d_array[:, 1:-1] = thicknesses
+        return d_array
+
+    def reflectance(self, lam_vac_list, d_list=None):
+        """
+        R at each wavelength in lam_vac_list, for the compiled thicknesses or
+        for d_list (same layout, starting and ending with inf) if given.
+        """
+        if d_list is None:
+            d_list = self.d_list
+        lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+        n_array = self.n_array(lam_vac_list)
+        if self.c_list is None:
+            return coh_tmm_spectrum(self.pol, n_array, d_list, self.th_0,
+                                    lam_vac_list)['R']
+        return inc_tmm_spectrum(self.pol, n_array, d_list, self.c_list,
+                                self.th_0, lam_vac_list,
+                                group_layers_data=self.group_layers_data)['R']
+
+    def reflectance_batch(self, thicknesses, lam_vac_list):
+        """
+        R for many thickness sets. thicknesses is (num_sets, num_layers - 2),
+        the finite layers only. Returns a (num_sets, num_wavelengths) array.
+        """
+        d_array = self._d_rows(thicknesses)
+        if self.c_list is None:
+            return coh_tmm_batch(self.pol, self.n_array(lam_vac_list), d_array,
+                                 self.th_0, lam_vac_list)
+        return np.vstack([self.reflectance(lam_vac_list, d_list)
+                          for d_list in d_array])
+
 def inc_absorp_in_each_layer(inc_data):
     """
     A list saying what proportion of light is absorbed in each layer.
@@ -929,7 +1858,11 @@ def inc_absorp_in_each_layer(inc_data):
     all transmitted light is eventually absorbed in the final medium.
     Returns a list [layer0absorp, layer1absorp, ...]. Entries should sum to 1.
     inc_data is output of incoherent_main()
+    If inc_data is output of inc_tmm_spectrum, returns a
+    (num_wavelengths, num_layers) array instead, each row summing to 1.
     """
+    if np.ndim(inc_data['R']) > 0:
+        return inc_absorp_in_each_layer_spectrum(inc_data)
     # Reminder: inc_from_stack[i] = j means that the i'th stack comes after the
     # layer with incoherent index j.
     # Reminder: stack_from_inc[i] = j means that the layer
@@ -967,21 +1900,62 @@ def inc_absorp_in_each_layer(inc_data):
     absorp_list.append(inc_data['T'])
     return absorp_list
 
+def inc_absorp_in_each_layer_spectrum(inc_data):
+    """
+    inc_absorp_in_each_layer for output of inc_tmm_spectrum. Each coherent
+    stack's absorption comes from absorp_in_each_layer_spectrum, so the
+    only loop is over incoherent layers. Returns a
+    (num_wavelengths, num_layers) array.
+    """
+    stack_from_inc = inc_data['stack_from_inc']
+    power_entering_list = inc_data['power_entering_list']
+    stackFB_list = inc_data['stackFB_list']
+    num_wl = power_entering_list.shape[1]
+    final_answer = zeros((num_wl, inc_data['num_layers']))
+
+    column = 0
+    for i in range(len(power_entering_list) - 1):
+        if isnan(stack_from_inc[i+1]):
+            final_answer[:, column] = (power_entering_list[i]
+                                       - power_entering_list[i+1])
+            column += 1
+        else:
+            j = stack_from_inc[i+1]
+            coh_tmm_data = inc_data['coh_tmm_data_list'][j]
+            coh_tmm_bdata = inc_data['coh_tmm_bdata_list'][j]
+            F, B = stackFB_list[j]
+            power_exiting = (F * coh_tmm_data['power_entering']
+                             - B * coh_tmm_bdata['T'])
+            final_answer[:, column] = power_entering_list[i] - power_exiting
+            stack_absorp = (
+                F[:, None] * absorp_in_each_layer_spectrum(coh_tmm_data)[:, 1:-1]
+                + B[:, None]
+                * absorp_in_each_layer_spectrum(coh_tmm_bdata)[:, -2:0:-1])
+            final_answer[:, column+1:column+1+stack_absorp.shape[1]] = stack_absorp
+            column += 1 + stack_absorp.shape[1]
+    final_answer[:, -1] = inc_data['T']
+    return final_answer
+
 def inc_find_absorp_analytic_fn(layer, inc_data):
     """
     Outputs an absorp_analytic_fn object for a coherent layer within a
     partly-incoherent stack.
     inc_data is output of incoherent_main()
+    If inc_data is output of inc_tmm_spectrum, an absorp_analytic_fn_array
+    covering every wavelength is returned instead.
     """
     j = inc_data['stack_from_all'][layer]
-    if isnan(j):
+    if np.any(isnan(j)):
         raise ValueError('layer must be coherent for this function!')
     [stackindex, withinstackindex] = j
-    forwardfunc = absorp_analytic_fn()
+    fn_class = absorp_analytic_fn
+    if np.ndim(inc_data['R']) > 0:
+        fn_class = absorp_analytic_fn_array
+    forwardfunc = fn_class()
     forwardfunc.fill_in(inc_data['coh_tmm_data_list'][stackindex],
                         withinstackindex)
     forwardfunc.scale(inc_data['stackFB_list'][stackindex][0])
-    backfunc = absorp_analytic_fn()
+    backfunc = fn_class()
     backfunc.fill_in(inc_data['coh_tmm_bdata_list'][stackindex],
                -1-withinstackindex)
     backfunc.scale(inc_data['stackFB_list'][stackindex][1])
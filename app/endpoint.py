@@ -0,0 +1,194 @@
+import socket
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class Trajectory:
+    """
+    Simulated spectra along a polish: spectra[i] is the spectrum expected
+    at times[i], when the top film is thickness[i] thick.
+    """
+
+    def __init__(self, spectra, times, thickness, wavelengths=None):
+        self.spectra = np.asarray(spectra, dtype=float)
+        self.times = np.asarray(times, dtype=float)
+        self.thickness = np.asarray(thickness, dtype=float)
+        self.wavelengths = wavelengths
+        if not (self.spectra.shape[0] == self.times.size == self.thickness.size):
+            raise ValueError('Need one time and thickness per trajectory spectrum!')
+
+    @classmethod
+    def from_matrix(cls, full_matrix, start_thickness, removal_rate,
+                    time_step=1, wavelengths=None):
+        """
+        Build a trajectory from the contour tab's matrix: one column per
+        polish step, one row per wavelength.
+
+        input
+        ======
+
+        full_matrix: array
+            (num_wavelengths, num_steps) spectra matrix
+        start_thickness: float
+            top film thickness at step 0, in nm
+        removal_rate: float
+            in nm per time unit
+        time_step: float
+            time between columns
+
+        """
+        full_matrix = np.asarray(full_matrix, dtype=float)
+        times = np.arange(full_matrix.shape[1]) * time_step
+        return cls(full_matrix.T, times, start_thickness - removal_rate * times,
+                   wavelengths=wavelengths)
+
+    @classmethod
+    def from_csv(cls, path, start_thickness, removal_rate, time_step=1,
+                 wavelengths=None):
+        """
+        Load a matrix exported from the contour tab (/export/<job_id>.csv):
+        a header "wavelength,<time>,...", then one row per wavelength with
+        the reflectance at each polish time. Read with index_col=0, so the
+        wavelength column becomes the index; wavelengths defaults to it.
+        """
+        matrix_df = pd.read_csv(path, index_col=0)
+        if wavelengths is None:
+            wavelengths = matrix_df.index.values.astype(float)
+        return cls.from_matrix(matrix_df.values, start_thickness, removal_rate,
+                               time_step=time_step, wavelengths=wavelengths)
+
+
+class EndpointDetector:
+    """
+    Match incoming spectra frame by frame against a Trajectory and report
+    when the estimated film thickness reaches the target.
+
+    The polish only moves forward along the trajectory, so after the first
+    frame only a fixed window around the last match is searched. Per-frame
+    cost is therefore O(window * num_wavelengths), independent of the
+    trajectory length. If the best distance in the window exceeds
+    relock_distance, the whole trajectory is searched again.
+
+    Spectra are compared after removing their mean and scaling to unit norm,
+    so a drifting lamp intensity doesn't shift the match.
+    """
+
+    def __init__(self, trajectory, target_thickness, window=8, confirm=3,
+                 relock_distance=None, on_endpoint=None):
+        self.trajectory = trajectory
+        self.target_thickness = target_thickness
+        self.window = window
+        self.confirm = confirm
+        self.relock_distance = relock_distance
+        self.on_endpoint = on_endpoint
+        self._reference = self._normalize(trajectory.spectra)
+        self._steps = np.arange(self._reference.shape[0])
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous match and any fired endpoint.
+        """
+        self.index = None
+        self.frames = 0
+        self.below_target = 0
+        self.endpoint = None
+
+    @staticmethod
+    def _normalize(spectra):
+        centered = spectra - spectra.mean(axis=-1, keepdims=True)
+        norm = np.linalg.norm(centered, axis=-1, keepdims=True)
+        return centered / np.where(norm > 0, norm, 1)
+
+    def _search(self, frame, lo, hi):
+        # 2 - 2*cos(angle) between unit vectors == squared distance
+        distance = 2 - 2 * np.dot(self._reference[lo:hi], frame)
+        best = int(np.argmin(distance))
+        # Parabolic interpolation between neighbouring steps
+        offset = 0.
+        if 0 < best < distance.size - 1:
+            left, mid, right = distance[best-1:best+2]
+            curvature = left - 2 * mid + right
+            if curvature > 0:
+                offset = 0.5 * (left - right) / curvature
+        return lo + best + offset, distance[best]
+
+    def update(self, frame):
+        """
+        Process one measured spectrum (on the trajectory's wavelengths).
+
+        output
+        ======
+
+        dict
+            position: fractional trajectory index of the match
+            time, thickness: interpolated along the trajectory
+            remaining: thickness still to remove before the target, in nm
+            distance: squared distance of the match (0 to 4)
+            endpoint: True on the frame the endpoint fires
+            latency: seconds spent on this frame
+
+        """
+        t_start = time.perf_counter()
+        frame = self._normalize(np.asarray(frame, dtype=float))
+        num_steps = self._reference.shape[0]
+
+        if self.index is None:
+            position, distance = self._search(frame, 0, num_steps)
+        else:
+            lo = max(self.index - 1, 0)
+            hi = min(self.index + self.window + 1, num_steps)
+            position, distance = self._search(frame, lo, hi)
+            if self.relock_distance is not None and distance > self.relock_distance:
+                position, distance = self._search(frame, 0, num_steps)
+        self.index = int(round(position))
+        self.frames += 1
+
+        thickness = np.interp(position, self._steps, self.trajectory.thickness)
+        elapsed = np.interp(position, self._steps, self.trajectory.times)
+        remaining = thickness - self.target_thickness
+
+        fired = False
+        if self.endpoint is None:
+            self.below_target = self.below_target + 1 if remaining <= 0 else 0
+            if self.below_target >= self.confirm:
+                fired = True
+        result = {'position': position, 'time': elapsed,
+                  'thickness': thickness, 'remaining': remaining,
+                  'distance': distance, 'endpoint': fired}
+        if fired:
+            self.endpoint = dict(result, frame=self.frames)
+            if self.on_endpoint is not None:
+                self.on_endpoint(self.endpoint)
+        result['latency'] = time.perf_counter() - t_start
+        return result
+
+    def run(self, frames):
+        """
+        Consume an iterable of spectra (e.g. socket_frames(...)) and yield
+        the update() result for each one.
+        """
+        for frame in frames:
+            yield self.update(frame)
+
+
+def socket_frames(address, num_wavelengths, dtype='<f8', timeout=None):
+    """
+    Yield spectra from a local TCP socket, standing in for a spectrometer
+    stream. Each frame is num_wavelengths values of dtype sent back to back;
+    the generator ends when the sender closes the connection.
+    """
+    frame_bytes = num_wavelengths * np.dtype(dtype).itemsize
+    with socket.create_connection(address, timeout=timeout) as conn:
+        buffer = bytearray()
+        while True:
+            while len(buffer) < frame_bytes:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    return
+                buffer.extend(chunk)
+            frame = np.frombuffer(bytes(buffer[:frame_bytes]), dtype=dtype)
+            del buffer[:frame_bytes]
+            yield frame
@@ -0,0 +1,184 @@
+import io
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'npz': 'application/octet-stream',
+    'parquet': 'application/octet-stream',
+}
+
+
+class ExportJob:
+    """
+    One spectra matrix kept for download: r[i, j] is the reflectance at
+    wavelengths[i] and times[j].
+    """
+
+    def __init__(self, r, wavelengths, times):
+        self.r = np.asarray(r, dtype=float)
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.times = np.asarray(times, dtype=float)
+        if self.r.shape != (self.wavelengths.size, self.times.size):
+            raise ValueError('Need one wavelength per row and one time per '
+                             'column of the matrix!')
+
+
+class ExportStore:
+    """
+    Thread-safe registry of export jobs, keyed by random ids so concurrent
+    users never see each other's results. Only the most recent max_jobs
+    are kept; older ones are dropped first.
+    """
+
+    def __init__(self, max_jobs=64):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, r, wavelengths, times):
+        """
+        Keep a matrix for export and return its job id.
+        """
+        job = ExportJob(r, wavelengths, times)
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job_id
+
+    def get(self, job_id):
+        """
+        The ExportJob for job_id, or None if it is unknown or expired.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+export_store = ExportStore()
+
+
+class _StreamBuffer:
+    """
+    Write-only, non-seekable file object whose contents are drained as the
+    archive is being written, so zip members can be streamed.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self._data = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self._data.extend(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._data)
+        del self._data[:]
+        return data
+
+
+def _row_chunks(job, chunk_rows):
+    for start in range(0, job.wavelengths.size, chunk_rows):
+        yield start, min(start + chunk_rows, job.wavelengths.size)
+
+
+def iter_csv(job, chunk_rows=256):
+    """
+    Yield the matrix as CSV text: a header row "wavelength,<time>,...",
+    then one row per wavelength. Readable with
+    pd.read_csv(path, index_col=0) and endpoint.Trajectory.from_csv.
+    """
+    yield ','.join(['wavelength'] + ['{:g}'.format(t) for t in job.times]) + '\n'
+    for start, stop in _row_chunks(job, chunk_rows):
+        text = io.StringIO()
+        np.savetxt(text, np.column_stack((job.wavelengths[start:stop],
+                                          job.r[start:stop])),
+                   fmt='%.10g', delimiter=',')
+        yield text.getvalue()
+
+
+def iter_npz(job, chunk_rows=256):
+    """
+    Yield a compressed .npz with arrays wavelength, time and r, written
+    chunk by chunk.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for name, array in (('wavelength', job.wavelengths),
+                            ('time', job.times)):
+            with archive.open(name + '.npy', 'w') as member:
+                np.lib.format.write_array(member, array)
+        with archive.open('r.npy', 'w', force_zip64=True) as member:
+            np.lib.format.write_array_header_2_0(
+                member, {'descr': np.lib.format.dtype_to_descr(job.r.dtype),
+                         'fortran_order': False, 'shape': job.r.shape})
+            for start, stop in _row_chunks(job, chunk_rows):
+                member.write(np.ascontiguousarray(job.r[start:stop]).tobytes())
+                yield buffer.drain()
+    yield buffer.drain()
+
+
+def iter_parquet(job, chunk_rows=256):
+    """
+    Yield the matrix as Parquet (needs pyarrow): a wavelength column and one
+    column per time, one row group per chunk of wavelengths. The times are
+    also stored in the schema metadata.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    names = ['wavelength'] + ['{:g}'.format(t) for t in job.times]
+    schema = pa.schema([(name, pa.float64()) for name in names],
+                       metadata={'time': ','.join(repr(float(t)) for t in job.times)})
+    buffer = _StreamBuffer()
+    writer = pq.ParquetWriter(buffer, schema)
+    try:
+        for start, stop in _row_chunks(job, chunk_rows):
+            columns = [job.wavelengths[start:stop]] + list(job.r[start:stop].T)
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column) for column in columns], schema=schema))
+            yield buffer.drain()
+    finally:
+        writer.close()
+    yield buffer.drain()
+
+
+def iter_export(job, file_format, chunk_rows=256):
+    """
+    Chunks of job in file_format ('csv', 'npz' or 'parquet')
+    """
+    writers = {'csv': iter_csv, 'npz': iter_npz, 'parquet': iter_parquet}
+    if file_format not in writers:
+        raise ValueError('Unknown export format: {}'.format(file_format))
+    if file_format == 'parquet':
+        # Fail before streaming starts rather than halfway through a response
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Exporting Parquet requires pyarrow')
+    return writers[file_format](job, chunk_rows)
@@ -0,0 +1,122 @@
+import numpy as np
+from numpy import inf
+
+from .core_tmm import coh_tmm_spectrum
+
+EPS_DIAG = 1e-12 # damping floor for layers the spectrum barely depends on
+
+
+def fit_thicknesses(n_array, d_list, lam_vac_list, measured_r, fit_layers=None,
+                    th_0=0, pol='s', reference=None, weights=None,
+                    max_iter=100, ftol=1e-10, xtol=1e-8, damping=1e-3):
+    """
+    Fit layer thicknesses to a measured reflectance spectrum with
+    Levenberg-Marquardt. Trial steps only need the residuals; once a step
+    is accepted, its residuals and analytic Jacobian come out of a single
+    coh_tmm_spectrum pass, however many layers are fitted.
+
+    input
+    ======
+
+    n_array: array
+        (num_layers, num_wavelengths) complex refractive indices, see
+        coh_tmm_spectrum
+    d_list: list
+        starting thicknesses in nm, starting and ending with inf
+    lam_vac_list: array
+        wavelengths in nm the measurement was taken at
+    measured_r: array
+        measured reflectance, one value per wavelength
+    fit_layers: list
+        indices into d_list of the layers to fit (default: every finite
+        layer). The others are held at their d_list value.
+    reference: array
+        optional reference spectrum (e.g. bare Si) the measurement is
+        normalized to; the model is then R / reference
+    weights: array
+        optional per-wavelength weights applied to the residuals
+
+    output
+    ======
+
+    dict
+        d_list: fitted thicknesses
+        R: modeled spectrum at the solution (normalized like measured_r)
+        residual: rms of the weighted residuals
+        n_iter: number of LM iterations
+        converged: whether ftol or xtol was reached
+        covariance: (len(fit_layers), len(fit_layers)) estimate from the
+                    final Jacobian, in nm^2
+
+    """
+    d_list = np.array(d_list, dtype=float)
+    measured_r = np.asarray(measured_r, dtype=float)
+    if fit_layers is None:
+        fit_layers = [i for i in range(1, d_list.size - 1)]
+    fit_layers = np.asarray(fit_layers, dtype=int)
+    if np.any(np.isinf(d_list[fit_layers])):
+        raise ValueError('Only finite layers can be fitted!')
+    scale = np.ones_like(measured_r)
+    if reference is not None:
+        scale = scale / np.asarray(reference, dtype=float)
+    if weights is not None:
+        w = np.asarray(weights, dtype=float)
+    else:
+        w = np.ones_like(measured_r)
+
+    def evaluate(d, jacobian=False):
+        data = coh_tmm_spectrum(pol, n_array, d, th_0, lam_vac_list,
+                                jacobian=jacobian)
+        model = data['R'] * scale
+        res = w * (model - measured_r)
+        if not jacobian:
+            return model, res
+        jac = (w * scale * data['dR_dd'][fit_layers]).T
+        return model, res, jac
+
+    model, res, jac = evaluate(d_list, jacobian=True)
+    cost = np.dot(res, res)
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        JTJ = np.dot(jac.T, jac)
+        grad = np.dot(jac.T, res)
+        # Marquardt scaling: damp each direction by its own curvature
+        diag = np.maximum(np.diag(JTJ), EPS_DIAG)
+        while True:
+            step = np.linalg.solve(JTJ + damping * np.diag(diag), -grad)
+            trial = d_list.copy()
+            trial[fit_layers] = np.maximum(d_list[fit_layers] + step, 0)
+            trial_model, trial_res = evaluate(trial)
+            trial_cost = np.dot(trial_res, trial_res)
+            if trial_cost < cost:
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+            if damping > 1e12:
+                break
+        if trial_cost >= cost:
+            # Damping saturated without finding a downhill step. That is a
+            # stall, not a solution: ftol/xtol were never met.
+            break
+        step_size = np.linalg.norm(trial[fit_layers] - d_list[fit_layers])
+        decrease = cost - trial_cost
+        d_list, cost = trial, trial_cost
+        model, res, jac = evaluate(d_list, jacobian=True)
+        if (decrease <= ftol * cost
+                or step_size <= xtol * (np.linalg.norm(d_list[fit_layers]) + xtol)):
+            converged = True
+            break
+
+    dof = max(res.size - fit_layers.size, 1)
+    try:
+        covariance = np.linalg.inv(np.dot(jac.T, jac)) * cost / dof
+    except np.linalg.LinAlgError:
+        covariance = np.full((fit_layers.size, fit_layers.size), inf)
+
+    return {'d_list': d_list,
+            'R': model,
+            'residual': np.sqrt(cost / res.size),
+            'n_iter': n_iter,
+            'converged': converged,
+            'covariance': covariance}
@@ -0,0 +1,128 @@
+import numpy as np
+
+HC_EV_NM = 1239.841984 # photon energy (eV) times wavelength (nm)
+
+
+class WavelengthGrid:
+    """
+    The wavelengths (in nm, increasing) a spectrum is computed at.
+
+    Use this class directly for arbitrary points, e.g. the pixel wavelengths
+    of a spectrometer, or one of the subclasses for generated grids. A grid
+    converts to a plain array with np.asarray(grid), so it can be passed
+    anywhere a lam_vac_list is expected. Grids with the same points compare
+    and hash equal, which makes them usable as cache keys.
+    """
+
+    def __init__(self, wavelengths):
+        wavelengths = np.array(wavelengths, dtype=float)
+        if wavelengths.ndim != 1 or wavelengths.size == 0:
+            raise ValueError('A wavelength grid needs a 1D array of wavelengths')
+        if np.any(wavelengths <= 0) or np.any(np.diff(wavelengths) <= 0):
+            raise ValueError('Wavelengths must be positive and strictly increasing')
+        wavelengths.flags.writeable = False
+        self.wavelengths = wavelengths
+        self._hash = hash(wavelengths.tobytes())
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.wavelengths
+        return self.wavelengths.astype(dtype)
+
+    def __len__(self):
+        return self.wavelengths.size
+
+    def __eq__(self, other):
+        return (isinstance(other, WavelengthGrid)
+                and np.array_equal(self.wavelengths, other.wavelengths))
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return '{}({} points, {:g}-{:g} nm)'.format(
+            type(self).__name__, len(self), self.wavelengths[0],
+            self.wavelengths[-1])
+
+
+class UniformGrid(WavelengthGrid):
+    """
+    start to stop nm (both included) every step nm
+    """
+
+    def __init__(self, start, stop, step=1):
+        if step <= 0 or stop < start:
+            raise ValueError('Need start <= stop and a positive step')
+        num = int(np.floor((stop - start) / step + 1e-9)) + 1
+        super().__init__(start + step * np.arange(num))
+        self.start, self.stop, self.step = start, stop, step
+
+
+class LogGrid(WavelengthGrid):
+    """
+    num wavelengths from start to stop nm, evenly spaced in log(wavelength)
+    """
+
+    def __init__(self, start, stop, num):
+        super().__init__(np.geomspace(start, stop, int(num)))
+        self.start, self.stop, self.num = start, stop, num
+
+
+class EnergyGrid(WavelengthGrid):
+    """
+    num wavelengths from start to stop nm, evenly spaced in photon energy,
+    so the points crowd towards the blue where fringes are densest
+    """
+
+    def __init__(self, start, stop, num):
+        energies = np.linspace(HC_EV_NM / stop, HC_EV_NM / start, int(num))
+        super().__init__(np.sort(HC_EV_NM / energies))
+        self.start, self.stop, self.num = start, stop, num
+
+
+DEFAULT_GRID = UniformGrid(250, 1499)
+
+
+def as_grid(spec=None):
+    """
+    Turn a grid specification into a WavelengthGrid.
+
+    input
+    ======
+
+    spec: WavelengthGrid, tuple, array or None
+        a grid is returned as is; (start, stop) or (start, stop, step) gives
+        a UniformGrid; an array of wavelengths gives a WavelengthGrid of
+        those points; None gives DEFAULT_GRID (250-1499 nm every 1 nm)
+
+    """
+    if spec is None:
+        return DEFAULT_GRID
+    if isinstance(spec, WavelengthGrid):
+        return spec
+    if isinstance(spec, tuple) and len(spec) in (2, 3):
+        return UniformGrid(*spec)
+    return WavelengthGrid(spec)
+
+
+def grid_from_dict(spec):
+    """
+    Grid from its JSON/YAML form: a list of wavelengths, or a dict with
+    start and stop and either step (uniform, default 1) or num with
+    spacing 'log' or 'energy'.
+    """
+    if isinstance(spec, (list, tuple)):
+        return WavelengthGrid(spec)
+    if not isinstance(spec, dict):
+        raise ValueError('A grid must be a list of wavelengths or a dict')
+    spacing = spec.get('spacing', 'uniform')
+    try:
+        if spacing == 'uniform':
+            return UniformGrid(spec['start'], spec['stop'], spec.get('step', 1))
+        if spacing == 'log':
+            return LogGrid(spec['start'], spec['stop'], spec['num'])
+        if spacing == 'energy':
+            return EnergyGrid(spec['start'], spec['stop'], spec['num'])
+    except KeyError as missing:
+        raise ValueError('grid is missing {}'.format(missing))
+    raise ValueError('Unknown grid spacing: {}'.format(spacing))
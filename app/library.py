@@ -0,0 +1,187 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .core_tmm import coh_tmm_batch
+
+
+class SpectralLibrary:
+    """
+    Precomputed spectra of a stack template over an N-D thickness grid,
+    compressed with PCA and indexed with a KD-tree, for thickness lookup
+    without an iterative fit.
+
+    Build one with SpectralLibrary.build(...), match measured spectra with
+    match(...), and persist it with save(path) / SpectralLibrary.load(path).
+    The grid itself is never stored: a grid point's thicknesses are
+    recovered from its flat index and the grid axes.
+    """
+
+    def __init__(self, d_list, fit_layers, axes, lam_vac_list, mean,
+                 components, coeffs, reference=None, th_0=0, pol='s'):
+        self.d_list = np.asarray(d_list, dtype=float)
+        self.fit_layers = np.asarray(fit_layers, dtype=int)
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.lam_vac_list = np.asarray(lam_vac_list, dtype=float)
+        self.mean = mean
+        self.components = components
+        self.coeffs = coeffs
+        self.reference = reference
+        self.th_0 = th_0
+        self.pol = pol
+        self.tree = cKDTree(coeffs)
+
+    @classmethod
+    def build(cls, n_array, d_list, fit_layers, axes, lam_vac_list,
+              th_0=0, pol='s', reference=None, n_components=16,
+              n_train=4000, chunk_size=256, seed=0):
+        """
+        Compute the library.
+
+        input
+        ======
+
+        n_array: array
+            (num_layers, num_wavelengths) refractive indices of the
+            template, see core_tmm.coh_tmm_spectrum
+        d_list: list
+            template thicknesses in nm; entries in fit_layers are overwritten
+            by grid values
+        fit_layers: list
+            indices into d_list of the layers the grid spans
+        axes: list
+            one 1D array of thicknesses per entry of fit_layers
+        lam_vac_list: array
+            wavelengths in nm
+        reference: array
+            optional reference spectrum (e.g. bare Si); library spectra are
+            stored as R / reference to match normalized measurements
+        n_components: int
+            number of PCA coefficients kept per spectrum
+        n_train: int
+            grid points sampled at random to fit the PCA basis; the full
+            grid is then projected chunk by chunk, so memory stays bounded
+            by n_train and chunk_size rather than by the grid size
+
+        output
+        ======
+
+        SpectralLibrary
+
+        """
+        d_list = np.array(d_list, dtype=float)
+        fit_layers = np.asarray(fit_layers, dtype=int)
+        axes = [np.asarray(axis, dtype=float) for axis in axes]
+        if len(axes) != fit_layers.size:
+            raise ValueError('Need one thickness axis per fitted layer!')
+        shape = tuple(axis.size for axis in axes)
+        num_points = int(np.prod(shape))
+
+        def spectra(flat_index):
+            d_array = np.tile(d_list, (flat_index.size, 1))
+            for axis, layer, idx in zip(axes, fit_layers,
+                                        np.unravel_index(flat_index, shape)):
+                d_array[:, layer] = axis[idx]
+            R = coh_tmm_batch(pol, n_array, d_array, th_0, lam_vac_list)
+            if reference is not None:
+                R = R / reference
+            return R
+
+        rng = np.random.RandomState(seed)
+        train = np.sort(rng.choice(num_points, min(n_train, num_points),
+                                   replace=False))
+        train_spectra = np.vstack([spectra(train[i:i+chunk_size])
+                                   for i in range(0, train.size, chunk_size)])
+        mean = train_spectra.mean(axis=0)
+        _, _, vt = np.linalg.svd(train_spectra - mean, full_matrices=False)
+        components = vt[:n_components]
+
+        coeffs = np.empty((num_points, components.shape[0]))
+        for start in range(0, num_points, chunk_size):
+            flat_index = np.arange(start, min(start + chunk_size, num_points))
+            coeffs[flat_index] = np.dot(spectra(flat_index) - mean,
+                                        components.T)
+
+        return cls(d_list, fit_layers, axes, lam_vac_list, mean, components,
+                   coeffs, reference=reference, th_0=th_0, pol=pol)
+
+    def thicknesses(self, flat_index):
+        """
+        Grid thicknesses (len(flat_index), len(fit_layers)) of library
+        entries.
+        """
+        idx = np.unravel_index(flat_index, tuple(a.size for a in self.axes))
+        return np.stack([axis[i] for axis, i in zip(self.axes, idx)], axis=-1)
+
+    def match(self, measured_r, wavelengths=None, k=1):
+        """
+        Look up the thicknesses whose spectra are closest to measured_r.
+
+        input
+        ======
+
+        measured_r: array
+            one spectrum (num_wavelengths,) or many (num_spectra,
+            num_wavelengths), normalized the same way as the library
+        wavelengths: array
+            wavelengths of measured_r if they differ from the library's;
+            the spectra are then interpolated onto the library grid
+        k: int
+            number of neighbours. For k > 1 the estimate is the
+            inverse-distance weighted mean of the neighbours' thicknesses.
+
+        output
+        ======
+
+        dict
+            d: thickness estimate(s) for the fitted layers, in nm
+            distance: distance to the nearest library entry in PCA space
+            index: flat grid index of the nearest entry
+
+        """
+        measured_r = np.asarray(measured_r, dtype=float)
+        single = measured_r.ndim == 1
+        measured_r = np.atleast_2d(measured_r)
+        if wavelengths is not None:
+            measured_r = np.vstack([np.interp(self.lam_vac_list, wavelengths, r)
+                                    for r in measured_r])
+        coeffs = np.dot(measured_r - self.mean, self.components.T)
+        distance, index = self.tree.query(coeffs, k=k)
+        if k == 1:
+            d = self.thicknesses(index)
+            nearest_distance, nearest_index = distance, index
+        else:
+            weights = 1 / np.maximum(distance, 1e-12)
+            d = (np.sum(self.thicknesses(index) * weights[..., None], axis=1)
+                 / weights.sum(axis=1)[:, None])
+            nearest_distance, nearest_index = distance[:, 0], index[:, 0]
+        if single:
+            d, nearest_distance, nearest_index = (
+                d[0], nearest_distance[0], nearest_index[0])
+        return {'d': d, 'distance': nearest_distance, 'index': nearest_index}
+
+    def save(self, path):
+        """
+        Write the library to a compressed .npz file.
+        """
+        arrays = {'axis_{}'.format(i): axis for i, axis in enumerate(self.axes)}
+        if self.reference is not None:
+            arrays['reference'] = self.reference
+        np.savez_compressed(path, d_list=self.d_list,
+                            fit_layers=self.fit_layers,
+                            lam_vac_list=self.lam_vac_list, mean=self.mean,
+                            components=self.components, coeffs=self.coeffs,
+                            th_0=self.th_0, pol=self.pol, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a library written by save(); the KD-tree is rebuilt on load.
+        """
+        with np.load(path) as data:
+            axes = [data['axis_{}'.format(i)]
+                    for i in range(data['fit_layers'].size)]
+            reference = data['reference'] if 'reference' in data else None
+            return cls(data['d_list'], data['fit_layers'], axes,
+                       data['lam_vac_list'], data['mean'], data['components'],
+                       data['coeffs'], reference=reference,
+                       th_0=float(data['th_0']), pol=str(data['pol']))
@@ -0,0 +1,314 @@
+"""
+Process-local metrics in the Prometheus text exposition format, served
+at /metrics. Self-contained: no client library or push gateway, a scraper
+or curl reading /metrics is all that is needed.
+
+Counters and histograms are updated where things happen (timing.timed,
+the TMM calls in spectra, the request hooks installed by init_app);
+gauges such as cache statistics are read from their source when /metrics
+is scraped.
+Values are per process, so with several workers each has its own.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value))
+                          for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base of the metric types: a name, help text and a fixed set of label
+    names; values are kept per combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(
+                self.name, ', '.join(self.labelnames) or 'none'))
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        (name, labels, value) tuples, labels as (name, value) pairs
+        """
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With a callback, the value is read from
+    it at scrape time instead: callback() returns [(labels dict, value)].
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        return [(self.name, self._key(labels), value)
+                for labels, value in self.callback()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            states = [(key, list(state[0]), state[1], state[2])
+                      for key, state in self._values.items()]
+        samples = []
+        for key, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket',
+                                key + (('le', _format_value(bound)),),
+                                cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, count))
+        return samples
+
+
+class Registry:
+    """
+    The metrics rendered at /metrics, in registration order.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('Metric {} already registered'.format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# Read at scrape time. Modules that were never imported have nothing to
+# report, and a scrape must not import them (spectra pulls in scipy etc).
+
+def _cache_stats():
+    spectra = sys.modules.get('app.spectra')
+    if spectra is None:
+        return []
+    return [(name, getattr(spectra, name).cache_info())
+            for name in ('material_fn', 'material_nk')]
+
+def _cache_requests():
+    samples = []
+    for cache, info in _cache_stats():
+        samples.append(({'cache': cache, 'result': 'hit'}, info.hits))
+        samples.append(({'cache': cache, 'result': 'miss'}, info.misses))
+    return samples
+
+def _cache_hit_ratio():
+    return [({'cache': cache}, info.hits / (info.hits + info.misses))
+            for cache, info in _cache_stats() if info.hits + info.misses]
+
+def _export_jobs():
+    exports = sys.modules.get('app.exports')
+    return [({}, len(exports.export_store) if exports is not None else 0)]
+
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'theospec_request_duration_seconds',
+    'Latency of timed requests (simulator callbacks, API calls), by name.',
+    ['name']))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'theospec_request_stage_duration_seconds',
+    'Time spent in each stage of timed requests.', ['name', 'stage']))
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    'theospec_http_request_duration_seconds',
+    'HTTP request latency by endpoint, method and status.',
+    ['endpoint', 'method', 'status']))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'theospec_http_requests_in_flight', 'HTTP requests being served.'))
+TMM_EVALUATIONS = REGISTRY.register(Counter(
+    'theospec_tmm_evaluations_total',
+    'Spectra computed by the transfer-matrix engine; use rate() for per '
+    'second.'))
+TMM_WAVELENGTHS = REGISTRY.register(Counter(
+    'theospec_tmm_wavelengths_total',
+    'Wavelength points evaluated by the transfer-matrix engine.'))
+CACHE_REQUESTS = REGISTRY.register(Gauge(
+    'theospec_cache_requests', 'Lookups of the n,k caches since start-up '
+    'or the last clear, by result.', ['cache', 'result'],
+    callback=_cache_requests))
+CACHE_HIT_RATIO = REGISTRY.register(Gauge(
+    'theospec_cache_hit_ratio', 'Fraction of n,k cache lookups that hit.',
+    ['cache'], callback=_cache_hit_ratio))
+DB_QUERIES = REGISTRY.register(Counter(
+    'theospec_db_queries_total', 'SQL statements executed.'))
+DB_QUERIES_PER_REQUEST = REGISTRY.register(Histogram(
+    'theospec_db_queries_per_request', 'SQL statements per HTTP request.',
+    buckets=COUNT_BUCKETS))
+EXPORT_JOBS = REGISTRY.register(Gauge(
+    'theospec_export_jobs', 'Spectra matrices waiting in the export store '
+    'for download.', callback=_export_jobs))
+
+
+def count_tmm(num_spectra, num_wavelengths):
+    """
+    Record num_spectra spectra of num_wavelengths points each going
+    through the transfer-matrix engine.
+    """
+    TMM_EVALUATIONS.inc(num_spectra)
+    TMM_WAVELENGTHS.inc(num_spectra * num_wavelengths)
+
+
+def observe_timing(record):
+    """
+    Add a finished timing.timed record to the latency histograms.
+    """
+    if record['total_ms'] is not None:
+        REQUEST_SECONDS.observe(record['total_ms'] / 1e3, name=record['name'])
+    for stage_name, ms in record['stages_ms'].items():
+        STAGE_SECONDS.observe(ms / 1e3, name=record['name'], stage=stage_name)
+
+
+_local = threading.local()
+
+def _count_query(*args):
+    DB_QUERIES.inc()
+    if getattr(_local, 'queries', None) is not None:
+        _local.queries += 1
+
+def _listen_for_queries():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+def _before_request():
+    _local.queries = 0
+    _local.start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+def _after_request(response):
+    from flask import request
+    start = getattr(_local, 'start', None)
+    if start is not None:
+        HTTP_SECONDS.observe(time.perf_counter() - start,
+                             endpoint=request.endpoint or 'unmatched',
+                             method=request.method,
+                             status=str(response.status_code))
+    return response
+
+def _teardown_request(error=None):
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        DB_QUERIES_PER_REQUEST.observe(queries)
+        IN_FLIGHT.dec()
+    _local.queries = _local.start = None
+
+
+def init_app(server):
+    """
+    Collect HTTP latency and per-request SQL counts for a Flask server.
+    """
+    _listen_for_queries()
+    server.before_request(_before_request)
+    server.after_request(_after_request)
+    server.teardown_request(_teardown_request)
+
+
+def render():
+    """
+    All metrics in the Prometheus text format
+    """
+    return REGISTRY.render()
@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+
+MAX_LINE_POINTS = 2000 # about the pixel width of a wide plot
+GL_THRESHOLD = 5000 # points above which lines are drawn with WebGL
+MAX_MATRIX_SHAPE = (500, 500) # rows, columns
+HEATMAP_THRESHOLD = 20000 # matrix entries above which Contour becomes Heatmap
+DECIMALS = 5 # digits kept in the JSON; far below what a plot resolves
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a line to n_out points.
+    Keeps the first and last points, and from each bucket in between the
+    point forming the largest triangle with the previously kept point and
+    the mean of the next bucket, so peaks and fringes survive.
+
+    input
+    ======
+
+    x, y: array
+        the line, x increasing
+    n_out: int
+        number of points to keep (at least 3)
+
+    output
+    ======
+
+    numpy array
+        indices into x and y of the kept points
+
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = x.size
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < n_out - 1:
+            next_lo, next_hi = hi, edges[i + 2]
+        else:
+            next_lo, next_hi = n - 1, n
+        cx = x[next_lo:next_hi].mean()
+        cy = y[next_lo:next_hi].mean()
+        area = abs((x[a] - cx) * (y[lo:hi] - y[a])
+                   - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def block_mean(z, shape):
+    """
+    Shrink a matrix to at most shape = (rows, columns) by averaging
+    contiguous blocks. Blocks differ in size by at most one row/column when
+    the sizes don't divide evenly.
+
+    output
+    ======
+
+    tuple
+        (reduced matrix, row starts, column starts); the starts index the
+        first row/column of each block, for decimating the axes to match
+
+    """
+    z = np.asarray(z, dtype=float)
+    starts = []
+    for axis, limit in enumerate(shape):
+        size = z.shape[axis]
+        if size > limit:
+            start = np.linspace(0, size, limit, endpoint=False).astype(int)
+            counts = np.diff(np.append(start, size))
+            z = np.add.reduceat(z, start, axis=axis)
+            z = z / (counts[:, None] if axis == 0 else counts[None, :])
+        else:
+            start = np.arange(size)
+        starts.append(start)
+    return z, starts[0], starts[1]
+
+
+def _axis_means(axis, starts, size):
+    # Block centres of a coordinate axis reduced with block_mean
+    axis = np.asarray(axis, dtype=float)
+    if axis.size != size:
+        return axis
+    counts = np.diff(np.append(starts, size))
+    return np.add.reduceat(axis, starts) / counts
+
+
+def _compact(values):
+    return np.round(np.asarray(values, dtype=float), DECIMALS).tolist()
+
+
+def line_trace(x, y, name=None, max_points=MAX_LINE_POINTS,
+               gl_threshold=GL_THRESHOLD, mode='lines'):
+    """
+    Plotly trace dict for a spectrum, downsampled with lttb to max_points
+    and drawn with Scattergl when the original has more than gl_threshold
+    points.
+    """
+    kept = lttb(x, y, max_points)
+    trace = {'type': 'scattergl' if len(x) > gl_threshold else 'scatter',
+             'x': _compact(np.asarray(x)[kept]),
+             'y': _compact(np.asarray(y)[kept]),
+             'mode': mode}
+    if name is not None:
+        trace['name'] = name
+    return trace
+
+
+def matrix_trace(z, x=None, y=None, max_shape=MAX_MATRIX_SHAPE,
+                 heatmap_threshold=HEATMAP_THRESHOLD, **kwargs):
+    """
+    Plotly trace dict for a (len(y), len(x)) matrix, block-mean decimated to
+    max_shape. Small matrices stay a Contour; larger ones become a Heatmap,
+    which renders in one pass instead of tracing contour lines. Axes whose
+    length matches the matrix are averaged over the same blocks; other
+    keyword arguments are copied into the trace.
+    """
+    z = np.asarray(z, dtype=float)
+    reduced, row_starts, col_starts = block_mean(z, max_shape)
+    trace = dict(kwargs)
+    trace['type'] = 'heatmap' if z.size > heatmap_threshold else 'contour'
+    trace['z'] = _compact(reduced)
+    if x is not None:
+        trace['x'] = _compact(_axis_means(x, col_starts, z.shape[1]))
+    if y is not None:
+        trace['y'] = _compact(_axis_means(y, row_starts, z.shape[0]))
+    return trace
+
+
+def payload_bytes(figure):
+    """
+    Size in bytes of a figure once serialized to JSON for the browser.
+    """
+    import plotly
+    return len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
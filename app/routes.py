@@ -1,30 +1,32 @@
 import os
 import random
-from flask import render_template, url_for, flash, redirect, request, session
-from app import app, db, bcrypt
+from flask import (Blueprint, render_template, url_for, flash, redirect, request,
+                   session, abort, Response, stream_with_context)
+from app import db, bcrypt, metrics
 from app.models import User, Post, Material, NKValues
 from app.forms import RegistrationForm, LoginForm, PostForm, UploadForm, SimulatorForm
 from flask_login import login_user, current_user, logout_user, login_required
 from werkzeug.utils import secure_filename
-import pandas as pd
 
+main = Blueprint('main', __name__)
 
-@app.route("/")
-@app.route("/home")
+
+@main.route("/")
+@main.route("/home")
 # @login_required
 def home():
     posts = Post.query.all()
     return render_template('home.html', posts=posts)
 
-@app.route("/about")
+@main.route("/about")
 @login_required
 def about():
     return render_template('about.html')
 
-@app.route("/register", methods=['GET', 'POST'])
+@main.route("/register", methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
         hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
@@ -32,13 +34,13 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash(f'your theospec profile has been created! You are now logged in', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='Register', form=form)
 
-@app.route("/login", methods=['GET', 'POST'])
+@main.route("/login", methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
@@ -46,23 +48,23 @@ def login():
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             flash(f'Welcome! Check out the Simulator dashboard.', 'success')
-            return redirect(next_page) if next_page else redirect(url_for('home'))
+            return redirect(next_page) if next_page else redirect(url_for('main.home'))
         else:
             flash('Login Unsuccessful. Please check email and password', 'danger')
     return render_template('login.html', title='Login', form=form)
 
-@app.route("/logout")
+@main.route("/logout")
 def logout():
     logout_user()
     flash(f"You've beeen logged out.", 'success')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
-@app.route("/account")
+@main.route("/account")
 @login_required
 def account():
     return render_template('account.html', title='Account')
 
-@app.route("/post/new", methods=['GET', 'POST'])
+@main.route("/post/new", methods=['GET', 'POST'])
 def new_post():
     form = PostForm()
     if form.validate_on_submit():
@@ -70,15 +72,19 @@ def new_post():
         db.session.add(post)
         db.session.commit()
         flash('Your post has been created!', 'success')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     return render_template('create_post.html', title='New Post', form=form)
 
 
-@app.route('/upload', methods=['GET', 'POST'])
+@main.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
     form = UploadForm()
     if form.validate_on_submit():
+        # pandas and scipy (via spectra) are only needed here; importing
+        # them lazily keeps them out of app start-up
+        import pandas as pd
+        from app.spectra import clear_material_cache
         material = Material(name=form.material.data)
         db.session.add(material)
         db.session.commit()
@@ -96,11 +102,12 @@ def upload():
                                 material_id = material.id)
             db.session.add(nk_values)
         db.session.commit()
+        clear_material_cache()
         flash("Upload successful!", "success")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     return render_template('upload.html', form=form)
 
-@app.route("/simulator", methods=['GET', 'POST'])
+@main.route("/simulator", methods=['GET', 'POST'])
 @login_required
 def simulator():
     # form = SimulatorForm()
@@ -114,10 +121,40 @@ def simulator():
     return redirect(url_for('/data/'))
     # return render_template('simulator.html', form=form)
 
-@app.route('/simulator/dashboard', methods=['GET', 'POST'])
+@main.route('/simulator/dashboard', methods=['GET', 'POST'])
 def test():
     medium = session['medium']
     active_layers = session['active_layers']
     trench_layers = session['trench_layers']
     pattern_density = float(session['pattern_density'])
     return str([medium, active_layers, trench_layers, pattern_density])
+
+
+@main.route('/export/<job_id>.<file_format>')
+def export_spectra(job_id, file_format):
+    """
+    Stream a spectra matrix registered by the simulator as CSV, npz or
+    Parquet. Nothing is written on the server.
+    """
+    from app.exports import EXPORT_FORMATS, export_store, iter_export
+    job = export_store.get(job_id)
+    if job is None or file_format not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        chunks = iter_export(job, file_format)
+    except ImportError:
+        abort(501)
+    filename = 'spectra_matrix_{}.{}'.format(job_id[:8], file_format)
+    return Response(stream_with_context(chunks), 
+                    mimetype=EXPORT_FORMATS[file_format],
+                    headers={'Content-Disposition': 
+                             'attachment; filename={}'.format(filename)})
+
+
+@main.route('/metrics')
+def prometheus_metrics():
+    """
+    Metrics of this process in the Prometheus text format, for a scraper
+    or curl.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -1,6 +1,6 @@
 import ast
 import itertools
-import time
+import logging
 import numpy as np
 import dash
 import dash_core_components as dcc
@@ -9,17 +9,23 @@ from flask import Flask, render_template
 import pandas as pd
 import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State
-from scipy.interpolate import interp1d
-from .core_tmm import calc_reflectances
+from .exports import export_store
+from .payload import line_trace, matrix_trace, payload_bytes
+from .spectra import SPECTRAL_GRID, combined_spectrum_adaptive, polish_spectra_matrix
+from .timing import stage, timed
 
-from app import app, db
 from app.models import User, Post, Material, NKValues
 
 
+logger = logging.getLogger(__name__)
+
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
+# Dash makes its own Flask server; app.LazySimulator runs this module once
+# per app (see app.load_simulator), configures the server like the main app
+# and serves it under /data/ once the simulator is first requested
 simulator = dash.Dash(name='simulator', external_stylesheets=external_stylesheets, 
-                      sharing=True, server=app, url_base_pathname='/data/')
+                      url_base_pathname='/data/')
 
 simulator.config['suppress_callback_exceptions']=True
 simulator.title = 'Simulator'
@@ -678,9 +684,7 @@ def stack_calc(values):
         films = dram_films + films[2:]
         thks = dram_thks + thks[2:]
     
-    print('VALUE: {}'.format(values))
-    print ('STACK CALC FILMS: {}'.format(films))
-    print ('STACK CLAC THKS: {}'.format(thks))
+    logger.debug('Stack values %s: films %s, thicknesses %s', values, films, thks)
 
 
     return str(films) + '*' + str(thks) #data to be parsed from hidden div-- split on "*"
@@ -1071,297 +1075,226 @@ def create_data_container(n_clicks, n_active, n_trench, active_stack_type, trenc
             n_active = n_active + 2
         if trench_stack_type == 'nand':
             n_trench = n_trench + 2
-        print(generate_data_output_id(n_active, n_trench))
+        logger.debug(generate_data_output_id(n_active, n_trench))
         return html.Div(id=generate_data_output_id(n_active, n_trench))
 
-def get_nkvals(mat_name):
-    mat_id = Material.query.filter_by(name=mat_name).first().id
-    nk_vals = NKValues.query.filter_by(material_id=mat_id).all()
-    df = pd.DataFrame([(d.wavelength, d.n_value, d.k_value) for d in nk_vals], 
-                  columns=['wavelength', 'n', 'k'])
-    df['nk'] = df['n'] + (1j * df['k'])
-    ### Handle nm from data instead of Angstrom
-    ## TODO- make more robust
-    if df.wavelength.min() > 1000:
-        df['wavelength'] = df.wavelength /10
-    return df
-
-def compute_reflectance_1d(mat_names, thicknesses, medium):
-    """
-    Compute reflectances of given film stack for fixed stack thickness
-
-    input
-    ======
-
-    mat_names: list
-        string names of film type
-    thicknesses: list
-        int values of film thicknesses in Angstroms
-    medium: float
-        index of refraction of medium on top of stack (air, water, etc)
-
-    output
-    ======
-
-    pandas DataFrame
-        columns: wavelength, reflectance
+COARSE_TOL = 1e-2 # interpolation error allowed in the unzoomed r-spectra plot
+COARSE_POINTS = 400
+REFINED_TOL = 1e-4 # ... and inside a zoomed window
+REFINED_POINTS = 4000
 
+def r_spectra_figure(spectra, x_range=None):
     """
-
-    mat_fns = []
-    for mat in mat_names:
-        mat_df = get_nkvals(mat)
-        mat_fn = interp1d(mat_df.wavelength, mat_df.nk, kind='linear')
-        mat_fns.append(mat_fn)
-    medium_fn = lambda wavelength: medium
-    si_df = get_nkvals('Si') ## change to make film passable
-    si_fn = interp1d(si_df.wavelength, si_df.nk, kind='linear')
-    reflectance = calc_reflectances(n_fn_list=[medium_fn] + mat_fns + [si_fn], 
-                                    d_list=[np.inf] + thicknesses + [np.inf], 
-                                    th_0=0, 
-                                    spectral_range=(260, 1700))
-    r_df = pd.DataFrame(reflectance, columns=['wavelength', 'r'])
-    return r_df
-
-def compute_reflectance_2d(active_names, active_thicknesses, trench_names, trench_thicknessness, 
-                          rr, medium):
+    Figure for the r-spectra tab from a (wavelength, reflectance) array.
+    x_range keeps a zoomed window in place when the figure is replaced.
     """
-    Compute reflectances of given film stack for variable thicknesses
-
-    input
-    ======
-
-    mat_names: list
-        string names of film type
-    thicknesses: list
-        int values of film thicknesses in Angstroms
-    rr: numeric
-        removal rate in A/min
-    medium: float
-        index of refraction of medium on top of stack (air, water, etc)
-
-    output
-    ======
-
-    pandas DataFrame
-        columns: wavelength, reflectance
+    return {
+        'data': [line_trace(spectra[:,0], spectra[:,1], name='Reflectance')],
+        'layout': go.Layout(
+            xaxis=dict(
+                title='wavelength',
+                range=x_range
+                ),
+            yaxis=dict(
+                title='computed intensity',
+                # range=[0, 2]
+                )
+            )
+        }
 
+def zoom_window(relayout_data):
     """
-    a_s = rr / 60 # removal rate in A/s
-    top_layer = active
-
-    active_fns = []
-    trench_fns = []
-    for mat_names, n_fn_list in zip((active_names, trench_names), (active_fns, trench_fns)):
-        for mat in mat_names:
-            mat_df = get_nkvals(mat)
-            mat_fn = interp1d(mat_df.wavelength, mat_df.nk, kind='linear')
-            fns.append(mat_fn)
-    medium_fn = lambda wavelength: medium
-    si_df = get_nkvals('Si') ## change to make film passable
-    si_fn = interp1d(si_df.wavelength, si_df.nk, kind='linear')
-
-    reflectance = calc_reflectances(n_fn_list=[medium_fn] + mat_fns + [si_fn], 
-                                    d_list=[np.inf] + current_thicknesses + [np.inf], 
-                                    th_0=0, 
-                                    spectral_range=(260, 1700))
-    r_df = pd.DataFrame(reflectance, columns=['wavelength', '0s'])
-
-
-    for sec in range(active_thicknesses[-1]/a_s): #
-        thk_by_pol_time = thicknesses[:-1] + [thicknesses[-1] - sec*a_s]
-        r_by_pol_time = calc_reflectances(n_fn_list=[medium_fn] + mat_fns + [si_fn], 
-                                        d_list=[np.inf] + thk_by_pol_time + [np.inf], 
-                                        th_0=0, 
-                                        spectral_range=(260, 1700))
-        r_df['{}s'.format(sec)] = r_by_pol_time[:,1]
-    return r_df
-
-def combine_spectra(active_r, trench_r, pattern_density, medium):
-    
-    """ 
-    Compute aggregate spectra from active and trench reflectance 
-    as a function of pattern_density
-
-    input
-    ------
-    
-    active_r: pandas Dataframe with columns wavelength and r
-
-    trench_r: pandas Dataframe with columns wavelength and r
-
-    pattern_density: float, fraction of pattern mask containing active sites
-                     (between 0 and 1)
-
-    output
-    -------
-    numpy array, computed reflectance with columns 0 and 1 as wavelength 
-    and reflectance respectively
-        
+    (min, max) wavelength of the visible x range from a graph's
+    relayoutData, 'reset' when the user zooms back out, None otherwise
+    (e.g. a y-only zoom or the initial autosize event)
     """
-
-    base_reflectance = trench_r.copy().values
-    ref_si = compute_reflectance_1d(['Si'], [50000], medium)
-
-    np.multiply(base_reflectance[:,1], (1 - (pattern_density/100)), base_reflectance[:,1])
-    np.add(base_reflectance[:,1], active_r.r*(pattern_density/100), base_reflectance[:,1])
-    np.divide(base_reflectance[:,1], ref_si.r, base_reflectance[:,1])
-
-    return base_reflectance
-
-
+    if not relayout_data:
+        return None
+    if relayout_data.get('xaxis.autorange'):
+        return 'reset'
+    if 'xaxis.range[0]' in relayout_data:
+        lo, hi = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        lo, hi = relayout_data['xaxis.range']
+    else:
+        return None
+    return (min(float(lo), float(hi)), max(float(lo), float(hi)))
 
 def generate_callback(n1, n2):
     def callback_data(x1, x2, tab, medium, pattern_density, rr):
+        # Stages not marked here (nk_fetch, interpolation, tmm) are recorded
+        # by spectra
+        with timed('simulator.spectra', tab=tab) as timer:
+
+            with stage('parse'):
+                active_films = ast.literal_eval(x1.split('*')[0])
+                active_thks = [x/10 for x in ast.literal_eval(x1.split('*')[1])] # convert to nm for calc
+
+                trench_films = ast.literal_eval(x2.split('*')[0]) # convert to nm for calc
+                trench_thks = [x/10 for x in ast.literal_eval(x2.split('*')[1])] # convert to nm for calc
+            logger.debug('Active films %s, thicknesses %s; trench films %s, '
+                         'thicknesses %s', active_films, active_thks, 
+                         trench_films, trench_thks)
+
+
+            if tab == 'r-spectra':
+
+                # active_films = ast.literal_eval(x1.split('*')[0])
+                # active_thks = ast.literal_eval(x1.split('*')[1])
+                # active_r = compute_reflectance_1d(active_films, active_thks, medium)
+
+                # trench_films = ast.literal_eval(x2.split('*')[0])
+                # trench_thks = ast.literal_eval(x2.split('*')[1])
+                # trench_r = compute_reflectance_1d(trench_films, trench_thks, medium)
+
+                # combined_spectra = combine_spectra(active_r, trench_r, pattern_density, medium)
+
+
+                # Coarse over the whole range first; zooming refines the
+                # visible window (see refine_r_spectra)
+                with stage('combine'):
+                    coarse_spectra = combined_spectrum_adaptive(
+                        active_films, active_thks, trench_films, trench_thks,
+                        pattern_density, medium, tol=COARSE_TOL, max_points=COARSE_POINTS)
+                logger.debug('Combined spectra: %s', coarse_spectra[:5])
+                stack_spec = [active_films, active_thks, trench_films, trench_thks,
+                              medium, pattern_density]
+                with stage('figure'):
+                    figure = r_spectra_figure(coarse_spectra)
+                graph = html.Div([
+                        dcc.Graph(
+                            id='r-spectra-graph',
+                            figure=figure
+                        ),
+                        html.Div(str(stack_spec), id='r-spectra-stack', 
+                                 style={'display':'none'})
+                    ])
+                timer.fields['points'] = len(coarse_spectra)
+            elif tab == 'contour':
+                rr = int(rr)
 
-        t_start = time.perf_counter()
-
-        active_films = ast.literal_eval(x1.split('*')[0])
-        active_thks = [x/10 for x in ast.literal_eval(x1.split('*')[1])] # convert to nm for calc
-        active_r = compute_reflectance_1d(active_films, active_thks, medium)
-
-
-        trench_films = ast.literal_eval(x2.split('*')[0]) # convert to nm for calc
-        trench_thks = [x/10 for x in ast.literal_eval(x2.split('*')[1])] # convert to nm for calc
-        trench_r = compute_reflectance_1d(trench_films, trench_thks, medium)
-
-        combined_spectra = combine_spectra(active_r, trench_r, pattern_density, medium)
-
-
-        if tab == 'r-spectra':
-
-            # active_films = ast.literal_eval(x1.split('*')[0])
-            # active_thks = ast.literal_eval(x1.split('*')[1])
-            # active_r = compute_reflectance_1d(active_films, active_thks, medium)
-
-            # trench_films = ast.literal_eval(x2.split('*')[0])
-            # trench_thks = ast.literal_eval(x2.split('*')[1])
-            # trench_r = compute_reflectance_1d(trench_films, trench_thks, medium)
-
-            # combined_spectra = combine_spectra(active_r, trench_r, pattern_density, medium)
-
-
-            t_end = time.perf_counter()
-            print("CALC TIME:    ", (t_end - t_start), "SECONDS")
-            print('Active films: {}'.format(active_films))
-            print('Active thks: {}'.format(active_thks))
-            print('Combined spectra:{}'.format(combined_spectra[:,:5]))
-            graph = html.Div([
-                    dcc.Graph(
-                        figure={
-                            'data': [
-                                {
-                                    'x':combined_spectra[:,0],
-                                    'y':combined_spectra[:,1],
-                                    'mode': 'line',
-                                    'name': 'Reflectance'
-                                }
-                            ],
-                            'layout': go.Layout(
-                                xaxis=dict(
-                                    title='wavelength',
-                                    # range=[200, 1000]
-                                    ),
-                                yaxis=dict(
-                                    title='computed intensity',
-                                    # range=[0, 2]
-                                    )
-                                )
-                            },
-                    )
-                ])
-        elif tab == 'contour':
-            rr = int(rr)
-
-            # active_films = ast.literal_eval(x1.split('*')[0]) # convert to nm for calc
-            # active_thks = [x/10 for x in ast.literal_eval(x1.split('*')[1])] # convert to nm for calc
-            # active_r = compute_reflectance_1d(active_films, active_thks, medium)
+                # active_films = ast.literal_eval(x1.split('*')[0]) # convert to nm for calc
+                # active_thks = [x/10 for x in ast.literal_eval(x1.split('*')[1])] # convert to nm for calc
+                # active_r = compute_reflectance_1d(active_films, active_thks, medium)
 
 
-            # trench_films = ast.literal_eval(x2.split('*')[0]) # convert to nm for calc
-            # trench_thks = [x/10 for x in ast.literal_eval(x2.split('*')[1])] # convert to nm for calc
-            # trench_r = compute_reflectance_1d(trench_films, trench_thks, medium)
+                # trench_films = ast.literal_eval(x2.split('*')[0]) # convert to nm for calc
+                # trench_thks = [x/10 for x in ast.literal_eval(x2.split('*')[1])] # convert to nm for calc
+                # trench_r = compute_reflectance_1d(trench_films, trench_thks, medium)
 
-            # spectra_matrix = combine_spectra(active_r, trench_r, pattern_density, medium)
+                # spectra_matrix = combine_spectra(active_r, trench_r, pattern_density, medium)
             
-            rr_as = rr / 60 # removal rate in A/s
-            rr_nm = (rr / 10) / 60 # removal rate in nm/s
-
-            # setting rr for testing purposes
-            rr_nms = 10000 / 10 / 60
-
-            t_start = time.perf_counter()
-            print(active_thks[-1])
-            starting_thk_active = active_thks[-1] # in nm
-            starting_thk_trench = trench_thks[-1] # in nm
-
-            # pol_time = int(starting_thk_active/rr_nms)
-            # setting explicit int for testing
-            pol_time = 7
-
-            full_matrix = np.zeros((combined_spectra.shape[0], pol_time))
-
-            for sec in range(pol_time):
-                active_thks_sim = active_thks[:-1] + [(starting_thk_active - sec*rr_nms)]
-                active_r_sim = compute_reflectance_1d(active_films, active_thks_sim, medium)
-
-                trench_thks_sim = trench_thks[:-1] + [(starting_thk_trench - sec*rr_nms)]
-                trench_r_sim = compute_reflectance_1d(trench_films, trench_thks_sim, medium)
-
-                combined_spectra = combine_spectra(active_r_sim, trench_r_sim, pattern_density, medium)
-                # spectra_matrix = np.hstack((spectra_matrix, combined_spectra[:,1]))
-                # full_matrix.append(combined_spectra[:,1])
-                # full_matrix[:, sec] = active_r_sim.r.values
-                full_matrix[:, sec] = combined_spectra[:,1]
-
-            t_stop = time.perf_counter()
-
-            print('Comp time: {:.2f}'.format(t_stop - t_start))
-
-            # for x axis labels
-            pol_time = active_thks[-1] / rr_nm
-            print('Active thks: {}'.format(active_thks[-1]))
-            print('RR nm/s: {}'.format(rr_nm))
-            print('pol time: {}'.format(pol_time))
-            x_labels = list(range(0, int(pol_time), full_matrix.shape[1])),
-            print('x-labels: {}'.format(x_labels))
-            print('full-matrix-shape: {}'.format(full_matrix.shape))
-
-            graph = html.Div([
-                        dcc.Graph(
-                            figure={
-                                'data': [
-                                    go.Contour(
-                                        z=np.array(full_matrix),
-                                        # x=list(range(int((active_thks[-1]/rr_as) * 60))), # testing rr_nms
-                                        # x=list(range(0, int(pol_time), full_matrix.shape[1])),
-                                        x=[0, 10, 20, 30, 40, 50],
-                                        y=combined_spectra[:,0],
-                                        colorscale='Jet',
-                                        contours=dict(
-                                            coloring='heatmap'
-                                        )
-                                    )
-                                ],
-                                'layout': go.Layout(
-                                    xaxis=dict(
-                                        title='Polish Time (s)',
-                                        # range=[200, 1000]
-                                        ),
-                                    yaxis=dict(
-                                        title='Wavelength',
-                                        # range=[0, 2]
-                                        )
-                                    )
-                            },
-                    )
-                ])
-            pd.DataFrame(full_matrix).to_csv('spectra_matrix.csv')
-        
-        return graph
+                rr_as = rr / 60 # removal rate in A/s
+                rr_nm = (rr / 10) / 60 # removal rate in nm/s
+
+                # setting rr for testing purposes
+                rr_nms = 10000 / 10 / 60
+
+                # pol_time = int(active_thks[-1]/rr_nms)
+                # setting explicit int for testing
+                pol_time = 7
+
+                full_matrix = polish_spectra_matrix(
+                    active_films, active_thks, trench_films, trench_thks,
+                    pattern_density, medium, rr_nms, pol_time)
+
+                # for x axis labels
+                pol_time = active_thks[-1] / rr_nm
+                x_labels = list(range(0, int(pol_time), full_matrix.shape[1])),
+                logger.debug('Polish: %s nm/s for %s s, x-labels %s, matrix %s', 
+                             rr_nm, pol_time, x_labels, full_matrix.shape)
+
+                timer.fields['matrix_shape'] = list(full_matrix.shape)
+                with stage('figure'):
+                    # Decimated to screen size; large matrices are sent as a Heatmap
+                    trace = matrix_trace(full_matrix,
+                                         # x=list(range(int((active_thks[-1]/rr_as) * 60))), # testing rr_nms
+                                         # x=list(range(0, int(pol_time), full_matrix.shape[1])),
+                                         # one column per second of polish
+                                         x=list(range(full_matrix.shape[1])),
+                                         # the matrix rows are the SPECTRAL_GRID wavelengths
+                                         y=SPECTRAL_GRID.wavelengths,
+                                         colorscale='Jet')
+                    if trace['type'] == 'contour':
+                        trace['contours'] = dict(coloring='heatmap')
+                    figure = {
+                                        'data': [trace],
+                                        'layout': go.Layout(
+                                            xaxis=dict(
+                                                title='Polish Time (s)',
+                                                # range=[200, 1000]
+                                                ),
+                                            yaxis=dict(
+                                                title='Wavelength',
+                                                # range=[0, 2]
+                                                )
+                                            )
+                                    }
+                # Kept in memory under a per-job id; files are only produced
+                # when a download link is followed
+                job_id = export_store.register(full_matrix, SPECTRAL_GRID.wavelengths,
+                                               np.arange(full_matrix.shape[1]))
+                graph = html.Div([
+                    dcc.Graph(figure=figure),
+                    html.Div(
+                        ['Export: '] + [
+                            html.A(file_format, 
+                                   href='/export/{}.{}'.format(job_id, file_format),
+                                   style={'marginRight': '10'})
+                            for file_format in ('csv', 'npz', 'parquet')],
+                        style={'textAlign': 'right'})
+                    ])
+            else:
+                raise dash.exceptions.PreventUpdate
+
+            with stage('serialize'):
+                timer.fields['payload_bytes'] = payload_bytes(figure)
+            return graph
     return callback_data
 
 
+@simulator.callback(
+    Output('r-spectra-graph', 'figure'),
+    [Input('r-spectra-graph', 'relayoutData')],
+    [State('r-spectra-stack', 'children')]
+)
+def refine_r_spectra(relayout_data, stack_spec):
+    """
+    Recompute the r-spectra plot when it is zoomed or panned: adaptive
+    samples at REFINED_TOL inside the visible window only, or the coarse
+    full-range spectrum again when the zoom is reset.
+    """
+    window = zoom_window(relayout_data)
+    if window is None or not stack_spec:
+        raise dash.exceptions.PreventUpdate
+    with timed('simulator.refine', window=window) as timer:
+        with stage('parse'):
+            (active_films, active_thks, trench_films, trench_thks, medium, 
+             pattern_density) = ast.literal_eval(stack_spec)
+        if window == 'reset':
+            with stage('combine'):
+                spectra = combined_spectrum_adaptive(
+                    active_films, active_thks, trench_films, trench_thks,
+                    pattern_density, medium, tol=COARSE_TOL, 
+                    max_points=COARSE_POINTS)
+            x_range = None
+        else:
+            try:
+                with stage('combine'):
+                    spectra = combined_spectrum_adaptive(
+                        active_films, active_thks, trench_films, trench_thks,
+                        pattern_density, medium, window=window, 
+                        tol=REFINED_TOL, max_points=REFINED_POINTS)
+            except ValueError: # zoomed entirely outside the computed range
+                raise dash.exceptions.PreventUpdate
+            x_range = list(window)
+        with stage('figure'):
+            figure = r_spectra_figure(spectra, x_range=x_range)
+        with stage('serialize'):
+            timer.fields['payload_bytes'] = payload_bytes(figure)
+        timer.fields['points'] = len(spectra)
+    return figure
+
 @simulator.callback(
     Output('dummy-graph', 'style'),
     [Input('data-output', 'children')]
@@ -0,0 +1,561 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+from .core_tmm import (CompiledStack, adaptive_spectrum, calc_reflectances, coh_tmm_batch,
+                       coh_tmm_spectrum, inc_tmm_spectrum)
+from .fitting import fit_thicknesses
+from .grids import DEFAULT_GRID, as_grid
+from .metrics import count_tmm
+from .timing import stage
+
+from app.models import Material, NKValues
+
+SPECTRAL_GRID = DEFAULT_GRID # wavelengths the simulator shows, nm
+
+def get_nkvals(mat_name):
+    with stage('nk_fetch'):
+        material = Material.query.filter_by(name=mat_name).first()
+        if material is None:
+            raise ValueError('Unknown material: {}'.format(mat_name))
+        mat_id = material.id
+        nk_vals = NKValues.query.filter_by(material_id=mat_id).all()
+    df = pd.DataFrame([(d.wavelength, d.n_value, d.k_value) for d in nk_vals], 
+                  columns=['wavelength', 'n', 'k'])
+    df['nk'] = df['n'] + (1j * df['k'])
+    ### Handle nm from data instead of Angstrom
+    ## TODO- make more robust
+    if df.wavelength.min() > 1000:
+        df['wavelength'] = df.wavelength /10
+    return df
+
+@lru_cache(maxsize=None)
+def material_fn(mat_name):
+    """
+    Interpolated n,k of a material as a function of wavelength in nm.
+    Cached, so the database is queried once per material for the life of
+    the process and every stack using a material shares the same function
+    object (which lets CompiledStack evaluate it once per wavelength).
+    """
+    mat_df = get_nkvals(mat_name)
+    with stage('interpolation'):
+        return interp1d(mat_df.wavelength, mat_df.nk, kind='linear')
+
+@lru_cache(maxsize=256)
+def material_nk(mat_name, grid):
+    """
+    n,k of a material sampled on a grids.WavelengthGrid. Cached per
+    (material, grid), so a stack evaluated again on the same grid skips the
+    interpolation. The returned array is read-only.
+    """
+    fn = material_fn(mat_name)
+    with stage('interpolation'):
+        nk = np.asarray(fn(grid.wavelengths), dtype=complex)
+    nk.flags.writeable = False
+    return nk
+
+def clear_material_cache():
+    """
+    Forget cached n,k data, e.g. after materials are uploaded
+    """
+    material_fn.cache_clear()
+    material_nk.cache_clear()
+
+def compute_reflectance_1d(mat_names, thicknesses, medium, incoherent=None,
+                           grid=None):
+    """
+    Compute reflectances of given film stack for fixed stack thickness
+
+    input
+    ======
+
+    mat_names: list
+        string names of film type
+    thicknesses: list
+        int values of film thicknesses in Angstroms
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    incoherent: list
+        optional positions in mat_names of films thick enough (glass,
+        bonded wafers, ...) that interference in them averages out; they
+        are treated incoherently
+    grid: grids.WavelengthGrid
+        wavelengths to compute, default SPECTRAL_GRID (anything
+        grids.as_grid accepts also works)
+
+    output
+    ======
+
+    pandas DataFrame
+        columns: wavelength, reflectance
+
+    """
+
+    grid = SPECTRAL_GRID if grid is None else as_grid(grid)
+    mat_fns = [material_fn(mat) for mat in mat_names]
+    medium_fn = lambda wavelength: medium
+    si_fn = material_fn('Si') ## change to make film passable
+    c_list = None
+    if incoherent:
+        c_list = ['i'] + ['i' if i in incoherent else 'c'
+                          for i in range(len(mat_names))] + ['i']
+    count_tmm(1, len(grid))
+    with stage('tmm'):
+        reflectance = calc_reflectances(n_fn_list=[medium_fn] + mat_fns + [si_fn], 
+                                        d_list=[np.inf] + list(thicknesses) + [np.inf], 
+                                        th_0=0, 
+                                        spectral_range='full',
+                                        c_list=c_list,
+                                        grid=grid)
+    r_df = pd.DataFrame(reflectance, columns=['wavelength', 'r'])
+    return r_df
+
+def compute_reflectance_batch(mat_names, thickness_sets, medium, grid=None):
+    """
+    Compute reflectances of one film stack at many sets of thicknesses,
+    e.g. every step of a polish
+
+    input
+    ======
+
+    mat_names: list
+        string names of film type
+    thickness_sets: list
+        one list of film thicknesses (nm) per spectrum
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    grid: grids.WavelengthGrid
+        wavelengths to compute, default SPECTRAL_GRID as in
+        compute_reflectance_1d
+
+    output
+    ======
+
+    numpy array
+        (len(thickness_sets), n_wavelengths) reflectances on the grid
+
+    """
+    grid = SPECTRAL_GRID if grid is None else as_grid(grid)
+    stack = CompiledStack([medium] + [material_fn(mat) for mat in mat_names]
+                          + [material_fn('Si')],
+                          [np.inf] + [0] * len(mat_names) + [np.inf])
+    with stage('interpolation'):
+        stack.n_array(grid.wavelengths) # cached for reflectance_batch
+    count_tmm(len(thickness_sets), len(grid))
+    with stage('tmm'):
+        return stack.reflectance_batch(thickness_sets, grid.wavelengths)
+
+def compute_reflectance_many(stack_specs, medium, grid=None, th_0=0, pol='s',
+                             relative_to_si=False):
+    """
+    Compute reflectances of many film stacks in one call. Stacks with the
+    same films (in the same order) are evaluated together in one
+    vectorized batch, whatever their thicknesses.
+
+    input
+    ======
+
+    stack_specs: list
+        one (mat_names, thicknesses) or (mat_names, thicknesses, incoherent)
+        tuple per stack, thicknesses in nm, incoherent as in
+        compute_reflectance_1d
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    grid: grids.WavelengthGrid
+        wavelengths to compute, default SPECTRAL_GRID
+    th_0: float
+        angle of incidence in the medium, radians
+    pol: str
+        's' or 'p'
+    relative_to_si: bool
+        divide by bare Si, like the simulator's spectra
+
+    output
+    ======
+
+    numpy array
+        (len(stack_specs), n_wavelengths) reflectances, in input order
+
+    """
+    grid = SPECTRAL_GRID if grid is None else as_grid(grid)
+    R = np.empty((len(stack_specs), len(grid)))
+    for (mat_names, incoherent), rows in group_stacks(stack_specs).items():
+        d_array = np.full((len(rows), len(mat_names) + 2), np.inf)
+        d_array[:, 1:-1] = [stack_specs[i][1] for i in rows]
+        R[rows] = group_reflectance(stack_nk(mat_names, medium, grid), d_array,
+                                    incoherent, grid.wavelengths, th_0, pol)
+    if relative_to_si:
+        n_array = stack_nk([], medium, grid)
+        count_tmm(1, len(grid))
+        with stage('tmm'):
+            R /= coh_tmm_spectrum(pol, n_array, [np.inf, np.inf], th_0, 
+                                  grid.wavelengths)['R']
+    return R
+
+def group_stacks(stack_specs):
+    """
+    Group stacks by structure, for evaluation with group_reflectance.
+
+    input
+    ======
+
+    stack_specs: list
+        (mat_names, thicknesses) or (mat_names, thicknesses, incoherent)
+        tuples, as in compute_reflectance_many
+
+    output
+    ======
+
+    dict
+        {(mat_names, incoherent): [indices into stack_specs]}, both keys
+        tuples, incoherent sorted
+
+    """
+    groups = {}
+    for i, spec in enumerate(stack_specs):
+        mat_names, thicknesses = spec[0], spec[1]
+        incoherent = tuple(sorted(spec[2])) if len(spec) > 2 and spec[2] else ()
+        if len(mat_names) != len(thicknesses):
+            raise ValueError('Need one thickness per film (stack {})'.format(i))
+        if any(not 0 <= j < len(mat_names) for j in incoherent):
+            raise ValueError('Incoherent film positions must be between 0 and '
+                             '{} (stack {})'.format(len(mat_names) - 1, i))
+        groups.setdefault((tuple(mat_names), incoherent), []).append(i)
+    return groups
+
+def group_reflectance(n_array, d_array, incoherent, lam_vac_list, th_0=0, 
+                      pol='s'):
+    """
+    Reflectances of one structure at many sets of thicknesses.
+
+    input
+    ======
+
+    n_array: array
+        (num_films + 2, n_wavelengths) refractive indices, as from stack_nk
+    d_array: array
+        (num_stacks, num_films + 2) thicknesses in nm, each row starting and
+        ending with inf
+    incoherent: tuple
+        film positions treated incoherently; coherent stacks go through
+        coh_tmm_batch in one call, others through inc_tmm_spectrum per row
+
+    output
+    ======
+
+    numpy array
+        (num_stacks, n_wavelengths) reflectances
+
+    """
+    count_tmm(d_array.shape[0], len(lam_vac_list))
+    with stage('tmm'):
+        if not incoherent:
+            return coh_tmm_batch(pol, n_array, d_array, th_0, lam_vac_list)
+        c_list = ['i'] + ['i' if i in incoherent else 'c'
+                          for i in range(n_array.shape[0] - 2)] + ['i']
+        return np.vstack([inc_tmm_spectrum(pol, n_array, d_list, c_list, th_0,
+                                           lam_vac_list)['R']
+                          for d_list in d_array])
+
+def stack_nk(mat_names, medium, lam_vac_list):
+    """
+    Refractive indices of a film stack on a Si substrate, sampled at the
+    given wavelengths
+
+    input
+    ======
+
+    mat_names: list
+        string names of film type, top to bottom
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    lam_vac_list: grids.WavelengthGrid or array
+        wavelengths in nm; n,k come from the material cache per grid
+
+    output
+    ======
+
+    numpy array
+        (len(mat_names) + 2, len(lam_vac_list)) complex, rows ordered
+        medium, films..., Si, as coh_tmm_spectrum expects
+
+    """
+    grid = as_grid(lam_vac_list)
+    n_array = np.empty((len(mat_names) + 2, len(grid)), dtype=complex)
+    n_array[0] = medium
+    for i, mat in enumerate(list(mat_names) + ['Si']):
+        n_array[i+1] = material_nk(mat, grid)
+    return n_array
+
+def fit_stack_thicknesses(mat_names, thicknesses, medium, measured_r, 
+                          fit_layers=None, relative_to_si=True):
+    """
+    Fit film thicknesses of a stack to a measured spectrum
+
+    input
+    ======
+
+    mat_names: list
+        string names of film type
+    thicknesses: list
+        starting guess of film thicknesses in nm
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    measured_r: pandas DataFrame
+        columns: wavelength (nm), r
+    fit_layers: list
+        positions in mat_names of the films to fit (default: all)
+    relative_to_si: bool
+        measured_r is normalized to bare Si, like the simulator's spectra
+
+    output
+    ======
+
+    dict
+        output of fitting.fit_thicknesses, with d_list trimmed to the films
+
+    """
+    lam_vac_list = measured_r.wavelength.values
+    n_array = stack_nk(mat_names, medium, lam_vac_list)
+    reference = None
+    if relative_to_si:
+        reference = coh_tmm_spectrum('s', n_array[[0, -1]], [np.inf, np.inf], 
+                                     0, lam_vac_list)['R']
+    if fit_layers is not None:
+        fit_layers = [i+1 for i in fit_layers]
+    fit = fit_thicknesses(n_array, [np.inf] + list(thicknesses) + [np.inf], 
+                          lam_vac_list, measured_r.r.values, 
+                          fit_layers=fit_layers, reference=reference)
+    fit['d_list'] = fit['d_list'][1:-1]
+    return fit
+
+def combine_spectra(active_r, trench_r, pattern_density, medium, grid=None):
+    
+    """ 
+    Compute aggregate spectra from active and trench reflectance 
+    as a function of pattern_density
+
+    input
+    ------
+    
+    active_r: pandas Dataframe with columns wavelength and r
+
+    trench_r: pandas Dataframe with columns wavelength and r
+
+    pattern_density: float, fraction of pattern mask containing active sites
+                     (between 0 and 1)
+
+    grid: grids.WavelengthGrid, the wavelengths active_r and trench_r were
+          computed at, default SPECTRAL_GRID as in compute_reflectance_1d
+
+    output
+    -------
+    numpy array, computed reflectance with columns 0 and 1 as wavelength 
+    and reflectance respectively
+        
+    """
+
+    grid = SPECTRAL_GRID if grid is None else as_grid(grid)
+    for name, r_df in (('active_r', active_r), ('trench_r', trench_r)):
+        if not np.array_equal(r_df.wavelength.values, grid.wavelengths):
+            raise ValueError('{} is not on the grid {}; pass the grid it was '
+                             'computed on'.format(name, grid))
+    base_reflectance = np.array(trench_r.values, dtype=float)
+    ref_si = compute_reflectance_1d([], [], medium, grid=grid)
+
+    np.multiply(base_reflectance[:,1], (1 - (pattern_density/100)), base_reflectance[:,1])
+    np.add(base_reflectance[:,1], active_r.r*(pattern_density/100), base_reflectance[:,1])
+    np.divide(base_reflectance[:,1], ref_si.r, base_reflectance[:,1])
+
+    return base_reflectance
+
+def combined_spectrum_adaptive(active_films, active_thks, trench_films, 
+                               trench_thks, pattern_density, medium, 
+                               window=None, tol=1e-3, max_points=2000):
+    """
+    combine_spectra, sampled adaptively instead of on a fixed grid: points
+    are placed where the combined, Si-normalized spectrum needs them
+    (see core_tmm.adaptive_spectrum)
+
+    input
+    ======
+
+    active_films, trench_films: list
+        string names of film type
+    active_thks, trench_thks: list
+        film thicknesses in nm
+    pattern_density: float
+        active area in percent, as in combine_spectra
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    window: tuple
+        (min, max) wavelengths in nm to sample, clipped to SPECTRAL_GRID;
+        default the whole SPECTRAL_GRID range
+    tol: float
+        largest allowed error of linear interpolation between samples
+    max_points: int
+        sample budget
+
+    output
+    ======
+
+    numpy array
+        columns wavelength and reflectance, as combine_spectra
+
+    """
+    lam_min, lam_max = SPECTRAL_GRID.wavelengths[[0, -1]]
+    if window is not None:
+        lam_min, lam_max = max(window[0], lam_min), min(window[1], lam_max)
+        if lam_min >= lam_max:
+            raise ValueError('window does not overlap the spectral range')
+    si_fn = material_fn('Si')
+    active = CompiledStack([medium] + [material_fn(mat) for mat in active_films]
+                           + [si_fn], [np.inf] + list(active_thks) + [np.inf])
+    trench = CompiledStack([medium] + [material_fn(mat) for mat in trench_films]
+                           + [si_fn], [np.inf] + list(trench_thks) + [np.inf])
+    bare_si = CompiledStack([medium, si_fn], [np.inf, np.inf])
+    fraction = pattern_density / 100
+
+    def combined_r(lam):
+        with stage('interpolation'):
+            for stack in (active, trench, bare_si):
+                stack.n_array(lam) # cached for reflectance
+        count_tmm(3, np.size(lam))
+        with stage('tmm'):
+            return ((active.reflectance(lam) * fraction
+                     + trench.reflectance(lam) * (1 - fraction))
+                    / bare_si.reflectance(lam))
+
+    lam, r, _ = adaptive_spectrum(combined_r, lam_min, lam_max, tol=tol, 
+                                  max_points=max_points)
+    return np.column_stack((lam, r))
+
+
+def polish_spectra_matrix(active_films, active_thks, trench_films, 
+                          trench_thks, pattern_density, medium, rate, steps):
+    """
+    Combined spectra, as combine_spectra, during a polish: the last film of
+    both stacks thins by rate nm every second for steps seconds. Every step
+    is the same structure with a thinner film, so all steps of each stack
+    are evaluated in one batch.
+
+    input
+    ======
+
+    active_films, trench_films: list
+        string names of film type
+    active_thks, trench_thks: list
+        film thicknesses in nm at the start of the polish
+    pattern_density: float
+        active area in percent, as in combine_spectra
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+    rate: float
+        removal rate in nm/s
+    steps: int
+        number of one-second steps
+
+    output
+    ======
+
+    numpy array
+        (n_wavelengths, steps) reflectances on SPECTRAL_GRID, normalized to
+        bare Si, one column per second
+
+    """
+    active_r = compute_reflectance_batch(
+        active_films,
+        [active_thks[:-1] + [active_thks[-1] - sec*rate] for sec in range(steps)],
+        medium)
+    trench_r = compute_reflectance_batch(
+        trench_films,
+        [trench_thks[:-1] + [trench_thks[-1] - sec*rate] for sec in range(steps)],
+        medium)
+    ref_si = compute_reflectance_1d([], [], medium).r.values
+    with stage('combine'):
+        return ((active_r * (pattern_density/100) 
+                 + trench_r * (1 - (pattern_density/100))) / ref_si).T
+
+
+def unique_stacks(stack_specs):
+    """
+    Collapse a list of stack specs onto the distinct stacks it contains
+
+    input
+    ======
+
+    stack_specs: list
+        (mat_names, thicknesses) pairs, thicknesses in nm
+
+    output
+    ======
+
+    tuple
+        (unique_specs, index) where unique_specs lists each distinct stack
+        once and stack_specs[i] == unique_specs[index[i]]
+
+    """
+    unique_specs = []
+    positions = {}
+    index = np.empty(len(stack_specs), dtype=int)
+    for i, (mat_names, thicknesses) in enumerate(stack_specs):
+        key = (tuple(mat_names), tuple(float(t) for t in thicknesses))
+        if key not in positions:
+            positions[key] = len(unique_specs)
+            unique_specs.append((list(mat_names), list(thicknesses)))
+        index[i] = positions[key]
+    return unique_specs, index
+
+def mix_spectra(stack_specs, area_fractions, medium):
+    """
+    Compute area-weighted spectra of a layout made of K distinct regions
+    (array, periphery, scribe, dummy fill, ...). Each unique stack is
+    evaluated once; every mix is then a row of one matrix multiply, so
+    adding density scenarios costs almost nothing.
+
+    input
+    ======
+
+    stack_specs: list
+        K (mat_names, thicknesses) pairs, one per region, thicknesses in nm
+    area_fractions: array-like
+        shape (K,) for a single layout or (n_sites, K) for many sites or
+        density scenarios. Each row must sum to 1.
+    medium: float
+        index of refraction of medium on top of stack (air, water, etc)
+
+    output
+    ======
+
+    numpy array
+        shape (n_wavelengths, 2) with columns wavelength and reflectance for
+        a 1D area_fractions, otherwise (n_wavelengths, 1 + n_sites) with the
+        wavelength in column 0 and one mixed spectrum per site after it.
+        Reflectance is normalized to bare Si, as in combine_spectra.
+
+    """
+    fractions = np.asarray(area_fractions, dtype=float)
+    single = fractions.ndim == 1
+    fractions = np.atleast_2d(fractions)
+    if fractions.ndim != 2 or fractions.shape[1] != len(stack_specs):
+        raise ValueError('area_fractions must have one column per stack spec')
+    if not np.allclose(fractions.sum(axis=1), 1):
+        raise ValueError('area fractions of each site must sum to 1')
+
+    unique_specs, index = unique_stacks(stack_specs)
+    spectra = [compute_reflectance_1d(mat_names, thicknesses, medium)
+               for mat_names, thicknesses in unique_specs]
+    unique_r = np.vstack([r_df.r.values for r_df in spectra])
+
+    # Fold columns of repeated stacks together so the multiply is (sites x U)
+    unique_fractions = np.zeros((fractions.shape[0], len(unique_specs)))
+    np.add.at(unique_fractions.T, index, fractions.T)
+
+    ref_si = compute_reflectance_1d([], [], medium)
+    mixed = np.dot(unique_fractions, unique_r) / ref_si.r.values
+
+    wavelengths = spectra[0].wavelength.values
+    if single:
+        return np.column_stack((wavelengths, mixed[0]))
+    return np.column_stack((wavelengths, mixed.T))
@@ -0,0 +1,348 @@
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .core_tmm import coh_tmm_batch, coh_tmm_spectrum
+from .grids import as_grid
+from .spectra import SPECTRAL_GRID, stack_nk
+
+
+def as_axis(value):
+    """
+    A thickness, density or medium given either as one value or as a
+    sequence of values to sweep, returned as a 1D array.
+    """
+    return np.atleast_1d(np.asarray(value, dtype=float))
+
+
+class DOESweep:
+    """
+    Full-factorial sweep of active and trench film thicknesses, pattern
+    density and medium, evaluated lazily in bounded-size chunks.
+
+    Grid points are numbered in C order over the axes
+    (medium, active layers..., trench layers..., pattern density), so a
+    chunk is just a range of flat indices and nothing proportional to the
+    grid size is ever held in memory.
+
+    input
+    ======
+
+    active_mats, trench_mats: list
+        string names of film type, top to bottom
+    active_thicknesses, trench_thicknesses: list
+        one entry per film, in nm: a number to hold it fixed or a sequence
+        of thicknesses to sweep
+    pattern_densities: list
+        active area in percent, as in combine_spectra
+    media: list
+        index of refraction of medium on top of stack (air, water, etc)
+    lam_vac_list: grids.WavelengthGrid or array
+        wavelengths in nm, default spectra.SPECTRAL_GRID (250-1499 nm), the
+        wavelengths the simulator shows
+
+    """
+
+    def __init__(self, active_mats, active_thicknesses, trench_mats,
+                 trench_thicknesses, pattern_densities=(50,), media=(1.3333,),
+                 lam_vac_list=None):
+        if (len(active_mats) != len(active_thicknesses)
+                or len(trench_mats) != len(trench_thicknesses)):
+            raise ValueError('Need one thickness entry per film!')
+        self.grid = (SPECTRAL_GRID if lam_vac_list is None
+                     else as_grid(lam_vac_list))
+        self.lam_vac_list = self.grid.wavelengths
+        self.media = as_axis(media)
+        self.active_axes = [as_axis(d) for d in active_thicknesses]
+        self.trench_axes = [as_axis(d) for d in trench_thicknesses]
+        self.pattern_densities = as_axis(pattern_densities)
+        self.axes = ([self.media] + self.active_axes + self.trench_axes
+                     + [self.pattern_densities])
+        self.shape = tuple(axis.size for axis in self.axes)
+        self.size = int(np.prod(self.shape))
+
+        # n,k only depend on the medium through the top row, so fetch the
+        # films once and swap the medium in per grid point
+        self.active_n = stack_nk(active_mats, 1, self.grid)
+        self.trench_n = stack_nk(trench_mats, 1, self.grid)
+        self.ref_si = np.vstack([
+            coh_tmm_spectrum('s', [np.full(self.lam_vac_list.size, medium),
+                                   self.active_n[-1]],
+                             [np.inf, np.inf], 0, self.lam_vac_list)['R']
+            for medium in self.media])
+
+    def params(self, start, stop):
+        """
+        Grid coordinates of flat indices start to stop.
+
+        output
+        ======
+
+        dict
+            medium, pattern_density: (n,) arrays
+            active_d, trench_d: (n, num_films) thicknesses in nm
+
+        """
+        idx = np.unravel_index(np.arange(start, stop), self.shape)
+        num_active = len(self.active_axes)
+
+        def columns(axes, axes_idx):
+            d = np.empty((stop - start, len(axes)))
+            for j, (axis, i) in enumerate(zip(axes, axes_idx)):
+                d[:, j] = axis[i]
+            return d
+
+        return {
+            'medium': self.media[idx[0]],
+            'active_d': columns(self.active_axes, idx[1:1+num_active]),
+            'trench_d': columns(self.trench_axes, idx[1+num_active:-1]),
+            'pattern_density': self.pattern_densities[idx[-1]],
+        }
+
+    def evaluate(self, start, stop, wl_start=0, wl_stop=None):
+        """
+        Combined spectra, normalized to bare Si, for flat indices start to
+        stop as a (stop - start, num_wavelengths) array. wl_start and
+        wl_stop restrict the calculation to a slice of the wavelengths.
+        """
+        wl = slice(wl_start, wl_stop)
+        lam_vac_list = self.lam_vac_list[wl]
+        params = self.params(start, stop)
+        medium_idx = np.unravel_index(np.arange(start, stop), self.shape)[0]
+        r = np.empty((stop - start, lam_vac_list.size))
+        for m in np.unique(medium_idx):
+            sel = medium_idx == m
+            active_r = self._reflectance(self.active_n[:, wl], self.media[m],
+                                         params['active_d'][sel], lam_vac_list)
+            trench_r = self._reflectance(self.trench_n[:, wl], self.media[m],
+                                         params['trench_d'][sel], lam_vac_list)
+            density = params['pattern_density'][sel, None] / 100
+            r[sel] = ((density * active_r + (1 - density) * trench_r)
+                      / self.ref_si[m, wl])
+        return r
+
+    def _reflectance(self, n_array, medium, d_rows, lam_vac_list):
+        # Pattern density is the fastest axis, so neighbouring grid points
+        # share stacks; only the distinct ones go through the TMM
+        unique_rows, inverse = np.unique(d_rows, axis=0, return_inverse=True)
+        n_array = n_array.copy()
+        n_array[0] = medium
+        d_array = np.empty((unique_rows.shape[0], unique_rows.shape[1] + 2))
+        d_array[:, 0] = d_array[:, -1] = np.inf
+        d_array[:, 1:-1] = unique_rows
+        R = coh_tmm_batch('s', n_array, d_array, 0, lam_vac_list)
+        return R[np.ravel(inverse)]
+
+    def chunks(self, chunk_size=512):
+        """
+        Generator over the sweep: yields dicts with start, stop, the
+        params() arrays and r, the (stop - start, num_wavelengths) spectra.
+        """
+        for start in range(0, self.size, chunk_size):
+            stop = min(start + chunk_size, self.size)
+            chunk = self.params(start, stop)
+            chunk.update({'start': start, 'stop': stop,
+                          'r': self.evaluate(start, stop)})
+            yield chunk
+
+    def write(self, path, chunk_size=512, file_format=None):
+        """
+        Run the sweep and stream it to disk, one chunk at a time.
+        file_format is 'npz', 'hdf5' or 'parquet'; by default it is taken
+        from the file extension.
+        """
+        if file_format is None:
+            file_format = path.rsplit('.', 1)[-1].lower()
+        writers = {'npz': write_npz, 'hdf5': write_hdf5, 'h5': write_hdf5,
+                   'parquet': write_parquet}
+        if file_format not in writers:
+            raise ValueError('Unknown sweep file format: {}'.format(file_format))
+        return writers[file_format](self, path, chunk_size)
+
+
+class SharedSweepResult:
+    """
+    Spectra of a parallel sweep, (sweep.size, num_wavelengths), held in a
+    multiprocessing.shared_memory block that the workers write into
+    directly. Use as a context manager or call close() to free the block;
+    copy r first if it has to outlive it.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape)) * np.dtype(float).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.r = np.ndarray(self.shape, dtype=float, buffer=self.shm.buf)
+
+    def close(self):
+        """
+        Release and unlink the shared memory block.
+        """
+        self.r = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Per-process state of parallel_sweep workers, set by _init_worker
+_worker = {}
+
+def _init_worker(sweep, shm_name, shape):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['sweep'] = sweep
+    _worker['shm'] = shm
+    _worker['r'] = np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+def _evaluate_tile(tile):
+    start, stop, wl_start, wl_stop = tile
+    _worker['r'][start:stop, wl_start:wl_stop] = _worker['sweep'].evaluate(
+        start, stop, wl_start, wl_stop)
+    return stop - start
+
+def parallel_sweep(sweep, max_workers=None, chunk_size=512,
+                   wavelength_chunk=None):
+    """
+    Evaluate a DOESweep across a ProcessPoolExecutor.
+
+    The grid is cut into tiles of chunk_size grid points, and, if
+    wavelength_chunk is given, of wavelength_chunk wavelengths (useful
+    when there are few stacks but many wavelengths). Each worker receives
+    the sweep once at start-up and writes its tiles straight into a shared
+    memory result, so only tile coordinates cross process boundaries.
+
+    output
+    ======
+
+    SharedSweepResult
+        the caller owns it and must close() it
+
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    num_wl = sweep.lam_vac_list.size
+    if wavelength_chunk is None:
+        wavelength_chunk = num_wl
+    tiles = [(start, min(start + chunk_size, sweep.size),
+              wl_start, min(wl_start + wavelength_chunk, num_wl))
+             for start in range(0, sweep.size, chunk_size)
+             for wl_start in range(0, num_wl, wavelength_chunk)]
+
+    result = SharedSweepResult((sweep.size, num_wl))
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker,
+                                 initargs=(sweep, result.shm.name,
+                                           result.shape)) as executor:
+            for _ in executor.map(_evaluate_tile, tiles):
+                pass
+    except BaseException:
+        result.close()
+        raise
+    return result
+
+
+def _stream_npy(archive, name, shape, dtype, blocks):
+    """
+    Write an array into a zip archive as name.npy from an iterator of row
+    blocks, without ever holding the whole array.
+    """
+    with archive.open(name + '.npy', 'w', force_zip64=True) as member:
+        np.lib.format.write_array_header_2_0(
+            member, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                     'fortran_order': False, 'shape': shape})
+        for block in blocks:
+            member.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+
+
+def write_npz(sweep, path, chunk_size=512):
+    """
+    Stream a sweep to an .npz readable with np.load. Grid coordinates are
+    written first (cheap, no TMM), then the spectra chunk by chunk.
+    """
+    ranges = [(start, min(start + chunk_size, sweep.size))
+              for start in range(0, sweep.size, chunk_size)]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        _stream_npy(archive, 'wavelength', sweep.lam_vac_list.shape, float,
+                    [sweep.lam_vac_list])
+        for key, width in (('medium', None), ('pattern_density', None),
+                           ('active_d', len(sweep.active_axes)),
+                           ('trench_d', len(sweep.trench_axes))):
+            shape = (sweep.size,) if width is None else (sweep.size, width)
+            _stream_npy(archive, key, shape, float,
+                        (sweep.params(start, stop)[key]
+                         for start, stop in ranges))
+        _stream_npy(archive, 'r', (sweep.size, sweep.lam_vac_list.size), float,
+                    (sweep.evaluate(start, stop) for start, stop in ranges))
+    return path
+
+
+def write_hdf5(sweep, path, chunk_size=512):
+    """
+    Stream a sweep into preallocated HDF5 datasets (needs h5py).
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Writing HDF5 sweeps requires h5py')
+    num_wl = sweep.lam_vac_list.size
+    with h5py.File(path, 'w') as f:
+        f['wavelength'] = sweep.lam_vac_list
+        # h5py defaults to float32; keep the full precision of the spectra
+        datasets = {
+            'medium': f.create_dataset('medium', (sweep.size,), dtype=float),
+            'pattern_density': f.create_dataset(
+                'pattern_density', (sweep.size,), dtype=float),
+            'active_d': f.create_dataset(
+                'active_d', (sweep.size, len(sweep.active_axes)), dtype=float),
+            'trench_d': f.create_dataset(
+                'trench_d', (sweep.size, len(sweep.trench_axes)), dtype=float),
+            'r': f.create_dataset('r', (sweep.size, num_wl), dtype=float,
+                                  chunks=(min(chunk_size, sweep.size), num_wl)),
+        }
+        for chunk in sweep.chunks(chunk_size):
+            for key, dataset in datasets.items():
+                dataset[chunk['start']:chunk['stop']] = chunk[key]
+    return path
+
+
+def write_parquet(sweep, path, chunk_size=512):
+    """
+    Stream a sweep to Parquet, one row group per chunk (needs pyarrow).
+    Each row is a grid point; the spectrum is a list column r and the
+    wavelengths are stored in the schema metadata.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing Parquet sweeps requires pyarrow')
+    writer = None
+    try:
+        for chunk in sweep.chunks(chunk_size):
+            columns = {'medium': chunk['medium'],
+                       'pattern_density': chunk['pattern_density']}
+            for prefix in ('active_d', 'trench_d'):
+                for i, column in enumerate(chunk[prefix].T):
+                    columns['{}{}'.format(prefix, i)] = column
+            table = pa.table(columns)
+            table = table.append_column('r', pa.FixedSizeListArray.from_arrays(
+                pa.array(chunk['r'].ravel()), sweep.lam_vac_list.size))
+            if writer is None:
+                schema = table.schema.with_metadata(
+                    {'wavelength': ','.join(repr(float(lam))
+                                           for lam in sweep.lam_vac_list)})
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
@@ -0,0 +1,201 @@
+"""
+Per-stage timing of requests.
+
+A request is wrapped in timed(name), and the code it runs marks its parts
+with stage(stage_name), anywhere down the call stack:
+
+    with timed('simulator.spectra', tab=tab) as timer:
+        with stage('parse'):
+            ...
+        timer.fields['payload_bytes'] = size
+
+stage() is a no-op outside timed(), so library code (spectra) can be
+instrumented unconditionally. core_tmm is not: its callers in spectra
+mark the interpolation and tmm stages around it, so the engine stays free
+of app imports. Every finished request is appended to the timings ring
+buffer, logged as one JSON line at INFO level on the 'app.timing' logger,
+and added to the latency histograms served at /metrics.
+
+Stage names used across the app, in pipeline order: parse, nk_fetch,
+interpolation, tmm, combine, figure, serialize.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from .metrics import observe_timing
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('parse', 'nk_fetch', 'interpolation', 'tmm', 'combine', 'figure',
+          'serialize')
+
+_local = threading.local()
+
+
+class Timer:
+    """
+    Wall-clock seconds per stage of one request. Stages may nest; time
+    spent in an inner stage is not counted in the outer one, so the stage
+    times never add up to more than the total.
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.stages = OrderedDict()
+        self.total = None
+        self.started = time.time()
+        self._stack = [] # [stage name, perf_counter at (re)start]
+
+    def _add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self._add(outer[0], now - outer[1])
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add(name, now - self._stack.pop()[1])
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def record(self):
+        """
+        The timing as a JSON-serializable dict, times in milliseconds
+        """
+        record = OrderedDict([
+            ('name', self.name),
+            ('started', round(self.started, 3)),
+            ('total_ms', None if self.total is None
+                         else round(self.total * 1e3, 3)),
+            ('stages_ms', OrderedDict((name, round(seconds * 1e3, 3))
+                                      for name, seconds in self.stages.items())),
+        ])
+        record.update(self.fields)
+        return record
+
+
+class TimingBuffer:
+    """
+    Thread-safe ring buffer of the most recent maxlen timing records.
+    """
+
+    def __init__(self, maxlen=1000):
+        self._records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def records(self, name=None):
+        """
+        Copy of the buffered records, oldest first, optionally only those
+        of one request name.
+        """
+        with self._lock:
+            records = list(self._records)
+        if name is not None:
+            records = [record for record in records if record['name'] == name]
+        return records
+
+    def summary(self, name=None):
+        """
+        Statistics of each stage (and 'total') over the buffered records
+
+        output
+        ======
+
+        dict
+            {stage: {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms'}}
+
+        """
+        samples = OrderedDict([('total', [])])
+        for record in self.records(name):
+            if record['total_ms'] is not None:
+                samples['total'].append(record['total_ms'])
+            for stage_name, ms in record['stages_ms'].items():
+                samples.setdefault(stage_name, []).append(ms)
+        summary = OrderedDict()
+        for stage_name, values in samples.items():
+            if not values:
+                continue
+            values.sort()
+            summary[stage_name] = {
+                'count': len(values),
+                'mean_ms': sum(values) / len(values),
+                'p50_ms': values[(len(values) - 1) // 2],
+                'p95_ms': values[min(len(values) - 1,
+                                     int(0.95 * len(values)))],
+                'max_ms': values[-1],
+            }
+        return summary
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+
+timings = TimingBuffer()
+
+
+def current_timer():
+    """
+    The Timer of the request running in this thread, or None
+    """
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def timed(name, buffer=None, **fields):
+    """
+    Time the enclosed request as name, with extra fields for the record.
+    Yields the Timer, whose fields can be added to while it runs. A request
+    that raises is still recorded, with the exception type under 'error'.
+    A timed() inside another one takes over until it finishes.
+    """
+    timer = Timer(name, **fields)
+    outer = current_timer()
+    _local.timer = timer
+    start = time.perf_counter()
+    try:
+        yield timer
+    except BaseException as error:
+        timer.fields['error'] = type(error).__name__
+        raise
+    finally:
+        timer.total = time.perf_counter() - start
+        _local.timer = outer
+        record = timer.record()
+        (timings if buffer is None else buffer).append(record)
+        observe_timing(record)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record), extra={'timing': record})
+
+
+@contextmanager
+def stage(name):
+    """
+    Count the enclosed code towards stage name of the current request;
+    does nothing outside timed().
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+    else:
+        with timer.stage(name):
+            yield
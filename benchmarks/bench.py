@@ -0,0 +1,309 @@
+"""
+Benchmarks of the functions the simulator depends on, with correctness
+checks against the reference tmm package (pinned in environment.yml).
+
+    python -m benchmarks.bench [-o results.json] [--compare old.json] [--quick]
+
+Results go to benchmarks/results/<commit>.json by default, so runs on
+different commits can be compared with --compare. The run exits with
+status 1 if any check disagrees with tmm, so a speedup can't silently
+change the numbers.
+
+compute_reflectance_1d and the contour (polish) matrix read n,k from a
+temporary SQLite database seeded with the test suite's analytic materials,
+so the numbers don't depend on the local theospec.db.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+
+from app import create_app
+from app import core_tmm
+from tests.materials import MATERIALS, seed_database
+
+SEED = 0
+LAYER_COUNTS = (1, 2, 5, 10, 20, 50)
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Checks pass when every value agrees with tmm within
+RTOL = 1e-9
+ATOL = 1e-12
+
+
+# Seeded material database
+
+def seeded_app(path):
+    """
+    App with a fresh SQLite database at path holding the test suite's
+    analytic materials (tests.materials.MATERIALS)
+    """
+    uri = 'sqlite:///' + path
+    seed_database(uri)
+    return create_app({'SQLALCHEMY_DATABASE_URI': uri}, simulator=False)
+
+
+def random_stack(rng, num_films, materials=('SiO2', 'SiN', 'Poly')):
+    films = [materials[i] for i in rng.randint(len(materials), size=num_films)]
+    thicknesses = list(rng.uniform(5, 300, size=num_films))
+    return films, thicknesses
+
+
+# Timing
+
+def bench(fn, repeat=5, min_time=0.2):
+    """
+    Seconds per call of fn: the number of calls per repeat is scaled so a
+    repeat takes at least min_time, and min/median/mean over the repeats
+    are reported.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    one = timer.timeit(number) / number
+    number = max(1, int(np.ceil(min_time / max(one, 1e-9))))
+    per_call = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return OrderedDict([('min_s', float(per_call.min())),
+                        ('median_s', float(np.median(per_call))),
+                        ('mean_s', float(per_call.mean())),
+                        ('number', number), ('repeat', repeat)])
+
+
+# Correctness
+
+def check(name, ours, reference, checks):
+    ours = np.asarray(ours)
+    reference = np.asarray(reference)
+    diff = float(np.max(np.abs(ours - reference)))
+    passed = bool(np.allclose(ours, reference, rtol=RTOL, atol=ATOL))
+    checks[name] = OrderedDict([('max_abs_diff', diff), ('passed', passed)])
+
+
+def tmm_spectrum(tmm, pol, n_array, d_list, th_0, lam_vac_list, c_list=None):
+    """
+    R and T from the reference package, one wavelength at a time
+    """
+    R = np.empty(len(lam_vac_list))
+    T = np.empty(len(lam_vac_list))
+    for i, lam in enumerate(lam_vac_list):
+        if c_list is None:
+            data = tmm.coh_tmm(pol, n_array[:, i], d_list, th_0, lam)
+        else:
+            data = tmm.inc_tmm(pol, n_array[:, i], d_list, c_list, th_0, lam)
+        R[i], T[i] = data['R'], data['T']
+    return R, T
+
+
+def run(quick=False):
+    repeat = 3 if quick else 5
+    min_time = 0.05 if quick else 0.2
+    rng = np.random.RandomState(SEED)
+    results = OrderedDict()
+    checks = OrderedDict()
+    try:
+        import tmm
+    except ImportError:
+        tmm = None
+
+    lam_vac_list = core_tmm.LAM_VAC_LIST
+    n_coarse = lam_vac_list[::25]
+
+    # coh_tmm, one wavelength per call
+    films, d = random_stack(rng, 5)
+    n_list = np.array([1.0] + [MATERIALS[f](550.0) for f in films]
+                      + [MATERIALS['Si'](550.0)])
+    d_list = [np.inf] + d + [np.inf]
+    for pol, th_0 in (('s', 0.0), ('p', 0.6)):
+        name = 'coh_tmm[{},th0={}]'.format(pol, th_0)
+        results[name] = bench(lambda: core_tmm.coh_tmm(pol, n_list, d_list,
+                                                       th_0, 550.0),
+                              repeat, min_time)
+        if tmm is not None:
+            ours = core_tmm.coh_tmm(pol, n_list, d_list, th_0, 550.0)
+            ref = tmm.coh_tmm(pol, n_list, d_list, th_0, 550.0)
+            check(name, [ours[key] for key in ('r', 't', 'R', 'T')],
+                  [ref[key] for key in ('r', 't', 'R', 'T')], checks)
+
+    # calc_reflectances, one spectrum per call
+    for num_films in LAYER_COUNTS:
+        films, d = random_stack(rng, num_films)
+        n_fn_list = [1.0] + [MATERIALS[f] for f in films] + [MATERIALS['Si']]
+        d_list = [np.inf] + d + [np.inf]
+        name = 'calc_reflectances[{} films]'.format(num_films)
+        results[name] = bench(
+            lambda: core_tmm.calc_reflectances(n_fn_list, d_list, 0,
+                                               spectral_range='full'),
+            repeat, min_time)
+        results[name]['wavelengths'] = int(lam_vac_list.size)
+        if tmm is not None:
+            ours = core_tmm.calc_reflectances(n_fn_list, d_list, 0,
+                                              spectral_range='full',
+                                              grid=n_coarse)
+            n_array = np.array([np.full(n_coarse.size, 1.0, dtype=complex)]
+                               + [MATERIALS[f](n_coarse) for f in films]
+                               + [MATERIALS['Si'](n_coarse)])
+            check(name, ours[:, 1], tmm_spectrum(tmm, 's', n_array, d_list,
+                                                 0, n_coarse)[0], checks)
+
+    # inc_tmm, a glass layer between thin films
+    n_list = np.array([1.0, 1.46 + 0.001j, 1.52, 2.0 + 0.01j, 3.9 + 0.02j])
+    d_list = [np.inf, 120, 1e6, 60, np.inf]
+    c_list = ['i', 'c', 'i', 'c', 'i']
+    for pol, th_0 in (('s', 0.0), ('p', 0.5)):
+        name = 'inc_tmm[{},th0={}]'.format(pol, th_0)
+        results[name] = bench(lambda: core_tmm.inc_tmm(pol, n_list, d_list,
+                                                       c_list, th_0, 600.0),
+                              repeat, min_time)
+        if tmm is not None:
+            ours = core_tmm.inc_tmm(pol, n_list, d_list, c_list, th_0, 600.0)
+            ref = tmm.inc_tmm(pol, n_list, d_list, c_list, th_0, 600.0)
+            check(name, [ours['R'], ours['T']], [ref['R'], ref['T']], checks)
+
+    name = 'inc_tmm_spectrum'
+    n_array = np.tile(n_list[:, None], (1, lam_vac_list.size))
+    results[name] = bench(lambda: core_tmm.inc_tmm_spectrum(
+        's', n_array, d_list, c_list, 0, lam_vac_list), repeat, min_time)
+    results[name]['wavelengths'] = int(lam_vac_list.size)
+    if tmm is not None:
+        ours = core_tmm.inc_tmm_spectrum('s', n_array[:, ::25], d_list, c_list,
+                                         0, n_coarse)
+        check(name, [ours['R'], ours['T']],
+              tmm_spectrum(tmm, 's', n_array[:, ::25], d_list, 0, n_coarse,
+                           c_list=c_list), checks)
+
+    # Database-backed paths, on a seeded temporary SQLite database
+    tmp = tempfile.mkdtemp()
+    try:
+        from app import spectra
+        app = seeded_app(os.path.join(tmp, 'bench.db'))
+        with app.app_context():
+            spectra.clear_material_cache()
+            films, d = random_stack(rng, 3)
+
+            def cold():
+                spectra.clear_material_cache()
+                spectra.compute_reflectance_1d(films, d, 1.0)
+
+            results['compute_reflectance_1d[cold cache]'] = bench(
+                cold, repeat, min_time)
+            results['compute_reflectance_1d[warm cache]'] = bench(
+                lambda: spectra.compute_reflectance_1d(films, d, 1.0),
+                repeat, min_time)
+            r_df = spectra.compute_reflectance_1d(films, d, 1.0)
+            grid = spectra.SPECTRAL_GRID.wavelengths
+            n_array = spectra.stack_nk(films, 1.0, grid)
+            if tmm is not None:
+                check('compute_reflectance_1d', r_df.r.values[::25],
+                      tmm_spectrum(tmm, 's', n_array[:, ::25],
+                                   [np.inf] + d + [np.inf], 0,
+                                   grid[::25])[0], checks)
+
+            # Contour tab: 7 polish steps of an active and a trench stack
+            active = random_stack(rng, 4)
+            trench = random_stack(rng, 2)
+            rate, steps, density = 10000 / 10 / 60, 7, 40.0
+            results['contour[polish matrix]'] = bench(
+                lambda: spectra.polish_spectra_matrix(
+                    active[0], active[1], trench[0], trench[1], density, 1.0,
+                    rate, steps), repeat, min_time)
+            if tmm is not None:
+                ours = spectra.polish_spectra_matrix(
+                    active[0], active[1], trench[0], trench[1], density, 1.0,
+                    rate, steps)
+                sub = grid[::25]
+                si = tmm_spectrum(tmm, 's', spectra.stack_nk([], 1.0, grid)[:, ::25],
+                                  [np.inf, np.inf], 0, sub)[0]
+                ref = np.empty((sub.size, steps))
+                for sec in range(steps):
+                    r = []
+                    for films, d in (active, trench):
+                        d = [np.inf] + d[:-1] + [d[-1] - sec*rate, np.inf]
+                        r.append(tmm_spectrum(
+                            tmm, 's', spectra.stack_nk(films, 1.0, grid)[:, ::25],
+                            d, 0, sub)[0])
+                    ref[:, sec] = (r[0] * density/100
+                                   + r[1] * (1 - density/100)) / si
+                check('contour[polish matrix]', ours[::25], ref, checks)
+            spectra.clear_material_cache()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results, checks, tmm
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, path):
+    """
+    Print the speed of this run relative to a previous results file
+    """
+    with open(path) as f:
+        old = json.load(f)['benchmarks']
+    print('\nvs {} (>1 is faster now):'.format(path))
+    for name, stats in results.items():
+        if name in old:
+            print('  {:<40} {:6.2f}x'.format(
+                name, old[name]['median_s'] / stats['median_s']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench',
+                                     description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', help='results JSON (default: '
+                        'benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='previous results JSON to compare with')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer, shorter repeats')
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    results, checks, tmm = run(quick=args.quick)
+    report = OrderedDict([
+        ('commit', commit),
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('tmm', getattr(tmm, '__version__', 'installed') if tmm else None),
+        ('machine', platform.platform()),
+        ('benchmarks', results),
+        ('checks', checks),
+    ])
+    path = args.output or os.path.join(RESULTS_DIR, '{}.json'.format(commit))
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in results.items():
+        print('{:<40} {:>12.1f} us/call'.format(name, stats['median_s'] * 1e6))
+    if tmm is None:
+        print('\nCorrectness checks SKIPPED: the tmm package is not installed')
+    else:
+        print()
+        for name, result in checks.items():
+            print('{:<40} {} (max diff {:.2e})'.format(
+                name, 'ok' if result['passed'] else 'MISMATCH',
+                result['max_abs_diff']))
+    if args.compare:
+        compare(results, args.compare)
+    print('\nWrote {}'.format(path))
+    return 0 if all(result['passed'] for result in checks.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,14 @@
-from app import app
-from app.simulator import simulator
+import logging
+import os
+
+from app import create_app
+
+# Request timings are logged at INFO by app.timing; LOG_LEVEL=DEBUG adds the
+# simulator's stack details, WARNING silences both
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(port=8000, debug=True)
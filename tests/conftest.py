@@ -0,0 +1,38 @@
+import pytest
+
+from tests.materials import nk_frame, seed_database
+
+
+@pytest.fixture
+def materials(monkeypatch):
+    """
+    Serve n,k from tests.materials instead of the database
+    """
+    from app import spectra
+    monkeypatch.setattr(spectra, 'get_nkvals', nk_frame)
+    spectra.clear_material_cache()
+    yield
+    spectra.clear_material_cache()
+
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+    """
+    URI of a SQLite database seeded with tests.materials
+    """
+    uri = 'sqlite:///' + str(tmp_path_factory.mktemp('db') / 'theospec.db')
+    seed_database(uri)
+    return uri
+
+
+@pytest.fixture
+def app(database, tmp_path):
+    from app import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': database,
+                       'UPLOAD_FOLDER': str(tmp_path),
+                       'TESTING': True})
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
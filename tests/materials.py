@@ -0,0 +1,57 @@
+"""
+Analytic stand-ins for the n,k data in the materials database, so tests
+don't depend on what has been uploaded.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def _cauchy(a, b, c=0.0, k=0.0):
+    # n = a + b/lam^2 (lam in um), with k decaying towards the red
+    def nk(lam):
+        lam_um = np.asarray(lam, dtype=float) / 1000
+        return a + b / lam_um**2 + 1j * k * np.exp(-c * lam_um)
+    return nk
+
+MATERIALS = OrderedDict([
+    ('Si', _cauchy(3.45, 0.12, 4.0, 2.0)),
+    ('SiO2', _cauchy(1.44, 0.0036)),
+    ('SiN', _cauchy(1.98, 0.019, 6.0, 0.05)),
+    ('Poly', _cauchy(3.6, 0.15, 3.0, 1.5)),
+])
+NK_WAVELENGTHS = np.arange(200, 1801, 5.0) # nm, as they would be uploaded
+
+
+def nk_frame(mat_name):
+    """
+    n,k of a material in the form spectra.get_nkvals returns it
+    """
+    if mat_name not in MATERIALS:
+        raise ValueError('Unknown material: {}'.format(mat_name))
+    nk = MATERIALS[mat_name](NK_WAVELENGTHS)
+    return pd.DataFrame({'wavelength': NK_WAVELENGTHS, 'n': nk.real,
+                         'k': nk.imag, 'nk': nk})
+
+
+def seed_database(uri):
+    """
+    Create the tables of a fresh database at uri and store MATERIALS in it
+    on NK_WAVELENGTHS, as if they had been uploaded
+    """
+    from app import create_app, db
+    from app.models import Material, NKValues
+    with create_app({'SQLALCHEMY_DATABASE_URI': uri},
+                    simulator=False).app_context():
+        db.create_all()
+        for name, nk_fn in MATERIALS.items():
+            material = Material(name=name)
+            db.session.add(material)
+            db.session.flush()
+            nk = nk_fn(NK_WAVELENGTHS)
+            db.session.add_all([
+                NKValues(wavelength=float(lam), n_value=float(value.real),
+                         k_value=float(value.imag), material_id=material.id)
+                for lam, value in zip(NK_WAVELENGTHS, nk)])
+        db.session.commit()
@@ -0,0 +1,103 @@
+import io
+
+import numpy as np
+import pytest
+
+from app import api, spectra
+
+STACK = {'materials': ['SiO2', 'SiN'], 'thicknesses': [100, 50]}
+
+
+@pytest.fixture(autouse=True)
+def use_test_materials(materials):
+    pass
+
+
+def post(client, body):
+    return client.post('/api/v1/reflectance', json=body)
+
+
+def test_reflectance(client):
+    body = {'stacks': [STACK, {'materials': ['Poly'], 'thicknesses': [20]}],
+            'grid': {'start': 400, 'stop': 800, 'step': 10}}
+    response = post(client, body)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['wavelength'][0] == 400 and len(data['wavelength']) == 41
+    assert np.array(data['r']).shape == (2, 41)
+
+
+def test_reflectance_incoherent(client):
+    body = {'stacks': [dict(STACK, incoherent=[0]), STACK],
+            'grid': [500, 600]}
+    response = post(client, body)
+    assert response.status_code == 200
+    r = np.array(response.get_json()['r'])
+    assert r.shape == (2, 2) and not np.allclose(r[0], r[1])
+
+
+def test_reflectance_options(client):
+    body = {'stacks': [STACK], 'grid': [500, 600], 'medium': 1.33,
+            'angle': 30, 'pol': 'p', 'relative_to_si': True}
+    response = post(client, body)
+    assert response.status_code == 200
+    plain = post(client, {'stacks': [STACK], 'grid': [500, 600]})
+    assert not np.allclose(response.get_json()['r'], plain.get_json()['r'])
+
+
+def test_reflectance_npz(client):
+    response = post(client, {'stacks': [STACK], 'grid': [500, 600, 700],
+                             'format': 'npz'})
+    assert response.status_code == 200
+    archive = np.load(io.BytesIO(response.data))
+    assert archive['r'].shape == (1, 3)
+
+
+@pytest.mark.parametrize('body, message', [
+    (None, 'JSON object'),
+    ({'stacks': []}, 'non-empty list'),
+    ({'stacks': [{'materials': ['SiO2']}]}, 'numeric'),
+    ({'stacks': [{'materials': ['SiO2'], 'thicknesses': ['x']}]}, 'numeric'),
+    ({'stacks': [{'materials': ['SiO2'], 'thicknesses': [1, 2]}]},
+     'one thickness per film'),
+    ({'stacks': [{'materials': ['SiO2'], 'thicknesses': [-1]}]},
+     'non-negative'),
+    ({'stacks': [dict(STACK, incoherent=[2])]}, 'between 0 and 1'),
+    ({'stacks': [dict(STACK, incoherent=[-1])]}, 'between 0 and 1'),
+    ({'stacks': [STACK], 'grid': {'start': 400}}, 'grid is missing'),
+    ({'stacks': [STACK], 'grid': {'start': 400, 'stop': 500,
+                                  'spacing': 'cubic'}}, 'Unknown grid spacing'),
+    ({'stacks': [STACK], 'pol': 'x'}, 'pol'),
+    ({'stacks': [STACK], 'format': 'xml'}, 'format'),
+    ({'stacks': [STACK], 'medium': 'water'}, 'medium must be a number'),
+    ({'stacks': [STACK], 'medium': True}, 'medium must be a number'),
+    ({'stacks': [STACK], 'medium': 0}, 'positive'),
+    ({'stacks': [STACK], 'medium': -1.5}, 'positive'),
+    ({'stacks': [STACK], 'angle': 90}, 'angle'),
+    ({'stacks': [STACK], 'angle': -5}, 'angle'),
+    ({'stacks': [STACK], 'angle': '30'}, 'angle must be a number'),
+    ({'stacks': [STACK], 'relative_to_si': 'false'}, 'true or false'),
+    ({'stacks': [STACK], 'relative_to_si': 0}, 'true or false'),
+    ({'stacks': [{'materials': ['Unobtainium'], 'thicknesses': [1]}]},
+     'Unknown material'),
+])
+def test_reflectance_errors(client, body, message):
+    response = post(client, body)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+
+
+def test_reflectance_not_finite(client, monkeypatch):
+    monkeypatch.setattr(spectra, 'compute_reflectance_many',
+                        lambda stacks, *args, **kwargs:
+                        np.full((len(stacks), 2), np.nan))
+    response = post(client, {'stacks': [STACK], 'grid': [500, 600]})
+    assert response.status_code == 400
+    assert 'not finite' in response.get_json()['error']
+
+
+def test_reflectance_too_large(client, monkeypatch):
+    monkeypatch.setattr(api, 'MAX_STACKS', 1)
+    response = post(client, {'stacks': [STACK, STACK]})
+    assert response.status_code == 400
+    assert 'At most 1 stacks' in response.get_json()['error']
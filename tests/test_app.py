@@ -0,0 +1,85 @@
+def test_pages(client):
+    assert client.get('/').status_code == 200
+    response = client.get('/about')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+
+
+def test_simulator_served_under_data(client):
+    # The first request builds the Dash app, whose layout queries the
+    # materials, so this fails without an app context
+    response = client.get('/data/')
+    assert response.status_code == 200
+    assert b'<!DOCTYPE html>' in response.data
+
+    layout = client.get('/data/_dash-layout')
+    assert layout.status_code == 200
+    assert layout.get_json()['type'] == 'Div'
+
+
+def test_simulator_per_app(database, tmp_path):
+    from app import create_app
+    apps = [create_app({'SQLALCHEMY_DATABASE_URI': database,
+                        'UPLOAD_FOLDER': str(tmp_path), 'TESTING': True})
+            for _ in range(2)]
+    servers = [app.wsgi_app.server() for app in apps]
+    assert servers[0] is not servers[1]
+    for app, server in zip(apps, servers):
+        assert server.instance_path == app.instance_path
+        assert server.config['SQLALCHEMY_DATABASE_URI'] == database
+        assert app.test_client().get('/data/').status_code == 200
+
+
+def test_simulator_shares_relative_database(tmp_path, monkeypatch):
+    # A relative sqlite URI is resolved against the instance folder, so the
+    # simulator must open it in the main app's folder, not its own (which
+    # Flask puts under the working directory)
+    from app import create_app, db
+    monkeypatch.chdir(tmp_path)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///theospec.db',
+                      'UPLOAD_FOLDER': str(tmp_path)})
+    server = app.wsgi_app.server()
+    with app.app_context():
+        url = db.engine.url
+    with server.app_context():
+        assert db.engine.url == url
+    assert url.database.startswith(app.instance_path)
+
+
+def test_metrics(client):
+    client.post('/api/v1/reflectance',
+                json={'stacks': [{'materials': ['SiO2'], 'thicknesses': [100]}],
+                      'grid': [400, 500]})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'theospec_request_duration_seconds_count{name="api.reflectance"}' \
+        in text
+    assert 'theospec_http_request_duration_seconds_bucket' in text
+    assert 'theospec_tmm_evaluations_total' in text
+
+
+def test_simulator_callbacks(app):
+    import numpy as np
+    from app.exports import export_store
+    from app.spectra import SPECTRAL_GRID
+    from app.timing import timings
+    with app.app_context():
+        from app.simulator import generate_callback
+        callback = generate_callback(2, 1)
+        # Films and thicknesses (A) as the layout's hidden divs hold them
+        active, trench = "['SiO2', 'SiN']*[1000, 500]", "['SiO2']*[3000]"
+        graph = callback(active, trench, 'r-spectra', 1.0, 40, 10000)
+        trace = graph.children[0].figure['data'][0]
+        lam_min, lam_max = SPECTRAL_GRID.wavelengths[[0, -1]]
+        assert lam_min <= trace['x'][0] < trace['x'][-1] <= lam_max
+        assert timings.records('simulator.spectra')[-1]['tab'] == 'r-spectra'
+
+        graph = callback(active, trench, 'contour', 1.0, 40, 10000)
+    record = timings.records('simulator.spectra')[-1]
+    assert record['matrix_shape'][0] == len(SPECTRAL_GRID)
+    # The export links point at the matrix kept in the export store
+    link = graph.children[1].children[1].href
+    job = export_store.get(link.split('/')[-1].split('.')[0])
+    np.testing.assert_array_equal(job.wavelengths, SPECTRAL_GRID.wavelengths)
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import batch, spectra
+from app.grids import UniformGrid
+from tests.materials import MATERIALS, NK_WAVELENGTHS
+
+STACKS_CSV = """name,materials,thicknesses,incoherent
+a,SiO2;SiN,100;40,
+b,SiO2,400,
+c,SiO2;SiN,10;300,
+d,SiO2;Poly,20000;30,0
+"""
+
+
+@pytest.fixture
+def library(tmp_path):
+    path = str(tmp_path / 'nk.csv')
+    pd.concat([pd.DataFrame({'material': name, 'wavelength': NK_WAVELENGTHS,
+                             'n': nk_fn(NK_WAVELENGTHS).real,
+                             'k': nk_fn(NK_WAVELENGTHS).imag})
+               for name, nk_fn in MATERIALS.items()]).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def stacks(tmp_path):
+    path = tmp_path / 'stacks.csv'
+    path.write_text(STACKS_CSV)
+    return str(path)
+
+
+def test_load_stacks(stacks):
+    loaded = batch.load_stacks(stacks)
+    assert loaded.names == ['a', 'b', 'c', 'd']
+    assert loaded.stacks[0] == (['SiO2', 'SiN'], [100.0, 40.0], [])
+    assert loaded.stacks[3][2] == [0]
+    assert loaded.materials() == ['Poly', 'Si', 'SiN', 'SiO2']
+
+
+def test_load_stacks_yaml(tmp_path):
+    pytest.importorskip('yaml')
+    path = tmp_path / 'stacks.yaml'
+    path.write_text('medium: 1.33\nangle: 30\npol: p\n'
+                    'grid: {start: 400, stop: 500, step: 50}\n'
+                    'stacks:\n- {materials: [SiO2], thicknesses: [100]}\n')
+    loaded = batch.load_stacks(str(path))
+    assert loaded.medium == 1.33 and loaded.pol == 'p'
+    assert loaded.th_0 == pytest.approx(np.radians(30))
+    assert loaded.grid == UniformGrid(400, 500, 50)
+    path.write_text('pol: x\nstacks:\n- {materials: [SiO2], '
+                    'thicknesses: [100]}\n')
+    with pytest.raises(ValueError, match='pol must be'):
+        batch.load_stacks(str(path))
+
+
+def test_load_stacks_errors(tmp_path):
+    path = tmp_path / 'stacks.csv'
+    path.write_text('materials,thicknesses\nSiO2;SiN,100\n')
+    with pytest.raises(ValueError, match='one thickness per film'):
+        batch.load_stacks(str(path))
+    with pytest.raises(ValueError, match='Unknown stack file format'):
+        batch.load_stacks(str(path), file_format='xlsx')
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_run_batch_matches_spectra(materials, stacks, library, max_workers):
+    loaded = batch.load_stacks(stacks)
+    loaded.grid = UniformGrid(400, 800, 10)
+    nk = batch.resolve_materials(loaded.materials(), loaded.grid,
+                                 batch.load_material_library(library))
+    R = batch.run_batch(loaded, nk, max_workers=max_workers, chunk_size=1)
+    expected = spectra.compute_reflectance_many(loaded.stacks, 1.0,
+                                                grid=loaded.grid)
+    np.testing.assert_allclose(R, expected, rtol=1e-10)
+
+
+def test_run_batch_rejects_bad_incoherent(tmp_path, library):
+    path = tmp_path / 'stacks.csv'
+    path.write_text('materials,thicknesses,incoherent\nSiO2;SiN,100;40,2\n')
+    loaded = batch.load_stacks(str(path))
+    nk = batch.resolve_materials(loaded.materials(), loaded.grid,
+                                 batch.load_material_library(library))
+    with pytest.raises(ValueError, match='between 0 and 1'):
+        batch.run_batch(loaded, nk, max_workers=1)
+
+
+def test_main(tmp_path, stacks, library, capsys):
+    output = str(tmp_path / 'out.npz')
+    assert batch.main(['run', stacks, '-o', output, '--materials', library,
+                       '--grid', '400', '800', '10', '--workers', '1',
+                       '--relative-to-si']) == 0
+    assert 'Wrote' in capsys.readouterr().out
+    result = np.load(output)
+    assert result['r'].shape == (4, 41)
+    np.testing.assert_array_equal(result['name'], ['a', 'b', 'c', 'd'])
+    np.testing.assert_array_equal(result['thickness'][1], [400, np.nan])
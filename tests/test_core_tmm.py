@@ -0,0 +1,393 @@
+import numpy as np
+import pytest
+from numpy import inf
+
+from app import core_tmm
+from tests.materials import MATERIALS
+
+LAM = np.linspace(300, 1600, 61)
+
+
+def stack_n(names, medium=1.0, lam=LAM):
+    """
+    n_array of medium, the named films and a Si substrate
+    """
+    return np.array([np.full(lam.size, medium, dtype=complex)]
+                    + [MATERIALS[name](lam) for name in names]
+                    + [MATERIALS['Si'](lam)])
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+@pytest.mark.parametrize('th_0', [0, 0.4])
+def test_coh_tmm_spectrum_matches_scalar(pol, th_0):
+    n_array = stack_n(['SiO2', 'SiN', 'Poly'])
+    d_list = [inf, 120, 45, 300, inf]
+    spectrum = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, th_0, LAM)
+    for key in ('r', 't', 'R', 'T'):
+        expected = [core_tmm.coh_tmm(pol, n_array[:, j], d_list, th_0,
+                                     lam_vac)[key]
+                    for j, lam_vac in enumerate(LAM)]
+        np.testing.assert_allclose(spectrum[key], expected, rtol=1e-10,
+                                   atol=1e-13)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_coh_tmm_spectrum_matches_tmm(pol):
+    tmm = pytest.importorskip('tmm')
+    n_array = stack_n(['SiN', 'SiO2'], medium=1.3333)
+    d_list = [inf, 80, 500, inf]
+    R = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, 0.3, LAM)['R']
+    expected = [tmm.coh_tmm(pol, list(n_array[:, j]), d_list, 0.3,
+                            lam_vac)['R']
+                for j, lam_vac in enumerate(LAM)]
+    np.testing.assert_allclose(R, expected, rtol=1e-10, atol=1e-13)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_jacobian_matches_finite_differences(pol):
+    n_array = stack_n(['SiO2', 'SiN', 'Poly'])
+    d_list = np.array([inf, 120, 45, 30, inf])
+    dR_dd = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, 0.3, LAM,
+                                      jacobian=True)['dR_dd']
+    assert dR_dd.shape == (d_list.size, LAM.size)
+    assert not dR_dd[0].any() and not dR_dd[-1].any()
+    h = 1e-4
+    for i in range(1, d_list.size - 1):
+        up, down = d_list.copy(), d_list.copy()
+        up[i] += h
+        down[i] -= h
+        numeric = (core_tmm.coh_tmm_spectrum(pol, n_array, up, 0.3, LAM)['R']
+                   - core_tmm.coh_tmm_spectrum(pol, n_array, down, 0.3,
+                                               LAM)['R']) / (2 * h)
+        np.testing.assert_allclose(dR_dd[i], numeric, rtol=1e-5, atol=1e-9)
+
+
+def test_coh_tmm_spectrum_rejects_bad_shapes():
+    with pytest.raises(ValueError):
+        core_tmm.coh_tmm_spectrum('s', stack_n(['SiO2']), [inf, 10, 10, inf],
+                                  0, LAM)
+
+
+def test_coh_tmm_batch_matches_spectrum():
+    n_array = stack_n(['SiO2', 'Poly'])
+    d_array = [[inf, 100, 20, inf], [inf, 0, 250, inf], [inf, 900, 5, inf]]
+    R = core_tmm.coh_tmm_batch('s', n_array, d_array, 0, LAM)
+    assert R.shape == (3, LAM.size)
+    for row, d_list in zip(R, d_array):
+        np.testing.assert_allclose(
+            row, core_tmm.coh_tmm_spectrum('s', n_array, d_list, 0, LAM)['R'],
+            rtol=1e-10, atol=1e-13)
+
+
+def test_coh_tmm_spectrum_threaded_matches_spectrum():
+    n_array = stack_n(['SiN'])
+    d_list = [inf, 300, inf]
+    plain = core_tmm.coh_tmm_spectrum('p', n_array, d_list, 0.2, LAM,
+                                      jacobian=True)
+    threaded = core_tmm.coh_tmm_spectrum_threaded('p', n_array, d_list, 0.2,
+                                                  LAM, jacobian=True,
+                                                  chunk_size=16)
+    for key in ('R', 'T', 'dR_dd'):
+        np.testing.assert_allclose(threaded[key], plain[key], rtol=1e-12)
+
+
+def test_opacity_warning():
+    n_array = stack_n(['Poly'])
+    with pytest.warns(core_tmm.OpacityWarning):
+        core_tmm.coh_tmm_spectrum('s', n_array, [inf, 1e6, inf], 0, LAM)
+
+
+def test_compiled_stack_matches_spectrum():
+    films = [MATERIALS['SiO2'], MATERIALS['SiN']]
+    stack = core_tmm.CompiledStack([1.0] + films + [MATERIALS['Si']],
+                                   [inf, 0, 0, inf])
+    thicknesses = [[100, 40], [10, 300]]
+    R = stack.reflectance_batch(thicknesses, LAM)
+    n_array = stack_n(['SiO2', 'SiN'])
+    for row, (d_1, d_2) in zip(R, thicknesses):
+        np.testing.assert_allclose(
+            row, core_tmm.coh_tmm_spectrum('s', n_array, [inf, d_1, d_2, inf],
+                                           0, LAM)['R'],
+            rtol=1e-10, atol=1e-13)
+
+
+def counting(n_fn, calls):
+    def counted(lam):
+        calls.append(n_fn)
+        return n_fn(lam)
+    return counted
+
+
+def test_compiled_stack_shares_repeated_materials():
+    calls = []
+    sio2 = counting(MATERIALS['SiO2'], calls)
+    sin = counting(MATERIALS['SiN'], calls)
+    stack = core_tmm.CompiledStack([1.0, sio2, sin, sio2, sin, 1.0 + 0j,
+                                    MATERIALS['Si']],
+                                   [inf, 100, 40, 100, 40, 10, inf])
+    assert len(stack.n_fns) == 4
+    stack.reflectance(LAM)
+    assert len(calls) == 2
+
+
+def test_calc_reflectances_shares_repeated_materials():
+    calls = []
+    sio2 = counting(MATERIALS['SiO2'], calls)
+    sin = counting(MATERIALS['SiN'], calls)
+    air = lambda lam: 1.0
+    core_tmm.calc_reflectances([air, sio2, sin, sio2, sin, MATERIALS['Si']],
+                               [inf, 100, 40, 100, 40, inf], 0,
+                               spectral_range='narrow')
+    # The narrow-range wrappers must not hide that the layers repeat
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_inc_tmm_spectrum_matches_scalar(pol):
+    n_array = stack_n(['SiO2', 'SiN', 'SiO2'])
+    d_list = [inf, 200, 50000, 150, inf]
+    c_list = ['i', 'c', 'i', 'c', 'i']
+    spectrum = core_tmm.inc_tmm_spectrum(pol, n_array, d_list, c_list, 0.2, LAM)
+    for key in ('R', 'T'):
+        expected = [core_tmm.inc_tmm(pol, n_array[:, j], d_list, c_list, 0.2,
+                                     lam_vac)[key]
+                    for j, lam_vac in enumerate(LAM)]
+        np.testing.assert_allclose(spectrum[key], expected, rtol=1e-10,
+                                   atol=1e-13)
+
+
+def test_inc_tmm_spectrum_matches_tmm():
+    tmm = pytest.importorskip('tmm')
+    n_array = stack_n(['SiO2', 'SiN'])
+    d_list = [inf, 20000, 90, inf]
+    c_list = ['i', 'i', 'c', 'i']
+    R = core_tmm.inc_tmm_spectrum('s', n_array, d_list, c_list, 0, LAM)['R']
+    expected = [tmm.inc_tmm('s', list(n_array[:, j]), d_list, c_list, 0,
+                            lam_vac)['R']
+                for j, lam_vac in enumerate(LAM)]
+    np.testing.assert_allclose(R, expected, rtol=1e-10, atol=1e-13)
+
+
+def test_coh_tmm_spectrum_reverse_matches_scalar():
+    n_array = stack_n(['SiO2', 'SiN'])
+    d_list = [inf, 150, 60, inf]
+    R = core_tmm.coh_tmm_spectrum_reverse('p', n_array, d_list, 0.3, LAM)['R']
+    expected = [core_tmm.coh_tmm_reverse('p', n_array[:, j], d_list, 0.3,
+                                         lam_vac)['R']
+                for j, lam_vac in enumerate(LAM)]
+    np.testing.assert_allclose(R, expected, rtol=1e-10, atol=1e-13)
+
+
+def test_compiled_stack_incoherent():
+    stack = core_tmm.CompiledStack(
+        [1.0, MATERIALS['SiO2'], MATERIALS['SiN'], MATERIALS['Si']],
+        [inf, 30000, 90, inf], c_list=['i', 'i', 'c', 'i'])
+    R = core_tmm.inc_tmm_spectrum('s', stack_n(['SiO2', 'SiN']),
+                                  [inf, 30000, 90, inf], ['i', 'i', 'c', 'i'],
+                                  0, LAM)['R']
+    np.testing.assert_allclose(stack.reflectance(LAM), R, rtol=1e-10,
+                               atol=1e-13)
+
+
+@pytest.mark.parametrize('th_0', [0.1, 0.9])
+def test_coh_tmm_sp_matches_tmm(th_0):
+    tmm = pytest.importorskip('tmm')
+    n_array = stack_n(['SiO2', 'SiN'], medium=1.3333)
+    d_list = [inf, 300, 70, inf]
+    data = core_tmm.coh_tmm_sp(n_array, d_list, th_0, LAM)
+    for j, lam_vac in enumerate(LAM):
+        n_list = list(n_array[:, j])
+        for pol in ('s', 'p'):
+            expected = tmm.coh_tmm(pol, n_list, d_list, th_0, lam_vac)
+            for key in ('r', 't', 'R', 'T'):
+                assert data[key + pol][j] == pytest.approx(expected[key],
+                                                           rel=1e-10, abs=1e-13)
+        ellips = tmm.ellips(n_list, d_list, th_0, lam_vac)
+        assert data['psi'][j] == pytest.approx(ellips['psi'], rel=1e-10)
+        assert data['Delta'][j] == pytest.approx(ellips['Delta'], rel=1e-10)
+        unpolarized = tmm.unpolarized_RT(n_list, d_list, th_0, lam_vac)
+        assert data['R'][j] == pytest.approx(unpolarized['R'], rel=1e-10)
+        assert data['T'][j] == pytest.approx(unpolarized['T'], rel=1e-10)
+
+
+def test_coh_tmm_sp_angle_map():
+    n_array = stack_n(['SiN'])
+    angles = np.array([0, 0.3, 0.6])
+    data = core_tmm.coh_tmm_sp(n_array, [inf, 120, inf], angles, LAM)
+    assert data['Rp'].shape == (3, LAM.size)
+    for i, th_0 in enumerate(angles):
+        np.testing.assert_allclose(
+            data['Rp'][i], core_tmm.coh_tmm_spectrum('p', n_array,
+                                                     [inf, 120, inf], th_0,
+                                                     LAM)['R'],
+            rtol=1e-10, atol=1e-13)
+
+
+def test_ellips_and_unpolarized_RT_match_tmm():
+    tmm = pytest.importorskip('tmm')
+    n_list = list(stack_n(['SiO2'], lam=np.array([633.]))[:, 0])
+    d_list = [inf, 250, inf]
+    for ours, theirs in ((core_tmm.ellips, tmm.ellips),
+                         (core_tmm.unpolarized_RT, tmm.unpolarized_RT)):
+        expected = theirs(n_list, d_list, 0.7, 633)
+        for key, value in ours(n_list, d_list, 0.7, 633).items():
+            assert value == pytest.approx(expected[key], rel=1e-10)
+
+
+def trapezoid(y, x, axis=0):
+    y, x = np.moveaxis(y, axis, 0), np.moveaxis(x, axis, 0)
+    return np.sum((y[1:] + y[:-1]) * np.diff(x, axis=0), axis=0) / 2
+
+
+@pytest.mark.parametrize('pupil', ['aplanatic', 'uniform'])
+def test_coh_tmm_na_matches_tmm_cone_integral(pupil):
+    tmm = pytest.importorskip('tmm')
+    lam = LAM[::12]
+    n_array = stack_n(['SiO2', 'SiN'], lam=lam)
+    d_list = [inf, 400, 60, inf]
+    data = core_tmm.coh_tmm_na(n_array, d_list, 0.6, lam, num_angles=24,
+                               na_min=0.1, pupil=pupil)
+    assert data['weights'].sum() == pytest.approx(1)
+    # Brute-force cone average, one tmm.coh_tmm call per angle
+    th = np.linspace(np.arcsin(0.1), np.arcsin(0.6), 801)
+    weight = np.sin(th) * (np.cos(th) if pupil == 'aplanatic' else 1)
+    for j, lam_vac in enumerate(lam):
+        n_list = list(n_array[:, j])
+        for pol in ('s', 'p'):
+            R = [tmm.coh_tmm(pol, n_list, d_list, angle, lam_vac)['R']
+                 for angle in th]
+            expected = trapezoid(weight * R, th) / trapezoid(weight, th)
+            assert data['R' + pol][j] == pytest.approx(expected, rel=1e-5)
+
+
+def test_coh_tmm_na_small_cone_is_normal_incidence():
+    n_array = stack_n(['SiN'])
+    data = core_tmm.coh_tmm_na(n_array, [inf, 200, inf], 1e-4, LAM)
+    np.testing.assert_allclose(
+        data['R'], core_tmm.coh_tmm_spectrum('s', n_array, [inf, 200, inf], 0,
+                                             LAM)['R'], rtol=1e-7, atol=1e-9)
+    with pytest.raises(ValueError):
+        core_tmm.coh_tmm_na(n_array, [inf, 200, inf], 1.2, LAM)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_position_resolved_spectrum_matches_tmm(pol):
+    tmm = pytest.importorskip('tmm')
+    lam = LAM[::6]
+    n_array = stack_n(['SiO2', 'Poly'], lam=lam)
+    d_list = [inf, 150, 40, inf]
+    data = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, 0.4, lam)
+    distances = np.array([-20, 0, 37.5, 150, 170, 189.9, 190, 260])
+    field = core_tmm.position_resolved_spectrum(distances, data)
+    np.testing.assert_allclose(
+        core_tmm.vw_list_spectrum(data)[1:].transpose(2, 0, 1),
+        [tmm.coh_tmm(pol, list(n_array[:, j]), d_list, 0.4,
+                     lam_vac)['vw_list'][1:]
+         for j, lam_vac in enumerate(lam)], rtol=1e-10, atol=1e-13)
+    for j, lam_vac in enumerate(lam):
+        expected_data = tmm.coh_tmm(pol, list(n_array[:, j]), d_list, 0.4,
+                                    lam_vac)
+        for i, distance in enumerate(distances):
+            layer, z = tmm.find_in_structure_with_inf(d_list, distance)
+            assert (field['layer'][i], field['z'][i]) == (layer, z)
+            expected = tmm.position_resolved(layer, z, expected_data)
+            for key in ('poyn', 'absor', 'Ex', 'Ey', 'Ez'):
+                assert field[key][i, j] == pytest.approx(
+                    expected[key], rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_absorp_analytic_fn_array_matches_tmm(pol):
+    tmm = pytest.importorskip('tmm')
+    lam = LAM[::6]
+    n_array = stack_n(['SiO2', 'Poly', 'SiN'], lam=lam)
+    d_list = [inf, 150, 40, 80, inf]
+    data = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, 0.3, lam)
+    layers = np.array([1, 2, 3])
+    fn = core_tmm.absorp_analytic_fn_array().fill_in(data, layers)
+    flipped = fn.copy().flip()
+    z = np.linspace(0, 1, 2001)[:, None, None] * fn.d + np.zeros(lam.size)
+    absorbed = trapezoid(fn.run(z), z, axis=0)
+    for j, lam_vac in enumerate(lam):
+        expected_data = tmm.coh_tmm(pol, list(n_array[:, j]), d_list, 0.3,
+                                    lam_vac)
+        per_layer = tmm.absorp_in_each_layer(expected_data)
+        for i, layer in enumerate(layers):
+            expected = tmm.absorp_analytic_fn().fill_in(expected_data, layer)
+            np.testing.assert_allclose(fn.run(z)[:, i, j],
+                                       expected.run(z[:, i, j]),
+                                       rtol=1e-9, atol=1e-15)
+            np.testing.assert_allclose(flipped.run(z)[:, i, j],
+                                       expected.flip().run(z[:, i, j]),
+                                       rtol=1e-9, atol=1e-15)
+            # Integrating the profile over the layer gives its absorption
+            assert absorbed[i, j] == pytest.approx(per_layer[layer], rel=1e-5,
+                                                   abs=1e-12)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_absorp_in_each_layer_spectrum_matches_tmm(pol):
+    tmm = pytest.importorskip('tmm')
+    n_array = stack_n(['SiO2', 'Poly', 'SiN'])
+    d_list = [inf, 150, 40, 80, inf]
+    data = core_tmm.coh_tmm_spectrum(pol, n_array, d_list, 0.3, LAM)
+    absorbed = core_tmm.absorp_in_each_layer_spectrum(data)
+    assert absorbed.shape == (LAM.size, len(d_list))
+    np.testing.assert_allclose(absorbed.sum(axis=1), 1, rtol=1e-10)
+    expected = [tmm.absorp_in_each_layer(tmm.coh_tmm(pol, list(n_array[:, j]),
+                                                     d_list, 0.3, lam_vac))
+                for j, lam_vac in enumerate(LAM)]
+    np.testing.assert_allclose(absorbed, expected, rtol=1e-9, atol=1e-13)
+
+
+@pytest.mark.parametrize('pol', ['s', 'p'])
+def test_inc_absorp_in_each_layer_spectrum_matches_tmm(pol):
+    tmm = pytest.importorskip('tmm')
+    n_array = stack_n(['SiO2', 'SiN', 'Poly', 'SiO2'])
+    d_list = [inf, 20000, 90, 30, 150, inf]
+    c_list = ['i', 'i', 'c', 'c', 'i', 'i']
+    data = core_tmm.inc_tmm_spectrum(pol, n_array, d_list, c_list, 0.2, LAM)
+    absorbed = core_tmm.inc_absorp_in_each_layer_spectrum(data)
+    assert absorbed.shape == (LAM.size, len(d_list))
+    expected = [tmm.inc_absorp_in_each_layer(
+                    tmm.inc_tmm(pol, list(n_array[:, j]), d_list, c_list, 0.2,
+                                lam_vac))
+                for j, lam_vac in enumerate(LAM)]
+    np.testing.assert_allclose(absorbed, expected, rtol=1e-9, atol=1e-13)
+
+
+def test_adaptive_spectrum_meets_tolerance():
+    stack = core_tmm.CompiledStack([1.0, MATERIALS['SiO2'], MATERIALS['Si']],
+                                   [inf, 3000, inf])
+    lam, R, converged = core_tmm.adaptive_spectrum(stack.reflectance, 300,
+                                                   1500, tol=1e-3)
+    assert converged
+    assert lam[0] == pytest.approx(300) and lam[-1] == pytest.approx(1500)
+    assert np.all(np.diff(lam) > 0)
+    np.testing.assert_allclose(R, stack.reflectance(lam), rtol=1e-12)
+    dense = np.linspace(300, 1500, 20001)
+    error = abs(np.interp(dense, lam, R) - stack.reflectance(dense))
+    assert error.max() < 5e-3
+
+
+def test_adaptive_spectrum_respects_budget():
+    stack = core_tmm.CompiledStack([1.0, MATERIALS['SiO2'], MATERIALS['Si']],
+                                   [inf, 30000, inf])
+    lam, R, converged = core_tmm.adaptive_spectrum(stack.reflectance, 300,
+                                                   1500, tol=1e-4,
+                                                   max_points=500)
+    assert not converged
+    assert lam.size == 500
+
+
+def test_calc_reflectances_adaptive():
+    n_fns = [1.0, MATERIALS['SiN'], MATERIALS['Si']]
+    samples, resampled = core_tmm.calc_reflectances(
+        n_fns, [inf, 400, inf], 0, spectral_range='full', tol=1e-3,
+        display_grid=(300, 1400, 10))
+    np.testing.assert_array_equal(resampled[:, 0], np.arange(300, 1401, 10))
+    dense = core_tmm.calc_reflectances(n_fns, [inf, 400, inf], 0,
+                                       spectral_range='full',
+                                       grid=(300, 1400, 10))
+    assert len(samples) < len(core_tmm.DEFAULT_GRID)
+    np.testing.assert_allclose(resampled[:, 1], dense[:, 1], atol=1e-3)
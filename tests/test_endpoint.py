@@ -0,0 +1,100 @@
+import socket
+import threading
+
+import numpy as np
+import pytest
+from numpy import inf
+
+from app.core_tmm import coh_tmm_batch
+from app.endpoint import EndpointDetector, Trajectory, socket_frames
+from app.exports import ExportJob, iter_export
+from tests.test_core_tmm import LAM, stack_n
+
+START, RATE = 500., 5. # nm, nm per step
+
+
+def polish_spectra(thicknesses):
+    d_array = [[inf, d, inf] for d in thicknesses]
+    return coh_tmm_batch('s', stack_n(['SiO2']), d_array, 0, LAM)
+
+
+@pytest.fixture(scope='module')
+def trajectory():
+    steps = np.arange(81)
+    return Trajectory.from_matrix(polish_spectra(START - RATE * steps).T,
+                                  START, RATE, wavelengths=LAM)
+
+
+def test_trajectory_from_matrix(trajectory):
+    assert trajectory.spectra.shape == (81, LAM.size)
+    assert trajectory.thickness[0] == START
+    assert trajectory.thickness[-1] == START - 80 * RATE
+    with pytest.raises(ValueError):
+        Trajectory(trajectory.spectra, trajectory.times[1:],
+                   trajectory.thickness)
+
+
+def test_trajectory_from_csv(trajectory, tmp_path):
+    # As exported from the contour tab
+    job = ExportJob(trajectory.spectra.T, LAM, trajectory.times)
+    path = tmp_path / 'matrix.csv'
+    path.write_text(''.join(iter_export(job, 'csv')))
+    loaded = Trajectory.from_csv(str(path), START, RATE)
+    np.testing.assert_allclose(loaded.spectra, trajectory.spectra, rtol=1e-9)
+    np.testing.assert_array_equal(loaded.thickness, trajectory.thickness)
+    np.testing.assert_allclose(loaded.wavelengths, LAM, rtol=1e-9)
+
+
+def test_detector_follows_polish(trajectory):
+    detector = EndpointDetector(trajectory, target_thickness=200)
+    # Half-step sampling, with the lamp drifting brighter over the run
+    thicknesses = START - RATE * np.arange(0, 40, 0.5)
+    frames = polish_spectra(thicknesses) * np.linspace(1, 1.3, 80)[:, None]
+    results = list(detector.run(frames))
+    np.testing.assert_allclose([r['thickness'] for r in results], thicknesses,
+                               atol=0.5)
+
+
+def test_detector_fires_once_at_target(trajectory):
+    fired = []
+    detector = EndpointDetector(trajectory, target_thickness=202.5,
+                                confirm=3, on_endpoint=fired.append)
+    thicknesses = START - RATE * np.arange(80)
+    results = list(detector.run(polish_spectra(thicknesses)))
+    endpoints = [i for i, r in enumerate(results) if r['endpoint']]
+    # Step 60 (200 nm) is the first past the target; confirmed two frames on
+    assert endpoints == [62]
+    assert len(fired) == 1 and fired[0]['frame'] == 63
+    assert fired[0]['remaining'] <= 0
+    detector.reset()
+    assert detector.endpoint is None and detector.index is None
+
+
+def test_detector_relocks_after_jump(trajectory):
+    detector = EndpointDetector(trajectory, target_thickness=0, window=4,
+                                relock_distance=1e-3)
+    detector.update(polish_spectra([START])[0])
+    result = detector.update(polish_spectra([START - 50 * RATE])[0])
+    assert result['thickness'] == pytest.approx(START - 50 * RATE, abs=0.5)
+
+
+def test_socket_frames():
+    frames = polish_spectra([400, 300, 200])
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def send():
+        conn, _ = server.accept()
+        with conn:
+            # Split mid-frame to exercise the reassembly
+            payload = frames.astype('<f8').tobytes()
+            conn.sendall(payload[:100])
+            conn.sendall(payload[100:])
+        server.close()
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    received = list(socket_frames(server.getsockname(), LAM.size, timeout=5))
+    sender.join()
+    np.testing.assert_array_equal(received, frames)
@@ -0,0 +1,67 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.exports import ExportJob, ExportStore, export_store, iter_export
+
+WAVELENGTHS = np.arange(400.0, 410)
+TIMES = np.arange(3.0)
+R = np.arange(30.0).reshape(10, 3) / 30
+
+
+def test_store_keeps_most_recent():
+    store = ExportStore(max_jobs=2)
+    ids = [store.register(R, WAVELENGTHS, TIMES) for _ in range(3)]
+    assert len(store) == 2
+    assert store.get(ids[0]) is None
+    assert store.get(ids[2]) is not None
+
+
+def test_job_shape_checked():
+    with pytest.raises(ValueError):
+        ExportJob(R, WAVELENGTHS[:-1], TIMES)
+
+
+def test_csv_roundtrip():
+    job = ExportJob(R, WAVELENGTHS, TIMES)
+    text = ''.join(iter_export(job, 'csv', chunk_rows=4))
+    df = pd.read_csv(io.StringIO(text), index_col=0)
+    np.testing.assert_array_equal(df.index, WAVELENGTHS)
+    np.testing.assert_allclose(df.values, R)
+
+
+def test_npz_roundtrip():
+    job = ExportJob(R, WAVELENGTHS, TIMES)
+    archive = np.load(io.BytesIO(b''.join(iter_export(job, 'npz',
+                                                      chunk_rows=4))))
+    np.testing.assert_array_equal(archive['wavelength'], WAVELENGTHS)
+    np.testing.assert_array_equal(archive['time'], TIMES)
+    np.testing.assert_array_equal(archive['r'], R)
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        iter_export(ExportJob(R, WAVELENGTHS, TIMES), 'xlsx')
+
+
+def test_download(client):
+    job_id = export_store.register(R, WAVELENGTHS, TIMES)
+    response = client.get('/export/{}.csv'.format(job_id))
+    assert response.status_code == 200
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert response.data.startswith(b'wavelength,0,1,2\n')
+    assert client.get('/export/{}.xlsx'.format(job_id)).status_code == 404
+    assert client.get('/export/unknown.csv').status_code == 404
+
+
+def test_parquet_roundtrip():
+    pq = pytest.importorskip('pyarrow.parquet')
+    job = ExportJob(R, WAVELENGTHS, TIMES)
+    table = pq.read_table(io.BytesIO(b''.join(iter_export(job, 'parquet',
+                                                          chunk_rows=4))))
+    np.testing.assert_array_equal(table.column('wavelength').to_pylist(),
+                                  WAVELENGTHS)
+    np.testing.assert_array_equal(table.column('2').to_pylist(), R[:, 2])
+    assert table.schema.metadata[b'time'] == b'0.0,1.0,2.0'
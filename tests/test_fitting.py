@@ -0,0 +1,57 @@
+import numpy as np
+from numpy import inf
+
+from app import fitting
+from app.core_tmm import coh_tmm_spectrum
+from app.fitting import fit_thicknesses
+from tests.test_core_tmm import LAM, stack_n
+
+
+def test_fit_recovers_thicknesses():
+    n_array = stack_n(['SiO2', 'SiN'])
+    true_d = [inf, 210, 65, inf]
+    measured = coh_tmm_spectrum('s', n_array, true_d, 0, LAM)['R']
+    fit = fit_thicknesses(n_array, [inf, 190, 80, inf], LAM, measured)
+    assert fit['converged']
+    np.testing.assert_allclose(fit['d_list'], true_d, rtol=1e-6)
+    assert fit['residual'] < 1e-8
+    assert fit['covariance'].shape == (2, 2)
+
+
+def test_fit_holds_unfitted_layers_and_uses_reference():
+    n_array = stack_n(['SiO2', 'SiN'])
+    reference = coh_tmm_spectrum('s', stack_n([]), [inf, inf], 0, LAM)['R']
+    measured = coh_tmm_spectrum('s', n_array, [inf, 150, 40, inf], 0,
+                                LAM)['R'] / reference
+    fit = fit_thicknesses(n_array, [inf, 170, 40, inf], LAM, measured,
+                          fit_layers=[1], reference=reference)
+    assert fit['d_list'][2] == 40
+    np.testing.assert_allclose(fit['d_list'][1], 150, rtol=1e-6)
+
+
+def test_fit_computes_jacobian_only_for_accepted_steps(monkeypatch):
+    calls = []
+
+    def counting_spectrum(*args, jacobian=False):
+        calls.append(jacobian)
+        return coh_tmm_spectrum(*args, jacobian=jacobian)
+
+    monkeypatch.setattr(fitting, 'coh_tmm_spectrum', counting_spectrum)
+    n_array = stack_n(['SiO2'])
+    measured = coh_tmm_spectrum('s', n_array, [inf, 300, inf], 0, LAM)['R']
+    fit = fit_thicknesses(n_array, [inf, 250, inf], LAM, measured)
+    assert fit['converged']
+    # One Jacobian for the starting point, then one per accepted step
+    assert sum(calls) == fit['n_iter'] + 1
+
+
+def test_fit_stall_is_not_convergence():
+    # With both tolerances off the only way out short of max_iter is the
+    # damping saturating, which must not be reported as converged
+    n_array = stack_n(['SiO2'])
+    measured = coh_tmm_spectrum('s', n_array, [inf, 300, inf], 0, LAM)['R']
+    fit = fit_thicknesses(n_array, [inf, 290, inf], LAM, measured, ftol=0,
+                          xtol=0, max_iter=200)
+    assert fit['n_iter'] < 200
+    assert not fit['converged']
+    np.testing.assert_allclose(fit['d_list'][1], 300, rtol=1e-6)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from app.grids import (DEFAULT_GRID, EnergyGrid, LogGrid, UniformGrid,
+                       WavelengthGrid, as_grid, grid_from_dict)
+
+
+def test_uniform_grid():
+    grid = UniformGrid(400, 410, 2.5)
+    np.testing.assert_array_equal(grid.wavelengths, [400, 402.5, 405, 407.5,
+                                                     410])
+    np.testing.assert_array_equal(np.asarray(grid), grid.wavelengths)
+
+
+def test_generated_grids_span_range():
+    for grid in (LogGrid(300, 1200, 50), EnergyGrid(300, 1200, 50)):
+        assert len(grid) == 50
+        np.testing.assert_allclose(grid.wavelengths[[0, -1]], [300, 1200])
+        assert np.all(np.diff(grid.wavelengths) > 0)
+
+
+def test_equal_grids_hash_equal():
+    assert UniformGrid(400, 500) == WavelengthGrid(np.arange(400, 501))
+    assert hash(UniformGrid(400, 500)) == hash(WavelengthGrid(range(400, 501)))
+    assert UniformGrid(400, 500) != UniformGrid(400, 500, 2)
+
+
+@pytest.mark.parametrize('wavelengths', [[], [[400, 500]], [500, 400],
+                                         [0, 400]])
+def test_invalid_grids(wavelengths):
+    with pytest.raises(ValueError):
+        WavelengthGrid(wavelengths)
+
+
+def test_as_grid():
+    assert as_grid() is DEFAULT_GRID
+    assert as_grid((400, 500, 10)) == UniformGrid(400, 500, 10)
+    assert as_grid([400, 450]) == WavelengthGrid([400, 450])
+
+
+
+def test_grid_from_dict():
+    assert grid_from_dict({'start': 400, 'stop': 500}) == UniformGrid(400, 500)
+    assert (grid_from_dict({'start': 400, 'stop': 500, 'num': 5,
+                            'spacing': 'log'}) == LogGrid(400, 500, 5))
+    assert grid_from_dict([400, 450]) == WavelengthGrid([400, 450])
+    with pytest.raises(ValueError, match='missing'):
+        grid_from_dict({'start': 400, 'spacing': 'energy'})
+    with pytest.raises(ValueError, match='Unknown grid spacing'):
+        grid_from_dict({'start': 400, 'stop': 500, 'spacing': 'cubic'})
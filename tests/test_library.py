@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from numpy import inf
+
+from app.core_tmm import coh_tmm_batch
+from app.library import SpectralLibrary
+from tests.test_core_tmm import LAM, stack_n
+
+AXES = [np.arange(50, 301, 10.0), np.arange(20, 121, 5.0)]
+
+
+@pytest.fixture(scope='module')
+def library():
+    return SpectralLibrary.build(stack_n(['SiO2', 'SiN']), [inf, 0, 0, inf],
+                                 [1, 2], AXES, LAM, n_components=12,
+                                 n_train=200)
+
+
+def grid_spectra(points):
+    d_array = [[inf, d_1, d_2, inf] for d_1, d_2 in points]
+    return coh_tmm_batch('s', stack_n(['SiO2', 'SiN']), d_array, 0, LAM)
+
+
+def test_match_recovers_grid_thicknesses(library):
+    points = [(120, 45), (280, 110), (50, 20)]
+    match = library.match(grid_spectra(points))
+    np.testing.assert_array_equal(match['d'], points)
+    np.testing.assert_allclose(match['distance'], 0, atol=1e-6)
+    single = library.match(grid_spectra(points[:1])[0])
+    np.testing.assert_array_equal(single['d'], points[0])
+
+
+def test_match_interpolates_off_grid(library):
+    # Halfway between grid points, the k nearest entries bracket the truth
+    match = library.match(grid_spectra([(125, 47.5)]), k=4)
+    np.testing.assert_allclose(match['d'], [[125, 47.5]], atol=5)
+
+
+def test_match_resamples_measured_wavelengths(library):
+    lam = np.linspace(LAM[0], LAM[-1], 400)
+    n_array = stack_n(['SiO2', 'SiN'], lam=lam)
+    measured = coh_tmm_batch('s', n_array, [[inf, 200, 80, inf]], 0, lam)
+    match = library.match(measured[0], wavelengths=lam)
+    np.testing.assert_array_equal(match['d'], [200, 80])
+
+
+def test_save_load_round_trip(library, tmp_path):
+    path = str(tmp_path / 'library.npz')
+    library.save(path)
+    loaded = SpectralLibrary.load(path)
+    spectra = grid_spectra([(70, 30), (230, 95)])
+    for key, value in library.match(spectra).items():
+        np.testing.assert_array_equal(loaded.match(spectra)[key], value)
+    assert loaded.pol == 's' and loaded.reference is None
+
+
+def test_build_checks_axes():
+    with pytest.raises(ValueError):
+        SpectralLibrary.build(stack_n(['SiO2']), [inf, 0, inf], [1], AXES, LAM)
@@ -0,0 +1,48 @@
+import numpy as np
+
+from app.payload import block_mean, line_trace, lttb, matrix_trace
+
+
+def test_lttb_keeps_ends_and_peak():
+    x = np.linspace(0, 1, 10001)
+    y = np.exp(-((x - 0.3137) / 0.001)**2)
+    kept = lttb(x, y, 200)
+    assert kept.size == 200
+    assert kept[0] == 0 and kept[-1] == x.size - 1
+    assert np.all(np.diff(kept) > 0)
+    # Every 50th point would only catch the peak's flank (0.18)
+    assert y[kept].max() > 0.5
+
+
+def test_lttb_short_lines_unchanged():
+    np.testing.assert_array_equal(lttb([1, 2, 3], [4, 5, 6], 10), [0, 1, 2])
+
+
+def test_line_trace():
+    x = np.arange(10000.0)
+    trace = line_trace(x, np.sin(x / 100), name='r', max_points=500)
+    assert trace['type'] == 'scattergl'
+    assert len(trace['x']) == len(trace['y']) == 500
+    assert trace['name'] == 'r'
+    assert line_trace([1, 2], [3, 4])['type'] == 'scatter'
+
+
+def test_block_mean():
+    z = np.arange(20.0).reshape(4, 5)
+    reduced, rows, cols = block_mean(z, (2, 5))
+    np.testing.assert_array_equal(reduced, [z[:2].mean(0), z[2:].mean(0)])
+    np.testing.assert_array_equal(rows, [0, 2])
+    np.testing.assert_array_equal(cols, np.arange(5))
+
+
+def test_matrix_trace_decimates_axes():
+    z = np.random.RandomState(0).rand(1250, 7)
+    y = np.arange(250.0, 1500)
+    trace = matrix_trace(z, x=np.arange(7), y=y, max_shape=(100, 100),
+                         colorscale='Jet')
+    assert trace['type'] == 'contour'
+    assert np.shape(trace['z']) == (100, 7)
+    assert len(trace['y']) == 100
+    assert trace['y'][0] > y[0] and trace['y'][-1] < y[-1]
+    assert trace['colorscale'] == 'Jet'
+    assert matrix_trace(z, heatmap_threshold=1000)['type'] == 'heatmap'
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+from app import spectra
+from app.grids import UniformGrid
+
+ACTIVE = (['SiO2', 'SiN'], [120, 40])
+TRENCH = (['SiO2'], [400])
+PERIPHERY = (['Poly', 'SiO2'], [30, 10])
+
+
+@pytest.fixture(autouse=True)
+def use_test_materials(materials):
+    pass
+
+
+def test_unique_stacks():
+    unique, index = spectra.unique_stacks([ACTIVE, TRENCH, (['SiO2'], [400.0])])
+    assert unique == [ACTIVE, TRENCH]
+    np.testing.assert_array_equal(index, [0, 1, 1])
+
+
+def test_mix_spectra_is_area_weighted_sum():
+    fractions = [0.5, 0.3, 0.2]
+    mixed = spectra.mix_spectra([ACTIVE, TRENCH, PERIPHERY], fractions, 1.0)
+    r = [spectra.compute_reflectance_1d(*stack, 1.0)
+         for stack in (ACTIVE, TRENCH, PERIPHERY)]
+    ref_si = spectra.compute_reflectance_1d([], [], 1.0).r.values
+    expected = sum(f * r_df.r.values for f, r_df in zip(fractions, r)) / ref_si
+    np.testing.assert_array_equal(mixed[:, 0], r[0].wavelength)
+    np.testing.assert_allclose(mixed[:, 1], expected, rtol=1e-9)
+
+
+def test_mix_spectra_sites_and_repeated_stacks():
+    sites = [[0.2, 0.5, 0.3], [1, 0, 0]]
+    mixed = spectra.mix_spectra([ACTIVE, TRENCH, ACTIVE], sites, 1.0)
+    assert mixed.shape[1] == 3
+    # Repeated stacks are folded together
+    folded = spectra.mix_spectra([ACTIVE, TRENCH], [0.5, 0.5], 1.0)
+    np.testing.assert_allclose(mixed[:, 1], folded[:, 1], rtol=1e-12)
+    alone = spectra.mix_spectra([ACTIVE], [1], 1.0)
+    np.testing.assert_allclose(mixed[:, 2], alone[:, 1], rtol=1e-12)
+
+
+def test_mix_spectra_checks_fractions():
+    with pytest.raises(ValueError, match='sum to 1'):
+        spectra.mix_spectra([ACTIVE, TRENCH], [0.5, 0.6], 1.0)
+    with pytest.raises(ValueError, match='one column per stack'):
+        spectra.mix_spectra([ACTIVE, TRENCH], [1.0], 1.0)
+
+
+def test_spectral_grid_is_default_grid():
+    from app.grids import DEFAULT_GRID
+    assert spectra.SPECTRAL_GRID == DEFAULT_GRID
+    r_df = spectra.compute_reflectance_1d(*ACTIVE, 1.0)
+    np.testing.assert_array_equal(r_df.wavelength, DEFAULT_GRID.wavelengths)
+
+
+def test_reflectance_on_grid():
+    grid = UniformGrid(300, 1495, 5)
+    r_df = spectra.compute_reflectance_1d(*ACTIVE, 1.0, grid=grid)
+    np.testing.assert_array_equal(r_df.wavelength, grid.wavelengths)
+    dense = spectra.compute_reflectance_1d(*ACTIVE, 1.0)
+    np.testing.assert_allclose(r_df.r, dense.r.values[50::5], rtol=1e-10)
+    batch = spectra.compute_reflectance_batch(ACTIVE[0], [ACTIVE[1], [0, 0]],
+                                              1.0, grid=grid)
+    np.testing.assert_allclose(batch[0], r_df.r, rtol=1e-10)
+
+
+def test_combine_spectra_on_grid():
+    grid = UniformGrid(300, 1500, 5)
+    active = spectra.compute_reflectance_1d(*ACTIVE, 1.0, grid=grid)
+    trench = spectra.compute_reflectance_1d(*TRENCH, 1.0, grid=grid)
+    ref_si = spectra.compute_reflectance_1d([], [], 1.0, grid=grid)
+    combined = spectra.combine_spectra(active, trench, 40, 1.0, grid=grid)
+    np.testing.assert_array_equal(combined[:, 0], grid.wavelengths)
+    np.testing.assert_allclose(combined[:, 1],
+                               (0.4 * active.r + 0.6 * trench.r) / ref_si.r,
+                               rtol=1e-10)
+    with pytest.raises(ValueError, match='not on the grid'):
+        spectra.combine_spectra(active, trench, 40, 1.0)
+
+
+def test_adaptive_matches_dense():
+    dense = spectra.combine_spectra(spectra.compute_reflectance_1d(*ACTIVE, 1.0),
+                                    spectra.compute_reflectance_1d(*TRENCH, 1.0),
+                                    40, 1.0)
+    adaptive = spectra.combined_spectrum_adaptive(*ACTIVE, *TRENCH, 40, 1.0,
+                                                  tol=1e-4)
+    assert len(adaptive) < len(spectra.SPECTRAL_GRID)
+    np.testing.assert_allclose(
+        np.interp(dense[:, 0], adaptive[:, 0], adaptive[:, 1]), dense[:, 1],
+        atol=1e-3)
+
+
+def test_adaptive_window():
+    window = spectra.combined_spectrum_adaptive(*ACTIVE, *TRENCH, 40, 1.0,
+                                                window=(100, 600), tol=1e-3)
+    assert window[0, 0] == pytest.approx(spectra.SPECTRAL_GRID.wavelengths[0])
+    assert window[-1, 0] == pytest.approx(600)
+    with pytest.raises(ValueError):
+        spectra.combined_spectrum_adaptive(*ACTIVE, *TRENCH, 40, 1.0,
+                                           window=(1600, 1700))
+
+
+def test_many_matches_1d():
+    grid = UniformGrid(300, 1495, 5)
+    stacks = [ACTIVE, TRENCH, (['SiO2', 'SiN'], [10, 300]),
+              (['SiO2', 'Poly'], [20000, 30], [0])]
+    R = spectra.compute_reflectance_many(stacks, 1.0, grid=grid)
+    assert R.shape == (len(stacks), len(grid))
+    for row, stack in zip(R, stacks):
+        incoherent = stack[2] if len(stack) > 2 else None
+        expected = spectra.compute_reflectance_1d(stack[0], stack[1], 1.0,
+                                                  incoherent=incoherent,
+                                                  grid=grid)
+        np.testing.assert_allclose(row, expected.r, rtol=1e-10)
+
+
+def test_many_relative_to_si():
+    R = spectra.compute_reflectance_many([ACTIVE, ([], [])], 1.3333,
+                                         relative_to_si=True)
+    np.testing.assert_allclose(R[1], 1)
+
+
+@pytest.mark.parametrize('stack, message', [
+    ((['Unobtainium'], [10]), 'Unknown material'),
+    ((['SiO2'], [10, 20]), 'one thickness per film'),
+    ((['SiO2', 'SiN'], [10, 20], [2]), 'between 0 and 1'),
+    ((['SiO2', 'SiN'], [10, 20], [-1]), 'between 0 and 1'),
+])
+def test_many_rejects_bad_stacks(stack, message):
+    with pytest.raises(ValueError, match=message):
+        spectra.compute_reflectance_many([ACTIVE, stack], 1.0)
+
+
+def test_polish_matrix_starts_at_combined_spectrum():
+    matrix = spectra.polish_spectra_matrix(*ACTIVE, *TRENCH, 40, 1.0, 5, 4)
+    assert matrix.shape == (len(spectra.SPECTRAL_GRID), 4)
+    start = spectra.combine_spectra(spectra.compute_reflectance_1d(*ACTIVE, 1.0),
+                                    spectra.compute_reflectance_1d(*TRENCH, 1.0),
+                                    40, 1.0)
+    np.testing.assert_allclose(matrix[:, 0], start[:, 1], rtol=1e-10)
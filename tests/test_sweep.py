@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from numpy import inf
+
+from app.core_tmm import coh_tmm_spectrum
+from app.spectra import stack_nk
+from app.sweep import DOESweep, SharedSweepResult, parallel_sweep, write_npz
+
+LAM = np.linspace(300, 1500, 41)
+
+
+@pytest.fixture
+def sweep(materials):
+    return DOESweep(['SiO2', 'SiN'], [[100, 150, 200], 40], ['SiO2'],
+                    [[300, 600]], pattern_densities=[20, 80],
+                    media=[1.0, 1.3333], lam_vac_list=LAM)
+
+
+def expected_r(medium, active_d, trench_d, density):
+    def reflectance(mats, d):
+        n_array = stack_nk(mats, medium, LAM)
+        return coh_tmm_spectrum('s', n_array, [inf] + list(d) + [inf], 0,
+                                LAM)['R']
+    ref_si = reflectance([], [])
+    return ((density / 100 * reflectance(['SiO2', 'SiN'], active_d)
+             + (1 - density / 100) * reflectance(['SiO2'], trench_d))
+            / ref_si)
+
+
+def test_grid_order(sweep):
+    assert sweep.shape == (2, 3, 1, 2, 2)
+    assert sweep.size == 24
+    params = sweep.params(0, sweep.size)
+    # Pattern density varies fastest, the medium slowest
+    np.testing.assert_array_equal(params['pattern_density'][:4], [20, 80] * 2)
+    np.testing.assert_array_equal(params['medium'], [1.0] * 12 + [1.3333] * 12)
+    np.testing.assert_array_equal(params['active_d'][:, 1], 40)
+    assert params['trench_d'].shape == (24, 1)
+
+
+def test_evaluate_matches_single_stacks(sweep):
+    r = sweep.evaluate(5, 19)
+    params = sweep.params(5, 19)
+    for i in range(r.shape[0]):
+        np.testing.assert_allclose(
+            r[i], expected_r(params['medium'][i], params['active_d'][i],
+                             params['trench_d'][i],
+                             params['pattern_density'][i]),
+            rtol=1e-10)
+
+
+def test_chunks_cover_sweep(sweep):
+    chunks = list(sweep.chunks(chunk_size=7))
+    assert [(c['start'], c['stop']) for c in chunks] == [
+        (0, 7), (7, 14), (14, 21), (21, 24)]
+    np.testing.assert_allclose(np.vstack([c['r'] for c in chunks]),
+                               sweep.evaluate(0, sweep.size), rtol=1e-12)
+
+
+def test_write_npz(sweep, tmp_path):
+    path = sweep.write(str(tmp_path / 'sweep.npz'), chunk_size=5)
+    with np.load(path) as data:
+        np.testing.assert_array_equal(data['wavelength'], LAM)
+        np.testing.assert_allclose(data['r'], sweep.evaluate(0, sweep.size),
+                                   rtol=1e-12)
+        params = sweep.params(0, sweep.size)
+        for key in ('medium', 'pattern_density', 'active_d', 'trench_d'):
+            np.testing.assert_array_equal(data[key], params[key])
+
+
+def test_write_hdf5(sweep, tmp_path):
+    h5py = pytest.importorskip('h5py')
+    path = sweep.write(str(tmp_path / 'sweep.h5'), chunk_size=5)
+    with h5py.File(path, 'r') as f:
+        np.testing.assert_allclose(f['r'][:], sweep.evaluate(0, sweep.size),
+                                   rtol=1e-12)
+        np.testing.assert_array_equal(f['active_d'][:],
+                                      sweep.params(0, sweep.size)['active_d'])
+
+
+def test_write_parquet(sweep, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = sweep.write(str(tmp_path / 'sweep.parquet'), chunk_size=5)
+    table = pq.read_table(path)
+    assert table.num_rows == sweep.size
+    r = np.array(table.column('r').to_pylist())
+    np.testing.assert_allclose(r, sweep.evaluate(0, sweep.size), rtol=1e-12)
+    wavelength = table.schema.metadata[b'wavelength'].decode().split(',')
+    np.testing.assert_array_equal(np.array(wavelength, dtype=float), LAM)
+
+
+def test_write_checks_format(sweep, tmp_path):
+    with pytest.raises(ValueError):
+        sweep.write(str(tmp_path / 'sweep.txt'))
+    assert write_npz(sweep, str(tmp_path / 'direct.npz'))
+
+
+@pytest.mark.parametrize('wavelength_chunk', [None, 10])
+def test_parallel_sweep_matches_serial(sweep, wavelength_chunk):
+    with parallel_sweep(sweep, max_workers=2, chunk_size=5,
+                        wavelength_chunk=wavelength_chunk) as result:
+        assert result.r.shape == (sweep.size, LAM.size)
+        np.testing.assert_allclose(result.r, sweep.evaluate(0, sweep.size),
+                                   rtol=1e-12)
+
+
+def test_shared_sweep_result_close():
+    result = SharedSweepResult((3, 4))
+    result.r[:] = 1
+    result.close()
+    assert result.r is None
+
+
+def test_default_grid_is_spectral_grid(materials):
+    from app.spectra import SPECTRAL_GRID
+    sweep = DOESweep(['SiO2'], [100], ['SiO2'], [200])
+    assert sweep.grid == SPECTRAL_GRID
@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from app import metrics, spectra
+from app.timing import TimingBuffer, stage, timed
+
+
+def test_stages_are_exclusive():
+    buffer = TimingBuffer()
+    with timed('test.request', buffer=buffer, tab='x') as timer:
+        with stage('parse'):
+            time.sleep(0.01)
+            with stage('tmm'):
+                time.sleep(0.02)
+        timer.fields['payload_bytes'] = 10
+    record, = buffer.records()
+    assert record['name'] == 'test.request'
+    assert record['tab'] == 'x' and record['payload_bytes'] == 10
+    assert list(record['stages_ms']) == ['parse', 'tmm']
+    assert 10 <= record['stages_ms']['parse'] < 20
+    assert record['stages_ms']['tmm'] >= 20
+    assert sum(record['stages_ms'].values()) <= record['total_ms']
+
+
+def test_errors_are_recorded():
+    buffer = TimingBuffer()
+    with pytest.raises(KeyError):
+        with timed('test.error', buffer=buffer):
+            raise KeyError('x')
+    assert buffer.records()[0]['error'] == 'KeyError'
+
+
+def test_stage_outside_timed_is_a_no_op():
+    with stage('parse'):
+        pass
+
+
+def test_buffer_summary():
+    buffer = TimingBuffer(maxlen=3)
+    for ms in (1, 2, 3, 4):
+        buffer.append({'name': 'a', 'total_ms': ms, 'stages_ms': {'tmm': ms}})
+    assert len(buffer) == 3
+    summary = buffer.summary('a')
+    assert summary['total']['count'] == 3
+    assert summary['tmm']['max_ms'] == 4 and summary['tmm']['p50_ms'] == 3
+
+
+def test_spectra_stages(materials):
+    buffer = TimingBuffer()
+    with timed('test.spectra', buffer=buffer):
+        spectra.compute_reflectance_batch(['SiO2'], [[100], [90]], 1.0)
+        spectra.combined_spectrum_adaptive(['SiO2'], [100], [], [], 50, 1.0,
+                                           tol=1e-2)
+    record, = buffer.records()
+    # nk_fetch is the database query, which the test materials bypass
+    assert {'interpolation', 'tmm'} <= set(record['stages_ms'])
+
+
+def test_core_tmm_is_not_instrumented():
+    # The engine stays usable without the app; its callers time it
+    from app import core_tmm
+    assert not hasattr(core_tmm, 'stage')
+
+
+def test_metrics_render():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter('c_total', 'A counter.',
+                                                ['kind']))
+    histogram = registry.register(metrics.Histogram('h_seconds', 'Latency.',
+                                                    buckets=(0.1, 1)))
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    histogram.observe(0.5)
+    text = registry.render()
+    assert 'c_total{kind="a"} 3.0' in text
+    assert 'h_seconds_bucket{le="0.1"} 0.0' in text
+    assert 'h_seconds_bucket{le="1.0"} 1.0' in text
+    assert 'h_seconds_bucket{le="+Inf"} 1.0' in text
+    assert 'h_seconds_count 1.0' in text
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+    with pytest.raises(ValueError):
+        registry.register(metrics.Gauge('c_total', 'Duplicate.'))
+
+
+def test_spectra_count_tmm(materials):
+    def evaluations():
+        return sum(value for _, _, value in metrics.TMM_EVALUATIONS.samples())
+    before = evaluations()
+    spectra.compute_reflectance_batch(['SiO2'], [[100], [90], [80]], 1.0)
+    assert evaluations() == before + 3